@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Compare the payload codecs on encode time, decode time and payload size.
+
+    python benchmark/bench_codecs.py [--repeat N]
+"""
+import argparse
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nframe_protocol import CODECS
+
+SAMPLES = {
+    "numeric lists": {"series {0}".format(i): [j * 0.25 for j in range(500)]
+                      for i in range(20)},
+    "integer lists": {"ids {0}".format(i): list(range(i, i + 500))
+                      for i in range(20)},
+    "flat strings": {"key {0}".format(i): "value {0}".format(i)
+                     for i in range(2000)},
+    "nested records": {"user {0}".format(i): {"name": "user {0}".format(i),
+                                              "age": i % 90,
+                                              "active": i % 2 == 0,
+                                              "scores": [i, i * 2, i * 3]}
+                       for i in range(1000)},
+}
+
+
+def bench(repeat):
+    print("{0:<16}{1:<8}{2:>12}{3:>12}{4:>12}".format(
+        "sample", "codec", "bytes", "encode ms", "decode ms"))
+    for sample, data in sorted(SAMPLES.items()):
+        for name, codec in sorted(CODECS.items()):
+            payload = codec.encode(data)
+            encode_time = timeit(lambda: codec.encode(data), number=repeat)
+            decode_time = timeit(lambda: codec.decode(payload), number=repeat)
+            print("{0:<16}{1:<8}{2:>12}{3:>12.3f}{4:>12.3f}".format(
+                sample, name, len(payload), encode_time * 1000 / repeat,
+                decode_time * 1000 / repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--repeat", default=20, type=int,
+                        help="Runs per measurement")
+    bench(parser.parse_args().repeat)
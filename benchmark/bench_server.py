@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Drive a local nframe server with concurrent clients and report the
+throughput and latency percentiles of every operation.
+
+    python benchmark/bench_server.py [--modes single thread fork]
+        [--clients 16] [--duration 10] [--mix get=8,set=1,message=1]
+        [--keys 1000] [--value-size 100] [--output results.json]
+        [--compare baseline.json]
+
+Every mode gets a fresh server, started with nframe_server.main in a child
+process on a temporary data file, seeded with --keys keys. Clients are
+threads with a connection each. Clients that completed no operation while
+measuring are reported as starved and counted as errors. Results are saved
+as JSON with --output, --compare checks them against an earlier run and
+exits with 1 if an operation got slower by more than --tolerance or more
+clients starved.
+"""
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect
+from multiprocessing import Process
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nframe_server
+from nframe_client import Client
+from nframe_metrics import timer
+
+# Seconds after the deadline a client may take to finish its last operation
+STUCK_AFTER = 10.0
+
+
+def _key(rng, args):
+    return "key{0}".format(rng.randrange(args.keys))
+
+
+# Operation name: function running it once
+OPERATIONS = {
+    "get": lambda conn, rng, args: conn.get(_key(rng, args)),
+    "set": lambda conn, rng, args: conn.set({_key(rng, args): args.value}),
+    "message": lambda conn, rng, args: conn.message(
+        {_key(rng, args): args.value}),
+    "get_data": lambda conn, rng, args: conn.get_data(),
+    "count": lambda conn, rng, args: conn.count(),
+}
+
+
+def parse_mix(text):
+    """ "get=8,set=1" to a list of (operation, weight) """
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                "Unknown operation {0}, pick from {1}".format(
+                    name, ", ".join(sorted(OPERATIONS))))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(mode, port, directory, server_args):
+    """ Run nframe_server.main in a child process, wait until it listens """
+    argv = ["--ip", "127.0.0.1", "--port", str(port), "--mode", mode,
+            "--data-file", os.path.join(directory, "data.json"),
+            "--pid-file", os.path.join(directory, "nframe.pid")]
+    process = Process(target=nframe_server.main,
+                      args=argv + shlex.split(server_args))
+    process.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return process
+        except socket.error:
+            if not process.is_alive():
+                break
+            time.sleep(0.05)
+    process.terminate()
+    raise SystemExit("Server in {0} mode did not start".format(mode))
+
+
+def seed(port, args):
+    conn = Client("127.0.0.1", port, persistent=True)
+    for start in range(0, args.keys, 1000):
+        conn.set(dict(("key{0}".format(index), args.value) for index in
+                      range(start, min(start + 1000, args.keys))))
+    conn.close()
+
+
+def worker(port, args, number, measure_from, deadline, samples, errors):
+    """ Run random operations of the mix until deadline, keeping the
+    latencies of those finished after measure_from, so an operation held
+    up through the warmup counts with all of its latency
+    """
+    conn = Client("127.0.0.1", port, persistent=True, codec=args.codec)
+    rng = random.Random(number)
+    names = [name for name, _ in args.mix]
+    cumulative = []
+    total = 0
+    for _, weight in args.mix:
+        total += weight
+        cumulative.append(total)
+    while True:
+        name = names[bisect(cumulative, rng.random() * total)]
+        started = timer()
+        if started >= deadline:
+            break
+        try:
+            OPERATIONS[name](conn, rng, args)
+        except Exception:
+            errors[name] = errors.get(name, 0) + 1
+            continue
+        finished = timer()
+        if finished >= measure_from:
+            samples.setdefault(name, []).append(finished - started)
+    conn.close()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, seconds):
+    """ Count, ops/s and latency percentiles in milliseconds """
+    ordered = sorted(latencies)
+    if not ordered:
+        return dict(count=0, ops_per_sec=0)
+    return dict(count=len(ordered), ops_per_sec=len(ordered) / seconds,
+                p50=percentile(ordered, 0.5) * 1000,
+                p90=percentile(ordered, 0.9) * 1000,
+                p99=percentile(ordered, 0.99) * 1000,
+                max=ordered[-1] * 1000)
+
+
+def run(mode, args):
+    """ Benchmark one server mode, returns its results """
+    directory = tempfile.mkdtemp(prefix="nframe-bench-")
+    port = free_port()
+    process = start_server(mode, port, directory, args.server_args)
+    try:
+        seed(port, args)
+        measure_from = timer() + args.warmup
+        deadline = measure_from + args.duration
+        samples = [{} for _ in range(args.clients)]
+        errors = [{} for _ in range(args.clients)]
+        threads = [Thread(target=worker,
+                          args=(port, args, number, measure_from, deadline,
+                                samples[number], errors[number]))
+                   for number in range(args.clients)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline - timer(), 0) + STUCK_AFTER)
+        server_stats = Client("127.0.0.1", port).stats()
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    operations = {}
+    everything = []
+    for name, _ in args.mix:
+        latencies = [sample for client in samples
+                     for sample in client.get(name, [])]
+        everything.extend(latencies)
+        operations[name] = summarize(latencies, args.duration)
+        operations[name]['errors'] = sum(client.get(name, 0)
+                                         for client in errors)
+    clients = [sum(len(latencies) for latencies in client.values())
+               for client in list(samples)]
+    starved = sum(1 for count in clients if not count)
+    return dict(summarize(everything, args.duration), operations=operations,
+                clients=clients, starved=starved,
+                errors=starved + sum(operation['errors'] for operation
+                                     in operations.values()),
+                server=server_stats)
+
+
+def revision():
+    """ Short git revision of the tree being benchmarked, if known """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    print("{0:<10}{1:<10}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}{7:>8}".format(
+        "mode", "operation", "ops/s", "p50 ms", "p90 ms", "p99 ms", "max ms",
+        "errors"))
+    for mode, result in sorted(results['runs'].items()):
+        for name, numbers in sorted(result['operations'].items()):
+            if not numbers['count']:
+                continue
+            print("{0:<10}{1:<10}{2:>10.0f}{3:>10.3f}{4:>10.3f}{5:>10.3f}"
+                  "{6:>10.3f}{7:>8}".format(
+                      mode, name, numbers['ops_per_sec'], numbers['p50'],
+                      numbers['p90'], numbers['p99'], numbers['max'],
+                      numbers['errors']))
+        print("{0:<10}{1:<10}{2:>10.0f}{3:>48}".format(
+            mode, "total", result['ops_per_sec'], result['errors']))
+        print("{0:<10}{1:<10}{2} clients, {3} to {4} ops each, {5} "
+              "starved".format(mode, "clients", len(result['clients']),
+                               min(result['clients']),
+                               max(result['clients']), result['starved']))
+
+
+def compare(results, baseline, tolerance):
+    """ Print the change of every operation measured in both runs, returns
+    True if one of them lost more than tolerance of its throughput or
+    gained more than tolerance on its p99 latency
+    """
+    regressed = False
+    print("\nAgainst {0} ({1})".format(baseline.get('revision'),
+                                       time.ctime(baseline['time'])))
+    print("{0:<10}{1:<10}{2:>12}{3:>12}".format("mode", "operation",
+                                               "ops/s", "p99"))
+    for mode, result in sorted(results['runs'].items()):
+        before = baseline['runs'].get(mode)
+        if before is None:
+            continue
+        if result['starved'] > before.get('starved', 0):
+            regressed = True
+            print("{0:<10}{1} clients starved, {2} before  regression".format(
+                mode, result['starved'], before.get('starved', 0)))
+        for name, numbers in sorted(result['operations'].items()):
+            old = before['operations'].get(name)
+            if not numbers['count'] or not old or not old['count']:
+                continue
+            throughput = numbers['ops_per_sec'] / old['ops_per_sec'] - 1
+            latency = numbers['p99'] / old['p99'] - 1 if old['p99'] else 0
+            slower = throughput < -tolerance or latency > tolerance
+            regressed = regressed or slower
+            print("{0:<10}{1:<10}{2:>+11.1%}{3:>+12.1%}{4}".format(
+                mode, name, throughput, latency,
+                "  regression" if slower else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["thread"],
+                        choices=nframe_server.SERVER_MODES,
+                        help="Server modes to benchmark, one after another")
+    parser.add_argument("--clients", default=16, type=int,
+                        help="Concurrent clients")
+    parser.add_argument("--duration", default=10.0, type=float,
+                        help="Seconds measured per mode")
+    parser.add_argument("--warmup", default=1.0, type=float,
+                        help="Seconds run before measuring")
+    parser.add_argument("--mix", default=parse_mix("get=8,set=1,message=1"),
+                        type=parse_mix,
+                        help="Weighted operations, e.g. "
+                             "get=8,set=1,message=1,get_data=0.1,count=1")
+    parser.add_argument("--keys", default=1000, type=int,
+                        help="Keys in the data set")
+    parser.add_argument("--value-size", default=100, type=int,
+                        dest="value_size",
+                        help="Bytes in every value written")
+    parser.add_argument("--codec", default="json",
+                        help="Payload codec of the clients")
+    parser.add_argument("--server-args", default="", dest="server_args",
+                        help="More options for the server, e.g. "
+                             "\"--wal --flush-every 1\"")
+    parser.add_argument("--output", default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument("--compare", default=None,
+                        help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="Change counted as regression, 0.1 is 10%%")
+    args = parser.parse_args()
+    args.value = "x" * args.value_size
+
+    results = dict(time=time.time(), revision=revision(),
+                   python=sys.version.split()[0],
+                   nframe=nframe_server.__version__,
+                   config=dict(clients=args.clients, duration=args.duration,
+                               mix=dict(args.mix), keys=args.keys,
+                               value_size=args.value_size, codec=args.codec,
+                               server_args=args.server_args),
+                   runs={})
+    for mode in args.modes:
+        results['runs'][mode] = run(mode, args)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+asyncio engine for nframe, Python 3.7+ only. One event loop holds every
+connection, so thousands of mostly idle clients cost a few kilobytes each
+instead of a thread each. Speaks the same protocol and commands as
+nframe_server.Server and nframe_client.Client.
+"""
+
+__version__ = '0.1'
+
+import asyncio
+import os
+from collections import namedtuple
+
+from nframe_protocol import (HEADER, FLAG_ERROR, pack_header, unpack_header,
+                             encode, decode_frame, decode_message,
+                             accepted_compression, accept_flags, compress,
+                             ProtocolError, ConnectionClosed, RemoteError,
+                             CODEC_SHIFT, COMPRESS_THRESHOLD, JSON)
+from nframe_server import (Store, CommandError, ServerError, MAX_REQUEST_SIZE,
+                           REQUEST_TIMEOUT, BUSY_MESSAGE)
+from nframe_metrics import timer
+
+# A decoded watch request, served by AsyncServer._watch
+_Watch = namedtuple("_Watch", "version keys codec")
+
+
+async def read_frame(reader, max_size=None, timeout=None, idle_timeout=None):
+    """ Read a single frame from a stream.
+
+    :param reader: asyncio.StreamReader
+    :param max_size: Largest payload accepted, checked against the header
+    :param timeout: Seconds the payload may take once the header arrived
+    :param idle_timeout: Seconds to wait for the header
+    :return: tuple of (flags, payload)
+    """
+    flags, length = await read_header(reader, max_size, idle_timeout)
+    return flags, await read_payload(reader, length, timeout)
+
+
+async def read_header(reader, max_size=None, idle_timeout=None):
+    """ Read the header of a frame, see read_frame.
+
+    :return: tuple of (flags, payload length)
+    """
+    return unpack_header(await _read_exactly(reader, HEADER.size,
+                                             idle_timeout), max_size)
+
+
+async def read_payload(reader, length, timeout=None):
+    """ Read the payload of a frame whose header was read, see read_frame.
+    """
+    return await _read_exactly(reader, length, timeout)
+
+
+async def _read_exactly(reader, size, timeout):
+    try:
+        return await asyncio.wait_for(reader.readexactly(size), timeout)
+    except asyncio.IncompleteReadError as err:
+        raise ConnectionClosed("Connection closed after {0} bytes"
+                               .format(len(err.partial)))
+
+
+def write_frame(writer, payload, flags=0):
+    """ Queue a single frame on a stream, drain the writer afterwards """
+    writer.write(pack_header(len(payload), flags))
+    writer.write(payload)
+
+
+class AsyncServer(object):
+    """
+    asyncio stream server running requests against a Store. Requests are
+    handed to the default executor, so saving to disk never blocks the loop.
+    """
+    # Seconds between heartbeats sent to watchers while nothing changes
+    watch_heartbeat = 1.0
+
+    def __init__(self, store=None, keep_alive_timeout=None,
+                 compress_threshold=COMPRESS_THRESHOLD, max_connections=None,
+                 max_request_size=MAX_REQUEST_SIZE,
+                 request_timeout=REQUEST_TIMEOUT):
+        """
+        :param store: Store shared by all connections
+        :param keep_alive_timeout: Seconds an idle connection is kept open,
+            None to keep it until the client disconnects
+        :param compress_threshold: Smallest response compressed for clients
+            accepting it, None to never compress
+        :param max_connections: Connections served at once, further ones
+            are answered with an error and closed, None for no limit
+        :param max_request_size: Largest request accepted, in bytes
+        :param request_timeout: Seconds a request may take to arrive once
+            it started, and a response to be sent
+        """
+        self.store = store or Store()
+        self.keep_alive_timeout = keep_alive_timeout
+        self.compress_threshold = compress_threshold
+        self.max_connections = max_connections
+        self.max_request_size = max_request_size
+        self.request_timeout = request_timeout
+        self.connections = 0
+        self.server = None
+
+    async def start(self, host="0.0.0.0", port=7645):
+        """ Start accepting connections. """
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        """ Stop accepting connections. """
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _run(self, flags, payload, received=None):
+        """ Decode, run and encode one request, off the event loop. The
+        response uses the codec of the request and is compressed if the
+        request accepts it. The timeout of the request counts from
+        received, see Store.execute.
+
+        :return: tuple of (response payload, response flags), of a _Watch
+            and None for a watch request, or of an open snapshot file and
+            None for a snapshot request
+        """
+        metrics = self.store.metrics
+        started = timer()
+        incoming, codec = decode_frame(flags, payload, self.max_request_size)
+        metrics.observe("decode", timer() - started)
+        metrics.count("bytes_in", HEADER.size + len(payload))
+        if isinstance(incoming, dict) and incoming.get("command") == "watch":
+            return _Watch(*self.store.watch_args(incoming.get("data")),
+                          codec=codec), None
+        if isinstance(incoming, dict) and \
+                incoming.get("command") == "snapshot":
+            try:
+                return self.store.open_snapshot(), None
+            except ServerError as err:
+                raise CommandError(str(err))
+        result = self.store.execute(incoming, received)
+        started = timer()
+        response = codec.encode(result)
+        response_flags = codec.codec_id << CODEC_SHIFT
+        compression = accepted_compression(flags)
+        if compression and self.compress_threshold is not None and \
+                len(response) >= self.compress_threshold:
+            response, compressed = compress(response, compression)
+            response_flags |= compressed
+        metrics.observe("encode", timer() - started)
+        metrics.count("bytes_out", HEADER.size + len(response))
+        return response, response_flags
+
+    async def _drain(self, writer):
+        """ Wait until the client took the queued frames, at most
+        request_timeout seconds.
+        """
+        await asyncio.wait_for(writer.drain(), self.request_timeout)
+
+    async def handle(self, reader, writer):
+        """ Serve requests on one connection until it is closed. Beyond
+        max_connections the connection is turned away right away.
+        """
+        if self.max_connections is not None and \
+                self.connections >= self.max_connections:
+            self.store.metrics.count("connections_rejected")
+            write_frame(writer, encode(BUSY_MESSAGE), FLAG_ERROR)
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            await self._serve(reader, writer)
+        finally:
+            self.connections -= 1
+
+    async def _serve(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    flags, length = await read_header(
+                        reader, self.max_request_size,
+                        self.keep_alive_timeout)
+                    received = timer()
+                    payload = await read_payload(reader, length,
+                                                 self.request_timeout)
+                except (ConnectionClosed, ConnectionError,
+                        asyncio.TimeoutError):
+                    return
+                except ProtocolError as err:
+                    # The stream can not be trusted anymore, drop the client
+                    write_frame(writer, encode("Invalid request: {0}"
+                                               .format(err)), FLAG_ERROR)
+                    await self._drain(writer)
+                    return
+                try:
+                    response, response_flags = await loop.run_in_executor(
+                        None, self._run, flags, payload, received)
+                except ProtocolError as err:
+                    write_frame(writer, encode("Invalid request: {0}"
+                                               .format(err)), FLAG_ERROR)
+                    await self._drain(writer)
+                    return
+                except (TypeError, ValueError) as err:
+                    write_frame(writer, encode("Invalid request: {0}"
+                                               .format(err)), FLAG_ERROR)
+                except CommandError as err:
+                    write_frame(writer, encode(str(err)), FLAG_ERROR)
+                else:
+                    if isinstance(response, _Watch):
+                        return await self._watch(writer, response)
+                    if response_flags is None:
+                        await self._snapshot(writer, response)
+                    else:
+                        write_frame(writer, response, response_flags)
+                await self._drain(writer)
+        except (ConnectionError, asyncio.TimeoutError):
+            return
+        finally:
+            writer.close()
+
+
+    async def _snapshot(self, writer, snapshot):
+        """ Send an open snapshot file as the payload of one frame, see
+        nframe_server.Server._snapshot
+        """
+        with snapshot:
+            size = os.fstat(snapshot.fileno()).st_size
+            writer.write(pack_header(size, JSON.codec_id << CODEC_SHIFT))
+            await asyncio.get_running_loop().sendfile(writer.transport,
+                                                      snapshot, 0, size)
+        self.store.metrics.count("bytes_out", HEADER.size + size)
+
+    async def _watch(self, writer, watch):
+        """ Stream change events until the client disconnects, see
+        nframe_server.Server._watch
+        """
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(changed.set)
+
+        self.store.add_listener(listener)
+        version, keys, codec = watch
+        events = []
+        try:
+            while True:
+                write_frame(writer, codec.encode(dict(
+                    instance=self.store._instance, version=version,
+                    events=events)),
+                            codec.codec_id << CODEC_SHIFT)
+                await self._drain(writer)
+                changed.clear()
+                events, version = self.store.changes_since(version, keys)
+                if events:
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(),
+                                           self.watch_heartbeat)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(None, self.store.refresh)
+                events, version = self.store.changes_since(version, keys)
+        finally:
+            self.store.remove_listener(listener)
+
+
+def serve(host="0.0.0.0", port=7645, store=None,
+          compress_threshold=COMPRESS_THRESHOLD, **options):
+    """ Run an AsyncServer until interrupted, options are passed on to it.
+    """
+    async def run():
+        server = await AsyncServer(
+            store, compress_threshold=compress_threshold,
+            **options).start(host, port)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(run())
+
+
+class AsyncClient(object):
+    """
+    Awaitable counterpart of nframe_client.Client. Calls may run
+    concurrently, for example with asyncio.gather, each one uses its own
+    connection.
+    """
+    def __init__(self, server="localhost", port=7645, persistent=False,
+                 pool_size=4, compression=None, timeout=None):
+        """
+        :param server: Host name or IP of the server
+        :param port: Port of the server
+        :param persistent: Keep up to pool_size idle connections open for
+            reuse, otherwise connect for every call
+        :param compression: "zlib" or "lzma" to have large responses
+            compressed
+        :param timeout: Seconds a request may take, see
+            nframe_client.Client, asyncio.TimeoutError is raised after that
+        """
+        self.server = server
+        self.port = port
+        self.persistent = persistent
+        self.pool_size = pool_size
+        self.compression = compression
+        self.timeout = timeout
+        self._idle = []
+
+    async def _connect(self):
+        """ Reuse an idle connection or open a new one. """
+        if self._idle:
+            return self._idle.pop()
+        return await asyncio.open_connection(self.server, self.port)
+
+    def _release(self, connection):
+        """ Keep a healthy connection for reuse, or close it. """
+        if self.persistent and len(self._idle) < self.pool_size:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def _send(self, connection, data):
+        reader, writer = connection
+        write_frame(writer, encode(data), accept_flags(self.compression))
+        await writer.drain()
+        return decode_message(*await read_frame(reader))
+
+    async def _communicate(self, command, data=None, **fields):
+        request = dict(command=command, data=data)
+        if self.timeout is not None:
+            request['timeout'] = self.timeout
+        request.update(fields)
+        reused = bool(self._idle)
+        try:
+            connection = await asyncio.wait_for(self._connect(),
+                                                self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return "Error while communicating"
+        try:
+            received = await asyncio.wait_for(
+                self._send(connection, request), self.timeout)
+        except asyncio.TimeoutError:
+            # The server may still run it, do not send it again
+            connection[1].close()
+            raise
+        except (OSError, ConnectionClosed):
+            connection[1].close()
+            if not reused:
+                raise
+            # The server closed the idle connection, start over
+            self.close()
+            return await self._communicate(command, data, **fields)
+        except RemoteError:
+            # The exchange completed, the connection is still usable
+            self._release(connection)
+            raise
+        except Exception:
+            connection[1].close()
+            raise
+        self._release(connection)
+        return received
+
+    async def watch(self, keys=None, since=None):
+        """ Asynchronous generator of change events on a connection of its
+        own, see nframe_client.Client.watch. The subscription starts with
+        the first iteration.
+        """
+        reader, writer = await asyncio.open_connection(self.server,
+                                                       self.port)
+        try:
+            await self._send((reader, writer), dict(
+                command="watch", data=dict(keys=keys, since=since)))
+            while True:
+                frame = decode_message(*await read_frame(reader))
+                for event in frame['events']:
+                    event['token'] = "{0}:{1}".format(frame['instance'],
+                                                      event['version'])
+                    yield event
+        finally:
+            writer.close()
+
+    def close(self):
+        """ Close all idle connections. """
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def message(self, data, ttl=None):
+        """ Add data on the server, returns the request as echoed back.
+        With ttl the keys expire after that many seconds.
+        """
+        if ttl is None:
+            return await self._communicate("add data", data)
+        return await self._communicate("add data", data, ttl=ttl)
+
+    async def get_data(self):
+        """ Retrieve all data from the server. """
+        return await self._communicate("get data")
+
+    async def get(self, *keys):
+        """ Retrieve the given keys that exist. """
+        return await self._communicate("get", list(keys))
+
+    async def set(self, data, ttl=None):
+        """ Update keys without having them echoed back, see message. """
+        if ttl is None:
+            return await self._communicate("set", data)
+        return await self._communicate("set", data, ttl=ttl)
+
+    async def delete(self, *keys):
+        """ Remove keys, returns how many of them existed. """
+        return await self._communicate("delete", list(keys))
+
+    async def exists(self, *keys):
+        """ For each key whether it exists. """
+        return await self._communicate("exists", list(keys))
+
+    async def keys(self, prefix=""):
+        """ The sorted keys starting with prefix. """
+        return await self._communicate("keys", prefix)
+
+    async def count(self):
+        """ The number of keys on the server. """
+        return await self._communicate("count")
+
+    async def query(self, **query):
+        """ Find keys on the server, see nframe_client.Client.query. """
+        return await self._communicate("query", dict(
+            (name, value) for name, value in query.items() if value))
+
+    async def stats(self):
+        """ Metrics of the server, see nframe_client.Client.stats. """
+        return await self._communicate("stats")
@@ -6,76 +6,588 @@ Copyright (c) 2014 Chris Griffith - MIT License
 
 __version__ = '0.1'
 
+import os
 import socket
-from json import dumps, loads
-from math import ceil
-import sys
-from functools import partial
+from collections import deque, OrderedDict
+from itertools import count
+from threading import Lock, BoundedSemaphore
+from time import time
 
-_bytes = partial(bytes, encoding='utf-8') if sys.version_info > (3,) else \
-    lambda x: str(x).encode('utf-8')
+from nframe_protocol import (recv_message, send_message, set_nodelay,
+                             recv_frame_into, get_codec, accept_flags,
+                             ConnectionClosed, RemoteError, ProtocolError,
+                             COMPRESSIONS, COMPRESS_THRESHOLD, JSON)
 
+_replace = getattr(os, 'replace', os.rename)
 
-class Client():
-    def __init__(self, server="localhost", port=7645, **kwargs):
+# Returned instead of a response when the server can not be reached
+COMMUNICATION_ERROR = "Error while communicating"
+
+# Commands that only read, and can be answered by a replica
+READ_COMMANDS = ("get data", "get", "exists", "keys", "count", "query")
+
+
+def _with_token(event, frame):
+    """ Add the token resuming a watch after event, see Client.watch """
+    event['token'] = "{0}:{1}".format(frame['instance'], event['version'])
+    return event
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of open connections to one server. At most max_size
+    connections are open at once, idle ones are reused newest first and
+    closed once they have not been used for idle_timeout seconds. Opening
+    a connection gives up after timeout seconds.
+    """
+    def __init__(self, address, max_size=4, idle_timeout=4.0, timeout=None):
+        self.address = address
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = deque()
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_size)
+
+    def _connect(self):
+        """ Open a new connection to the server. """
+        sock = socket.create_connection(self.address, self.timeout)
+        set_nodelay(sock)
+        return sock
+
+    def acquire(self):
+        """
+        Take a connection out of the pool, opening a new one if there are
+        no usable idle connections. Blocks while max_size are in use.
+
+        :return: tuple of (socket, True if the socket was reused)
+        """
+        self._slots.acquire()
+        now = time()
+        stale = []
+        sock = None
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+                stale.append(self._idle.popleft()[0])
+            if self._idle:
+                sock = self._idle.pop()[0]
+        for old in stale:
+            old.close()
+        if sock is not None:
+            return sock, True
+        try:
+            return self._connect(), False
+        except socket.error:
+            self._slots.release()
+            raise
+
+    def release(self, sock):
+        """ Hand a healthy connection back to the pool. """
+        with self._lock:
+            self._idle.append((sock, time()))
+        self._slots.release()
+
+    def discard(self, sock):
+        """ Close a broken connection instead of returning it. """
+        sock.close()
+        self._slots.release()
+
+    def clear(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for sock, _ in idle:
+            sock.close()
+
+
+class Cache(object):
+    """
+    Thread safe least recently used cache holding at most size entries,
+    each one stored with the etag of the data it was read from.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """ :return: tuple of (etag, value), or None if not cached """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, etag, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (etag, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Commands(object):
+    """
+    Commands understood by the server, each one is sent with _communicate.
+    """
+    def _communicate(self, command, data=None, **fields):
+        raise NotImplementedError()
+
+    def message(self, data, ttl=None):
+        """
+        A example function that shows how to send data to the server
+        and receive data back. With ttl the keys expire after that many
+        seconds.
+        """
+        if ttl is None:
+            return self._communicate("add data", data)
+        return self._communicate("add data", data, ttl=ttl)
+
+    def get_data(self):
+        return self._communicate("get data")
+
+    def get(self, *keys):
+        """
+        Retrieve only the given keys, returns a dictionary of the ones
+        that exist.
+        """
+        return self._communicate("get", list(keys))
+
+    def set(self, data, ttl=None):
+        """
+        Update the keys in the dictionary data without having them echoed
+        back, returns the number of keys sent. With ttl the keys expire
+        after that many seconds, without it they are kept until deleted.
+        """
+        if ttl is None:
+            return self._communicate("set", data)
+        return self._communicate("set", data, ttl=ttl)
+
+    def delete(self, *keys):
+        """
+        Remove keys from the server, returns how many of them existed.
+        """
+        return self._communicate("delete", list(keys))
+
+    def exists(self, *keys):
+        """
+        Returns a list telling for each key whether it exists.
+        """
+        return self._communicate("exists", list(keys))
+
+    def keys(self, prefix=""):
+        """
+        Returns the sorted keys starting with prefix.
+        """
+        return self._communicate("keys", prefix)
+
+    def count(self):
+        """
+        Returns the number of keys on the server.
+        """
+        return self._communicate("count")
+
+    def query(self, prefix=None, start=None, stop=None, where=None,
+              limit=None, after=None, keys_only=False):
+        """
+        Find keys on the server, returns a dictionary of items, a list of
+        [key, value] in key order (just keys with keys_only), and cursor.
+        Only keys starting with prefix, from start up to but not including
+        stop and after the key after are considered, of those the ones whose
+        value meets all conditions in where, a list of
+        [field, operator, operand]:
+
+            conn.query(prefix="user:", where=[["age", ">=", 18],
+                                              ["address.city", "==", "Oslo"]])
+
+        Operators are ==, !=, <, <=, >, >=, in (operand is a list), prefix
+        and exists (operand is True or False). Given a limit, a full page
+        carries its last key as cursor, pass it as after for the next page.
+        """
+        query = dict(prefix=prefix, start=start, stop=stop, where=where,
+                     limit=limit, after=after, keys_only=keys_only)
+        return self._communicate("query", dict(
+            (name, value) for name, value in query.items() if value))
+
+    def stats(self):
+        """
+        Returns the metrics of the server: counters, latency percentiles in
+        milliseconds per phase and command, the number of keys, the version
+        and the changes not written yet.
+        """
+        return self._communicate("stats")
+
+
+
+class Pipeline(Commands):
+    """
+    Queues commands instead of sending them. execute(), which also runs
+    when the with block is left without an exception, sends all of them in
+    a single request. The server runs them in order with one save to disk
+    and the results are returned in the same order.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    #noinspection PyUnusedLocal
+    def __exit__(self, exctype, value, tb):
+        if exctype is None:
+            self.execute()
+
+    def _communicate(self, command, data=None, **fields):
+        request = dict(command=command, data=data)
+        request.update(fields)
+        self.requests.append(request)
+        return self
+
+    def execute(self):
+        """
+        Send the queued commands, returns the list of their results. If one
+        of them failed, RemoteError is raised with the results of the
+        commands before it as its results attribute.
+        """
+        requests, self.requests = self.requests, []
+        if not requests:
+            self.results = []
+            return self.results
+        response = self.client._communicate("batch", requests)
+        if not isinstance(response, dict):
+            # Could not connect
+            return response
+        self.results = response['results']
+        if response['error']:
+            error = RemoteError("Command {index} failed: {message}".format(
+                **response['error']))
+            error.results = self.results
+            raise error
+        return self.results
+
+
+class Client(Commands):
+    def __init__(self, server="localhost", port=7645, persistent=False,
+                 pool_size=4, idle_timeout=4.0, codec="json",
+                 compression=None, compress_threshold=COMPRESS_THRESHOLD,
+                 cache_size=0, replicas=None, timeout=None, **kwargs):
+        """
+        :param server: Host name or IP of the server
+        :param port: Port of the server
+        :param persistent: Keep connections open in a pool and reuse them,
+            otherwise connect for every call and disconnect afterwards
+        :param pool_size: Maximum number of open pooled connections
+        :param idle_timeout: Seconds before an idle pooled connection is
+            dropped, keep this below the server's keep_alive_timeout
+        :param codec: Preferred payload codec, "json" or "binary". Anything
+            but JSON is agreed on with the server by the first request,
+            falling back to JSON if the server does not support it.
+        :param compression: "zlib" or "lzma" to have large responses
+            compressed, and large requests too if the server supports it
+        :param compress_threshold: Smallest request that is compressed
+        :param cache_size: Keep the results of get_data() and of up to this
+            many keys fetched with get() and only fetch them again if they
+            changed on the server. Cached results are shared between calls,
+            do not modify them.
+        :param replicas: (host, port) of replicas of the server. Reads are
+            sent to them in turn and only to the server if the replica
+            fails, all other commands go to the server. A replica may lag
+            behind the server by the time a change takes to reach it.
+        :param timeout: Seconds a request may take. It is sent along, so the
+            server answers with an error instead of running a request that
+            waited longer than that, and socket.timeout is raised if the
+            response has not arrived by then. A request that timed out is
+            not sent again, it may still have been run.
+        """
         self.server = server
         self.port = port
         self.socket = None
+        self.pool = None
+        self.codec = get_codec(codec)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ProtocolError("Unknown compression {0}".format(compression))
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.timeout = timeout
+        # Agreed on with the server by the first request
+        self._codec = JSON
+        self._compression = None
+        self._negotiated = self.codec is JSON and not compression
+        self.cache = Cache(cache_size) if cache_size else None
+        self.replicas = [Client(host, replica_port, persistent, pool_size,
+                                idle_timeout, codec, compression,
+                                compress_threshold, timeout=timeout)
+                         for host, replica_port in replicas or ()]
+        self._turn = count()
+        if persistent:
+            self.pool = ConnectionPool((server, port), max_size=pool_size,
+                                       idle_timeout=idle_timeout,
+                                       timeout=timeout)
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def _connect(self):
         """Initiate the TCP socket connection to the server. """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
         self.socket.connect((self.server, self.port))
+        set_nodelay(self.socket)
 
     def _close(self):
         """ Close the tcp socket. """
         self.socket.close()
 
-    def _send(self, data):
-        """ Send and receive information from the server. This will automate
-        the process of breaking large data into chunks before sending.
+    def _send(self, data, sock=None):
+        """ Send a request frame to the server and wait for its response.
 
         :param data: Dictionary to send to the server.
+        :param sock: Connection to use, defaults to the one-shot socket.
         :return: Returned result from the server.
         """
-        write_data = _bytes(dumps(data))
-        data_sections = int(ceil(len(write_data) / 1024.0))
-        sec_data = {'sections': data_sections}
-        self.socket.send(_bytes(dumps(sec_data)))
-        if self.socket.recv(2).decode("utf-8") != "ok":
-            raise Exception('Server raised exception')
-        for index in range(0, data_sections):
-            self.socket.send(write_data[(1024 * index):(1024 * (index + 1))])
-        recv = loads(self.socket.recv(1024).decode('utf-8'))
-        self.socket.send(_bytes("ok"))
-        incoming = ""
-        for index in range(0, recv['sections']):
-            incoming += self.socket.recv(1024).decode('utf-8')
-        return loads(incoming)
-
-    def _communicate(self, command, data=None):
+        sock = sock or self.socket
+        started = time()
+        sock.settimeout(self.timeout)
+        if not self._negotiated:
+            self._negotiate(sock)
+        send_message(sock, data, flags=accept_flags(self.compression),
+                     codec=self._codec, compression=self._compression,
+                     threshold=self.compress_threshold)
+        if self.timeout is None:
+            return recv_message(sock)
+        return recv_message(sock, max(self.timeout - (time() - started), 0))
+
+    def _negotiate(self, sock):
+        """ Agree on the payload codec and request compression with the
+        server, once per client.
+        """
+        offer = dict(codecs=[self.codec.name, JSON.name])
+        if self.compression:
+            offer['compression'] = [self.compression]
+        send_message(sock, dict(command="hello", data=offer))
+        try:
+            answer = recv_message(sock)
+        except RemoteError:
+            # Server without negotiation
+            answer = {}
+        codecs = answer.get('codecs')
+        self._codec = get_codec(codecs[0]) if codecs else JSON
+        if self.compression in answer.get('compression', []):
+            self._compression = self.compression
+        self._negotiated = True
+
+    def _communicate(self, command, data=None, **fields):
+        if self.replicas and command in READ_COMMANDS:
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            try:
+                received = replica._communicate(command, data, **fields)
+            except (socket.error, ConnectionClosed, RemoteError):
+                received = COMMUNICATION_ERROR
+            if received != COMMUNICATION_ERROR:
+                return received
+        request = dict(command=command, data=data)
+        if self.timeout is not None:
+            request['timeout'] = self.timeout
+        request.update(fields)
+        if self.pool:
+            return self._communicate_pooled(request)
         try:
             self._connect()
         except socket.error:
-            received = "Error while communicating"
+            received = COMMUNICATION_ERROR
         else:
-            received = self._send(dict(command=command, data=data))
+            received = self._send(request)
         finally:
             self._close()
         return received
 
-    def message(self, data):
+    def _communicate_pooled(self, request):
+        """ Send the request over a pooled connection. A reused connection
+        may have been closed by the server in the meantime, in that case
+        the idle connections are dropped and the request is sent once more
+        over a fresh one.
         """
-        A example function that shows how to send data to the server
-        and receive data back.
-        """
-        return self._communicate("add data", data)
+        while True:
+            try:
+                sock, reused = self.pool.acquire()
+            except socket.error:
+                return COMMUNICATION_ERROR
+            try:
+                received = self._send(request, sock)
+            except socket.timeout:
+                # The server may still run it, do not send it again
+                self.pool.discard(sock)
+                raise
+            except (socket.error, ConnectionClosed):
+                self.pool.discard(sock)
+                if not reused:
+                    raise
+                self.pool.clear()
+            except RemoteError:
+                # The exchange completed, the connection is still usable
+                self.pool.release(sock)
+                raise
+            except Exception:
+                self.pool.discard(sock)
+                raise
+            else:
+                self.pool.release(sock)
+                return received
 
     def get_data(self):
-        return self._communicate("get data")
+        if self.cache is None:
+            return super(Client, self).get_data()
+        cached = self.cache.get(("data",))
+        response = self._communicate("get data", if_version=cached and
+                                     cached[0])
+        if not isinstance(response, dict):
+            # Could not connect
+            return response
+        if response.get('not_modified'):
+            return cached[1]
+        self.cache.put(("data",), response['version'], response['data'])
+        return response['data']
+
+    def get(self, *keys):
+        if self.cache is None:
+            return super(Client, self).get(*keys)
+        cached = [self.cache.get(("key", key)) for key in keys]
+        etag = None
+        tags = set(entry[0] for entry in cached if entry)
+        if keys and all(cached) and len(tags) == 1:
+            etag = tags.pop()
+        response = self._communicate("get", list(keys), if_version=etag)
+        if not isinstance(response, dict):
+            return response
+        if response.get('not_modified'):
+            return dict((key, entry[1][0]) for key, entry in zip(keys, cached)
+                        if entry[1])
+        data = response['data']
+        if len(keys) <= self.cache.size:
+            for key in keys:
+                # Keys that do not exist are cached as such
+                self.cache.put(("key", key), response['version'],
+                               (data[key],) if key in data else ())
+        return data
+
+    def scan(self, page_size=1000, **query):
+        """
+        Iterate over the items of a query, see query, fetching page_size
+        items per request.
+        """
+        after = query.pop("after", None)
+        while True:
+            page = self.query(limit=page_size, after=after, **query)
+            if not isinstance(page, dict):
+                raise ConnectionClosed(page)
+            for item in page['items']:
+                yield item
+            after = page['cursor']
+            if after is None:
+                return
+
+    def close(self):
+        """ Close all pooled connections. """
+        if self.pool:
+            self.pool.clear()
+        for replica in self.replicas:
+            replica.close()
+
+    def watch(self, keys=None, since=None):
+        """
+        Subscribe to changes on a connection of its own, returns a generator
+        of change events:
+
+            {"op": "update", "data": {key: value}, "version": 7,
+             "token": "8f3a01c2:7"}
+            {"op": "delete", "keys": [key], "version": 8, ...}
+            {"op": "reset", "version": 9, ...}
+
+        Only changes made after the call are sent, or all after the event
+        whose token is since to resume where an earlier watch stopped. A
+        reset means the changes can not be told apart anymore, fetch the
+        data again. Resuming from a token of a server that was restarted
+        since starts with a reset. The server must run in thread, fork or
+        async mode.
+
+        :param keys: Only send changes of these keys
+        :param since: Token of the last event already seen
+        """
+        sock = socket.create_connection((self.server, self.port),
+                                        self.timeout)
+        set_nodelay(sock)
+        try:
+            self._send(dict(command="watch", data=dict(keys=keys,
+                                                       since=since)), sock)
+        except Exception:
+            sock.close()
+            raise
+        # Events may be far apart
+        sock.settimeout(None)
+        return self._events(sock)
+
+    def download_snapshot(self, path, data_file=None):
+        """
+        Download all data of the server into the file path, on a connection
+        of its own, and return the number of bytes written. The file is
+        written while it arrives and only replaces path once complete. It
+        has the format of a JSON data file, so it can be imported or used
+        as the data file of a server. With data_file the keys are added to
+        that data file afterwards, with nframe_server.Data.import_data,
+        holding its lock as a Data context does, waiting up to the timeout
+        for it.
+
+        A timeout applies to every read of the download, not to all of it.
+        """
+        temp_file = "{0}.{1}.tmp".format(path, os.getpid())
+        sock = socket.create_connection((self.server, self.port),
+                                        self.timeout)
+        set_nodelay(sock)
+        try:
+            send_message(sock, dict(command="snapshot", data=None))
+            with open(temp_file, "wb") as handle:
+                size = recv_frame_into(sock, handle)[1]
+            # An earlier download stays in place until this one is complete
+            _replace(temp_file, path)
+        finally:
+            sock.close()
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+        if data_file is not None:
+            from nframe_server import Data
+            with Data(data_file, timeout=self.timeout) as data:
+                data.import_data(path, "json")
+        return size
+
+    @staticmethod
+    def _events(sock):
+        try:
+            while True:
+                frame = recv_message(sock)
+                for event in frame['events']:
+                    yield _with_token(event, frame)
+        finally:
+            sock.close()
+
+    def pipeline(self):
+        """
+        Queue commands and send them together in one request:
+
+            with client.pipeline() as pipe:
+                pipe.set({"a": 1})
+                pipe.get("a")
+            pipe.results
+        """
+        return Pipeline(self)
 
 
 if __name__ == '__main__':
-    print("\nYou can't run me!\n\n\ Read the README file.")
\ No newline at end of file
+    print("\nYou can't run me!\n\n\ Read the README file.")
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+Indexed storage engine for nframe. Values are kept in an append only record
+file and found through a sorted index of key hashes, both read through mmap,
+so opening a data set reads neither file and only the keys that are used are
+ever decoded.
+
+    data.json.records   header, then one record per change:
+                        key size, value size, flags | key | value
+    data.json.index     header, then (key hash, record offset) entries
+                        sorted by hash, covering the records up to the
+                        indexed end
+
+Records appended after the indexed end are scanned when the files are
+opened and kept in memory until compact() rewrites both files. Both headers
+carry the same random token, an index that does not belong to the record
+file, say after a crash while compacting, is ignored and the records are
+scanned instead.
+"""
+
+__version__ = '0.1'
+
+import hashlib
+import mmap
+import os
+import struct
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from nframe_protocol import BINARY, JSON, codec_from_flags, CODEC_SHIFT
+
+RECORDS_MAGIC = b"NFRC"
+INDEX_MAGIC = b"NFIX"
+RECORDS_HEADER = struct.Struct("<4s8s")
+INDEX_HEADER = struct.Struct("<4s8sQQ")
+RECORD = struct.Struct("<IIB")
+ENTRY = struct.Struct("<QQ")
+
+# Record flags, the top three bits name the codec of the value
+FLAG_DELETED = 0x01
+
+# Marks a deleted key that was not written yet
+_DELETED = object()
+_MISSING = object()
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def key_hash(raw_key):
+    """ 64 bit hash of an encoded key, the same in every process """
+    return struct.unpack("<Q", hashlib.md5(raw_key).digest()[:8])[0]
+
+
+def _encode_key(key):
+    """ Keys are always stored in the binary encoding, so their hash does
+    not depend on the codec of the values.
+    """
+    return bytes(BINARY.encode(key))
+
+
+def _map(filename):
+    """ Read only mmap of a whole file, None if it is empty """
+    with open(filename, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if not size:
+            return None
+        return mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+
+
+class IndexedData(MutableMapping):
+    """
+    Dictionary backed by a record file and its index. Changes are held in
+    memory until write() appends them as records.
+
+    Values are decoded on every access, changing a value that was read does
+    not change the stored one.
+    """
+    def __init__(self, records_file, index_file, codec=JSON):
+        self.records_file = records_file
+        self.index_file = index_file
+        self.codec = codec
+        self._pending = {}
+        self._writing = {}
+        self._tail = {}
+        self._count = 0
+        self._token = None
+        self._records = None
+        self._index = None
+        self._index_count = 0
+        self._indexed_end = 0
+        self._size = 0
+
+    @property
+    def tail_size(self):
+        """ Bytes of records not covered by the index """
+        return self._size - self._indexed_end
+
+    def open(self):
+        """ (Re)open the files, dropping all unwritten changes. """
+        self._pending = {}
+        self._writing = {}
+        self._tail = {}
+        self._records = self._index = None
+        self._index_count = 0
+        self._indexed_end = self._size = RECORDS_HEADER.size
+        self._token = None
+        if not os.path.exists(self.records_file):
+            self._count = 0
+            return
+        with open(self.records_file, "rb") as handle:
+            magic, self._token = RECORDS_HEADER.unpack(
+                handle.read(RECORDS_HEADER.size))
+        if magic != RECORDS_MAGIC:
+            raise ValueError("{0} is not a record file".format(
+                self.records_file))
+        if os.path.exists(self.index_file):
+            index = _map(self.index_file)
+            try:
+                magic, token, count, end = INDEX_HEADER.unpack_from(index, 0)
+            except (struct.error, TypeError):
+                magic = token = None
+            if magic == INDEX_MAGIC and token == self._token and \
+                    len(index) >= INDEX_HEADER.size + count * ENTRY.size:
+                self._index = index
+                self._index_count = count
+                self._indexed_end = self._size = end
+        self._count = self._index_count
+        self._scan()
+
+    def refresh(self):
+        """ Catch up with records appended by another process, reopening
+        the files if they were compacted meanwhile.
+        """
+        if self._token is None or not os.path.exists(self.records_file):
+            return self.open()
+        with open(self.records_file, "rb") as handle:
+            token = RECORDS_HEADER.unpack(
+                handle.read(RECORDS_HEADER.size))[1]
+        if token != self._token:
+            return self.open()
+        self._pending = {}
+        self._writing = {}
+        self._scan()
+
+    def _scan(self):
+        """ Apply the records after the last known one. A torn record at
+        the end, left by a crash, is cut off.
+        """
+        size = os.path.getsize(self.records_file)
+        if size <= self._size:
+            return
+        self._records = _map(self.records_file)
+        offset = self._size
+        while offset < size:
+            try:
+                key, flags, _, end = self._read_record(offset)
+            except (struct.error, ValueError, IndexError):
+                break
+            if end > size:
+                break
+            existed = self._offset(key) is not None
+            if flags & FLAG_DELETED:
+                self._tail[key] = None
+                self._count -= existed
+            else:
+                self._tail[key] = offset
+                self._count += not existed
+            offset = end
+        if offset < size:
+            with open(self.records_file, "r+b") as handle:
+                handle.truncate(offset)
+            self._records = _map(self.records_file)
+        self._size = offset
+
+    def _read_record(self, offset):
+        """ :return: tuple of (key, flags, value offset, end of record) """
+        if self._records is None or \
+                offset + RECORD.size > len(self._records):
+            # Appended since the file was mapped
+            self._records = _map(self.records_file)
+        key_size, value_size, flags = RECORD.unpack_from(self._records,
+                                                         offset)
+        start = offset + RECORD.size
+        end = start + key_size + value_size
+        if end > len(self._records):
+            self._records = _map(self.records_file)
+        key = BINARY.decode(self._records[start:start + key_size])
+        return key, flags, start + key_size, end
+
+    def _read_value(self, offset):
+        key, flags, start, end = self._read_record(offset)
+        return codec_from_flags(flags).decode(self._records[start:end])
+
+    def _find(self, key):
+        """ Offset of the indexed record of key, None if not indexed """
+        if not self._index_count:
+            return None
+        raw = _encode_key(key)
+        wanted = key_hash(raw)
+        low, high = 0, self._index_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self._index_count:
+            entry_hash, offset = self._entry(low)
+            if entry_hash != wanted:
+                break
+            if self._read_record(offset)[0] == key:
+                return offset
+            low += 1
+        return None
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self._index,
+                                 INDEX_HEADER.size + position * ENTRY.size)
+
+    def _offset(self, key):
+        """ Offset of the current record of key, None if it has none """
+        if key in self._tail:
+            return self._tail[key]
+        return self._find(key)
+
+    def _current(self, key):
+        """ Unwritten value of key, _DELETED, or _MISSING if it has none """
+        if key in self._pending:
+            return self._pending[key]
+        return self._writing.get(key, _MISSING)
+
+    def __getitem__(self, key):
+        value = self._current(key)
+        if value is _DELETED:
+            raise KeyError(key)
+        if value is not _MISSING:
+            return value
+        offset = self._offset(key)
+        if offset is None:
+            raise KeyError(key)
+        return self._read_value(offset)
+
+    def __contains__(self, key):
+        value = self._current(key)
+        if value is not _MISSING:
+            return value is not _DELETED
+        return self._offset(key) is not None
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._count += 1
+        self._pending[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._count -= 1
+        self._pending[key] = _DELETED
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for key, _ in self._locations():
+            yield key
+
+    def items(self):
+        for key, location in self._locations():
+            if isinstance(location, tuple):
+                yield key, location[0]
+            else:
+                yield key, self._read_value(location)
+
+    def _locations(self):
+        """ Every live key with the offset of its record, or its unwritten
+        value in a tuple.
+        """
+        unwritten = dict(self._writing)
+        unwritten.update(self._pending)
+        for position in range(self._index_count):
+            offset = self._entry(position)[1]
+            key = self._read_record(offset)[0]
+            if key not in unwritten and key not in self._tail:
+                yield key, offset
+        for key, offset in list(self._tail.items()):
+            if key not in unwritten and offset is not None:
+                yield key, offset
+        for key, value in unwritten.items():
+            if value is not _DELETED:
+                yield key, (value,)
+
+    def copy(self):
+        return dict(self.items())
+
+    def frozen_items(self):
+        """ The items as they are now, read while iterating. Only the record
+        offsets are copied, the values are decoded from the current mapping
+        of the record file, which later writes and compactions leave alone.
+        """
+        locations = list(self._locations())
+        if self._records is None or len(self._records) < self._size:
+            self._records = _map(self.records_file) \
+                if os.path.exists(self.records_file) else None
+        return self._frozen(locations, self._records)
+
+    @staticmethod
+    def _frozen(locations, records):
+        for key, location in locations:
+            if isinstance(location, tuple):
+                yield key, location[0]
+                continue
+            key_size, value_size, flags = RECORD.unpack_from(records,
+                                                             location)
+            start = location + RECORD.size + key_size
+            yield key, codec_from_flags(flags).decode(
+                records[start:start + value_size])
+
+    def take_pending(self):
+        """ Hand the unwritten changes to write(). They stay readable until
+        they are written.
+        """
+        pending, self._pending = self._pending, {}
+        self._writing.update(pending)
+        return pending
+
+    def return_pending(self, changes):
+        """ Hand changes from take_pending() that could not be written back
+        to the next take_pending(), later changes of a key win.
+        """
+        changes = dict(changes)
+        changes.update(self._pending)
+        self._pending = changes
+
+    def write(self, changes, fsync=False):
+        """ Append records for changes, a dictionary from take_pending(),
+        returns the number of bytes written.
+        """
+        if not changes:
+            return 0
+        if self._token is None:
+            self._create()
+        out = bytearray()
+        offsets = {}
+        for key, value in changes.items():
+            raw_key = _encode_key(key)
+            if value is _DELETED:
+                raw_value, flags = b"", FLAG_DELETED
+                offsets[key] = None
+            else:
+                raw_value = self.codec.encode(value)
+                flags = self.codec.codec_id << CODEC_SHIFT
+                offsets[key] = self._size + len(out)
+            out += RECORD.pack(len(raw_key), len(raw_value), flags)
+            out += raw_key
+            out += raw_value
+        with open(self.records_file, "ab") as handle:
+            handle.write(out)
+            handle.flush()
+            if fsync:
+                os.fsync(handle.fileno())
+        self._size += len(out)
+        self._tail.update(offsets)
+        for key, value in changes.items():
+            if self._writing.get(key, _MISSING) is value:
+                del self._writing[key]
+        return len(out)
+
+    def _create(self):
+        """ Start an empty record file """
+        self._token = os.urandom(8)
+        with open(self.records_file, "wb") as handle:
+            handle.write(RECORDS_HEADER.pack(RECORDS_MAGIC, self._token))
+        self._size = self._indexed_end = RECORDS_HEADER.size
+
+    def rebuild(self, data, fsync=False):
+        """ Replace both files with the records and index of the dictionary
+        data, without any deleted or overwritten records.
+        """
+        token = os.urandom(8)
+        entries = []
+        temp_records = "{0}.{1}.tmp".format(self.records_file, os.getpid())
+        temp_index = "{0}.{1}.tmp".format(self.index_file, os.getpid())
+        with open(temp_records, "wb") as handle:
+            handle.write(RECORDS_HEADER.pack(RECORDS_MAGIC, token))
+            offset = RECORDS_HEADER.size
+            for key, value in data.items():
+                raw_key = _encode_key(key)
+                raw_value = self.codec.encode(value)
+                handle.write(RECORD.pack(len(raw_key), len(raw_value),
+                                         self.codec.codec_id << CODEC_SHIFT))
+                handle.write(raw_key)
+                handle.write(raw_value)
+                entries.append((key_hash(raw_key), offset))
+                offset += RECORD.size + len(raw_key) + len(raw_value)
+            if fsync:
+                handle.flush()
+                os.fsync(handle.fileno())
+        entries.sort()
+        with open(temp_index, "wb") as handle:
+            handle.write(INDEX_HEADER.pack(INDEX_MAGIC, token, len(entries),
+                                           offset))
+            for entry in entries:
+                handle.write(ENTRY.pack(*entry))
+            if fsync:
+                handle.flush()
+                os.fsync(handle.fileno())
+        _replace(temp_records, self.records_file)
+        _replace(temp_index, self.index_file)
+        self.open()
+
+    def compact(self, fsync=False):
+        """ Write every change and fold all records into a new index. """
+        self.rebuild(self.copy(), fsync)
+
+    def remove(self):
+        """ Delete both files """
+        for name in (self.records_file, self.index_file):
+            if os.path.exists(name):
+                os.unlink(name)
+        self.open()
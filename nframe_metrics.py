@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+Lightweight instrumentation for nframe. Counters and latency histograms are
+kept in memory, recording one costs a clock read and a lock, so they can be
+left on in production. Latencies are counted in buckets a quarter of a power
+of two wide, percentiles are reported as the upper bound of their bucket.
+"""
+
+__version__ = '0.1'
+
+import json
+import os
+import time
+from collections import defaultdict
+from functools import wraps
+from math import frexp
+from threading import Lock
+
+# Monotonic where available
+timer = getattr(time, "perf_counter", time.time)
+
+# Buckets per power of two, and powers of two of microseconds covered
+_SUB_BUCKETS = 4
+_POWERS = 32
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class Histogram(object):
+    """
+    Distribution of durations in seconds.
+    """
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (_POWERS * _SUB_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        mantissa, exponent = frexp(seconds * 1000000)
+        index = exponent * _SUB_BUCKETS + int((mantissa - 0.5) * 2 *
+                                              _SUB_BUCKETS)
+        self.buckets[min(max(index, 0), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """ Duration in seconds that fraction of the samples stay below """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index == len(self.buckets) - 1:
+                    # Everything too long for the other buckets
+                    return self.max
+                exponent, sub = divmod(index, _SUB_BUCKETS)
+                upper = 2.0 ** (exponent - 1) * (1 + (sub + 1.0) /
+                                                 _SUB_BUCKETS)
+                return min(upper / 1000000, self.max)
+        return 0.0
+
+    def summary(self):
+        """ Dictionary of count and milliseconds of p50, p99, mean and max """
+        return dict(count=self.count,
+                    p50=self.percentile(0.5) * 1000,
+                    p99=self.percentile(0.99) * 1000,
+                    mean=self.total * 1000 / self.count if self.count else 0,
+                    max=self.max * 1000)
+
+
+class Metrics(object):
+    """
+    Thread safe set of named counters and latency histograms.
+
+    With dump_file set, dump() writes a snapshot to it at most every
+    dump_interval seconds whenever dump_due() is asked. "{pid}" in the file
+    name is replaced with the id of the process, so forked workers do not
+    overwrite each other's dumps.
+    """
+    def __init__(self, dump_file=None, dump_interval=60.0):
+        self.dump_file = dump_file
+        self.dump_interval = dump_interval
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Drop everything recorded so far. """
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+            self.started = time.time()
+            self._next_dump = self.started + self.dump_interval
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        """ Add a duration to the histogram name """
+        with self._lock:
+            self.histograms[name].add(seconds)
+
+    def snapshot(self):
+        """
+        Everything recorded, as a dictionary:
+
+            {"uptime": 12.5,
+             "counters": {"bytes_in": 1024, "command.get": 10},
+             "latency": {"command.get": {"count": 10, "p50": 0.02,
+                                         "p99": 0.05, "mean": 0.02,
+                                         "max": 0.06}}}
+
+        Latencies are in milliseconds.
+        """
+        with self._lock:
+            return dict(uptime=time.time() - self.started,
+                        counters=dict(self.counters),
+                        latency=dict((name, histogram.summary())
+                                     for name, histogram in
+                                     self.histograms.items()))
+
+    def dump(self, filename=None):
+        """ Atomically write a snapshot as JSON to filename or dump_file """
+        filename = (filename or self.dump_file).format(pid=os.getpid())
+        temp_file = "{0}.{1}.tmp".format(filename, os.getpid())
+        with open(temp_file, "w") as handle:
+            json.dump(dict(self.snapshot(), pid=os.getpid(),
+                           time=time.time()), handle, sort_keys=True)
+        _replace(temp_file, filename)
+
+    def dump_due(self):
+        """ Dump if dump_file is set and dump_interval has passed. """
+        if not self.dump_file or time.time() < self._next_dump:
+            return
+        with self._lock:
+            if time.time() < self._next_dump:
+                return
+            self._next_dump = time.time() + self.dump_interval
+        try:
+            self.dump()
+        except (IOError, OSError):
+            # Metrics must never take the server down
+            pass
+
+
+def measured(name):
+    """ This decorator records how long a method takes in the histogram
+    name of the metrics attribute of its object, if that is set.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return func(self, *args, **kwargs)
+            started = timer()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(name, timer() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+Wire protocol shared by the nframe server and client.
+
+Every message is a single frame: a fixed size header followed by the payload.
+
+    +-------+---------+-------+----------------+---------+
+    | magic | version | flags | payload length | payload |
+    | 2 B   | 1 B     | 1 B   | 4 B (network)  | n B     |
+    +-------+---------+-------+----------------+---------+
+
+There is no handshake, a request is one frame out and one frame back.
+
+The top three bits of the flags name the codec of the payload, JSON unless
+client and server agreed on another one with the "hello" command. A server
+answers every request with the codec the request was sent with.
+
+Payloads above a size threshold may be compressed with zlib or lzma, which
+is flagged per frame. A request flags the compression it accepts for the
+response, requests themselves are only compressed once the server listed
+the method in its "hello" answer.
+"""
+
+__version__ = '0.1'
+
+import json
+import os
+import socket
+import struct
+import sys
+import time
+import zlib
+from functools import partial
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+PROTOCOL_VERSION = 1
+MAGIC = b"NF"
+HEADER = struct.Struct("!2sBBI")
+
+# Frame flags
+FLAG_ERROR = 0x01
+FLAG_ZLIB = 0x02
+FLAG_LZMA = 0x04
+FLAG_ACCEPT_ZLIB = 0x08
+FLAG_ACCEPT_LZMA = 0x10
+CODEC_SHIFT = 5
+CODEC_MASK = 0xE0
+
+# Compression methods available here, with the flag of a compressed payload
+# and the flag accepting it
+COMPRESSIONS = {"zlib": (FLAG_ZLIB, FLAG_ACCEPT_ZLIB)}
+if lzma:
+    COMPRESSIONS["lzma"] = (FLAG_LZMA, FLAG_ACCEPT_LZMA)
+
+# Smallest payload worth compressing
+COMPRESS_THRESHOLD = 16 * 1024
+
+_DECOMPRESS_ERRORS = (zlib.error, EOFError) + \
+    ((lzma.LZMAError,) if lzma else ())
+
+# Payloads at least this big are sent without copying them behind the header
+_COPY_LIMIT = 64 * 1024
+
+_bytes = partial(bytes, encoding='utf-8') if sys.version_info > (3,) else \
+    lambda x: str(x).encode('utf-8')
+
+# Monotonic where available, for timeouts
+_clock = getattr(time, "monotonic", time.time)
+
+
+class ProtocolError(Exception):
+    """ Custom error class for malformed or unsupported frames """
+    pass
+
+
+class ConnectionClosed(ProtocolError):
+    """ The peer closed the connection before a full frame was read """
+    pass
+
+
+class RemoteError(Exception):
+    """ The peer answered with an error frame """
+    pass
+
+
+class Codec(object):
+    """ Turns python objects into frame payloads and back. Every codec has
+    a name used during negotiation and an id from 0 to 7 carried in the
+    frame flags.
+    """
+    name = None
+    codec_id = None
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, payload):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    """ UTF-8 encoded JSON, the default """
+    name = "json"
+    codec_id = 0
+
+    def encode(self, data):
+        return _bytes(json.dumps(data))
+
+    def decode(self, payload):
+        return json.loads(bytes(payload).decode('utf-8'))
+
+
+class BinaryCodec(Codec):
+    """
+    Compact tagged binary encoding. Every value starts with a one byte type
+    tag, integers are zigzag varints, floats 8 byte doubles, strings and
+    bytes are prefixed with their length as varint. Lists that only hold
+    64 bit integers or only floats are packed as arrays, integers in the
+    narrowest width that fits them, which is where most of the gain over
+    JSON comes from. Unlike JSON it keeps bytes values and
+    non string dictionary keys.
+    """
+    name = "binary"
+    codec_id = 1
+
+    (NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT, INT_ARRAY,
+     FLOAT_ARRAY) = range(11)
+
+    _double = struct.Struct("<d")
+    _int_types = (int, long) if sys.version_info < (3,) else (int,)
+    _str_type = type(u"")
+
+    def encode(self, data):
+        out = bytearray()
+        self._encode(data, out)
+        return out
+
+    def decode(self, payload):
+        data = payload if isinstance(payload, bytearray) else \
+            bytearray(payload)
+        try:
+            value, pos = self._decode(data, 0)
+        except (IndexError, struct.error, UnicodeDecodeError) as err:
+            raise ValueError("Malformed binary payload: {0}".format(err))
+        if pos != len(data):
+            raise ValueError("Malformed binary payload: trailing data")
+        return value
+
+    @staticmethod
+    def _write_varint(out, value):
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def _read_varint(data, pos):
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result, pos
+            shift += 7
+
+    def _encode(self, value, out):
+        kind = type(value)
+        if value is None:
+            out.append(self.NONE)
+        elif kind is bool:
+            out.append(self.TRUE if value else self.FALSE)
+        elif kind in self._int_types:
+            out.append(self.INT)
+            self._write_varint(out, value << 1 if value >= 0
+                               else ((-value) << 1) - 1)
+        elif kind is float:
+            out.append(self.FLOAT)
+            out += self._double.pack(value)
+        elif kind is self._str_type:
+            raw = value.encode('utf-8')
+            out.append(self.STR)
+            self._write_varint(out, len(raw))
+            out += raw
+        elif kind in (bytes, bytearray):
+            out.append(self.BYTES)
+            self._write_varint(out, len(value))
+            out += value
+        elif kind in (list, tuple):
+            if len(value) > 1 and self._encode_array(value, out):
+                return
+            out.append(self.LIST)
+            self._write_varint(out, len(value))
+            for item in value:
+                self._encode(item, out)
+        elif isinstance(value, dict):
+            out.append(self.DICT)
+            self._write_varint(out, len(value))
+            for key, item in value.items():
+                self._encode(key, out)
+                self._encode(item, out)
+        else:
+            raise TypeError("Can not encode {0}".format(kind.__name__))
+
+    def _encode_array(self, value, out):
+        """ Pack lists of only integers or only floats in one go """
+        first = type(value[0])
+        if first in self._int_types and \
+                all(type(item) in self._int_types for item in value):
+            tag, code = self.INT_ARRAY, self._int_code(min(value), max(value))
+            if code is None:
+                return False
+        elif first is float and all(type(item) is float for item in value):
+            tag, code = self.FLOAT_ARRAY, "d"
+        else:
+            return False
+        out.append(tag)
+        self._write_varint(out, len(value))
+        if tag == self.INT_ARRAY:
+            out.append(ord(code))
+        out += struct.pack("<{0}{1}".format(len(value), code), *value)
+        return True
+
+    @staticmethod
+    def _int_code(low, high):
+        """ struct code of the narrowest signed integer holding both """
+        for code, bits in (("b", 7), ("h", 15), ("i", 31), ("q", 63)):
+            if -(1 << bits) <= low and high < 1 << bits:
+                return code
+        # Integers beyond 64 bit
+        return None
+
+    def _decode(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == self.STR:
+            size, pos = self._read_varint(data, pos)
+            return data[pos:pos + size].decode('utf-8'), pos + size
+        if tag == self.INT:
+            value, pos = self._read_varint(data, pos)
+            return (value >> 1) ^ -(value & 1), pos
+        if tag == self.DICT:
+            count, pos = self._read_varint(data, pos)
+            result = {}
+            for _ in range(count):
+                key, pos = self._decode(data, pos)
+                result[key], pos = self._decode(data, pos)
+            return result, pos
+        if tag == self.LIST:
+            count, pos = self._read_varint(data, pos)
+            result = []
+            for _ in range(count):
+                item, pos = self._decode(data, pos)
+                result.append(item)
+            return result, pos
+        if tag in (self.INT_ARRAY, self.FLOAT_ARRAY):
+            count, pos = self._read_varint(data, pos)
+            code = "d"
+            if tag == self.INT_ARRAY:
+                code = chr(data[pos])
+                pos += 1
+                if code not in "bhiq":
+                    raise ValueError("Unknown integer width {0}".format(code))
+            fmt = "<{0}{1}".format(count, code)
+            return (list(struct.unpack_from(fmt, data, pos)),
+                    pos + struct.calcsize(fmt))
+        if tag == self.FLOAT:
+            return self._double.unpack_from(data, pos)[0], pos + 8
+        if tag == self.NONE:
+            return None, pos
+        if tag == self.TRUE:
+            return True, pos
+        if tag == self.FALSE:
+            return False, pos
+        if tag == self.BYTES:
+            size, pos = self._read_varint(data, pos)
+            if pos + size > len(data):
+                raise IndexError("bytes value past the end")
+            return bytes(data[pos:pos + size]), pos + size
+        raise ValueError("Unknown type tag {0}".format(tag))
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+# Registered codecs by name and by id
+CODECS = {}
+_CODEC_IDS = {}
+
+
+def register_codec(codec):
+    """ Make a codec available for negotiation and decoding """
+    if not 0 <= codec.codec_id <= CODEC_MASK >> CODEC_SHIFT:
+        raise ValueError("Codec ids range from 0 to 7")
+    CODECS[codec.name] = codec
+    _CODEC_IDS[codec.codec_id] = codec
+
+
+register_codec(JSON)
+register_codec(BINARY)
+
+
+def get_codec(name):
+    """ Look up a registered codec by name """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ProtocolError("Unknown codec {0}".format(name))
+
+
+def codec_from_flags(flags):
+    """ The codec a frame was encoded with """
+    try:
+        return _CODEC_IDS[(flags & CODEC_MASK) >> CODEC_SHIFT]
+    except KeyError:
+        raise ProtocolError("Unknown codec id {0}".format(
+            (flags & CODEC_MASK) >> CODEC_SHIFT))
+
+
+def encode(data, codec=JSON):
+    """ Serialize a python object into a frame payload """
+    return codec.encode(data)
+
+
+def decode(payload, codec=JSON):
+    """ Deserialize a frame payload back into a python object """
+    return codec.decode(payload)
+
+
+def set_nodelay(sock):
+    """ Disable Nagle's algorithm, frames are always written in full """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.error, AttributeError):
+        # Not a TCP socket (unix socket, socketpair)
+        pass
+
+
+def recv_exactly(sock, size, timeout=None):
+    """ Read exactly size bytes from the socket into a preallocated buffer.
+
+    :param sock: Connected socket
+    :param size: Number of bytes to read
+    :param timeout: Seconds reading all of them may take, socket.timeout is
+        raised after that. The socket timeout is left at what remained.
+    :return: bytearray of length size
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    deadline = None if timeout is None else _clock() + timeout
+    while received < size:
+        if deadline is not None:
+            remaining = deadline - _clock()
+            if remaining <= 0:
+                raise socket.timeout("Timed out after {0} of {1} bytes"
+                                     .format(received, size))
+            sock.settimeout(remaining)
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionClosed("Connection closed after {0} of {1} bytes"
+                                   .format(received, size))
+        received += count
+    return buffer
+
+
+def pack_header(length, flags=0):
+    """ Build the header of a frame carrying length bytes of payload """
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, flags, length)
+
+
+def unpack_header(header, max_size=None):
+    """ Validate a frame header.
+
+    :param header: HEADER.size bytes read from the peer
+    :param max_size: Largest payload accepted, in bytes
+    :return: tuple of (flags, payload length)
+    """
+    magic, version, flags, length = HEADER.unpack(bytes(header))
+    if magic != MAGIC:
+        raise ProtocolError("Not an nframe frame")
+    if version > PROTOCOL_VERSION:
+        raise ProtocolError("Unsupported protocol version {0}, "
+                            "highest known is {1}".format(version,
+                                                          PROTOCOL_VERSION))
+    if max_size is not None and length > max_size:
+        raise ProtocolError("Frame of {0} bytes exceeds the limit of {1} "
+                            "bytes".format(length, max_size))
+    return flags, length
+
+
+def send_frame(sock, payload, flags=0):
+    """ Write a single frame to the socket.
+
+    :param sock: Connected socket
+    :param payload: Encoded bytes to send
+    :param flags: Frame flags
+    """
+    header = pack_header(len(payload), flags)
+    if len(payload) < _COPY_LIMIT:
+        sock.sendall(header + bytes(payload))
+    else:
+        sock.sendall(header)
+        sock.sendall(memoryview(payload))
+
+
+def recv_frame(sock, timeout=None):
+    """ Read a single frame from the socket.
+
+    :param sock: Connected socket
+    :param timeout: Seconds reading the frame may take
+    :return: tuple of (flags, payload)
+    """
+    started = _clock()
+    flags, length = unpack_header(recv_exactly(sock, HEADER.size, timeout))
+    if timeout is not None:
+        timeout = max(timeout - (_clock() - started), 0)
+    return flags, recv_exactly(sock, length, timeout)
+
+
+def send_file_frame(sock, handle, flags=0):
+    """ Write a frame whose payload is the whole file handle, opened in
+    binary mode. The kernel copies the file to the socket where sendfile
+    is available, the payload never passes through Python.
+
+    :return: Number of bytes sent, header included
+    """
+    size = os.fstat(handle.fileno()).st_size
+    sock.sendall(pack_header(size, flags))
+    if size and hasattr(sock, "sendfile"):
+        sock.sendfile(handle, 0, size)
+    else:
+        # Python 2
+        handle.seek(0)
+        remaining = size
+        while remaining:
+            chunk = handle.read(min(remaining, _COPY_LIMIT))
+            if not chunk:
+                raise ProtocolError("File shrank while it was sent")
+            sock.sendall(chunk)
+            remaining -= len(chunk)
+    return HEADER.size + size
+
+
+def recv_frame_into(sock, handle):
+    """ Read a single frame and write its payload to the file handle as it
+    arrives, instead of holding it in memory. An error frame raises
+    RemoteError.
+
+    :return: tuple of (flags, payload length)
+    """
+    flags, length = unpack_header(recv_exactly(sock, HEADER.size))
+    if flags & FLAG_ERROR:
+        decode_message(flags, recv_exactly(sock, length))
+    buffer = bytearray(min(length, _COPY_LIMIT) or 1)
+    view = memoryview(buffer)
+    remaining = length
+    while remaining:
+        count = sock.recv_into(view, min(remaining, len(buffer)))
+        if not count:
+            raise ConnectionClosed("Connection closed after {0} of {1} "
+                                   "bytes".format(length - remaining, length))
+        handle.write(view[:count])
+        remaining -= count
+    return flags, length
+
+
+def compress(payload, method):
+    """ Compress a payload, returns it with the flag marking the method """
+    if method == "lzma":
+        return lzma.compress(bytes(payload)), FLAG_LZMA
+    return zlib.compress(bytes(payload), 1), FLAG_ZLIB
+
+
+def decompress(flags, payload, max_size=None):
+    """ Undo the compression named in the frame flags, if any. A payload
+    that would grow beyond max_size bytes raises ProtocolError, before
+    more than that is decompressed.
+    """
+    limit = 0 if max_size is None else max_size + 1
+    try:
+        if flags & FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(bytes(payload), limit)
+            if not limit:
+                data += decompressor.flush()
+        elif flags & FLAG_LZMA:
+            if not lzma:
+                raise ProtocolError("lzma is not available")
+            data = lzma.LZMADecompressor().decompress(bytes(payload),
+                                                      limit or -1)
+        else:
+            return payload
+    except _DECOMPRESS_ERRORS as err:
+        raise ProtocolError("Could not decompress payload: {0}".format(err))
+    if max_size is not None and len(data) > max_size:
+        raise ProtocolError("Payload exceeds the limit of {0} bytes once "
+                            "decompressed".format(max_size))
+    return data
+
+
+def accept_flags(method):
+    """ Flags asking the peer to compress its answer with method """
+    return COMPRESSIONS[method][1] if method else 0
+
+
+def accepted_compression(flags):
+    """ The compression a request accepts for its answer, None for none """
+    for method in ("zlib", "lzma"):
+        if method in COMPRESSIONS and flags & COMPRESSIONS[method][1]:
+            return method
+    return None
+
+
+def send_message(sock, data, flags=0, codec=JSON, compression=None,
+                 threshold=COMPRESS_THRESHOLD):
+    """ Encode and send a python object as one frame.
+
+    :param compression: "zlib" or "lzma" to compress payloads of at least
+        threshold bytes
+    :return: Number of bytes sent
+    """
+    payload = codec.encode(data)
+    if compression and threshold is not None and len(payload) >= threshold:
+        payload, compressed = compress(payload, compression)
+        flags |= compressed
+    send_frame(sock, payload, flags | codec.codec_id << CODEC_SHIFT)
+    return HEADER.size + len(payload)
+
+
+def send_error(sock, message):
+    """ Report an error to the peer """
+    send_frame(sock, encode(str(message)), FLAG_ERROR)
+
+
+def decode_frame(flags, payload, max_size=None):
+    """ Decode a received frame with the codec named in its flags.
+
+    :param max_size: Largest payload accepted once decompressed
+    :return: tuple of (data, codec)
+    """
+    codec = codec_from_flags(flags)
+    return codec.decode(decompress(flags, payload, max_size)), codec
+
+
+def decode_message(flags, payload):
+    """ Decode a received frame, raising RemoteError if the peer answered
+    with an error frame.
+    """
+    data = decode_frame(flags, payload)[0]
+    if flags & FLAG_ERROR:
+        raise RemoteError(data)
+    return data
+
+
+def recv_message(sock, timeout=None):
+    """ Receive one frame and decode it, raising RemoteError if the peer
+    answered with an error frame.
+
+    :param timeout: Seconds receiving the frame may take
+    """
+    return decode_message(*recv_frame(sock, timeout))
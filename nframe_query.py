@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+Server side queries for nframe. Keys are kept in a sorted list, so a prefix
+or range scan costs a binary search plus the keys it walks. Secondary
+indexes on named fields of the values answer equality and range conditions
+with the keys that match, instead of every key.
+
+Conditions compare numbers with numbers and strings with strings, a value
+of another type only ever equals a value of the same type. Values of
+indexed fields that are neither numbers nor strings are not indexed,
+conditions on them are checked against every key scanned.
+"""
+
+__version__ = '0.1'
+
+from bisect import bisect_left, bisect_right, insort
+
+_str_type = type(u"")
+_string_types = (str, _str_type)
+
+# Above this many changes at once, sorting beats inserting one by one
+_SORT_THRESHOLD = 8
+
+OPERATORS = ("==", "!=", "<", "<=", ">", ">=", "in", "prefix", "exists")
+
+# Operators a field index can answer
+_INDEXED = ("==", "in", "<", "<=", ">", ">=", "prefix")
+
+_missing = object()
+
+
+class QueryError(ValueError):
+    """ Raised for queries that can not be run """
+    pass
+
+
+class _Top(object):
+    """ Compares greater than any key, bounds index entries of a value """
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+_TOP = _Top()
+
+
+def _rank(value):
+    """ 0 for numbers, 1 for strings, None for values not ordered """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, _string_types):
+        return 1
+    return None
+
+
+def _equal(first, second):
+    rank = _rank(first)
+    if rank is None:
+        return type(first) is type(second) and first == second
+    return rank == _rank(second) and first == second
+
+
+def lookup(value, path):
+    """ The field at path, a list of names, of value, _missing if absent """
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return _missing
+        value = value[name]
+    return value
+
+
+def compare(found, operator, operand):
+    """ Whether the field value found meets the condition """
+    if operator == "exists":
+        return (found is not _missing) == bool(operand)
+    if found is _missing:
+        return operator == "!="
+    if operator == "==":
+        return _equal(found, operand)
+    if operator == "!=":
+        return not _equal(found, operand)
+    if operator == "in":
+        return any(_equal(found, item) for item in operand)
+    if operator == "prefix":
+        return _rank(found) == 1 and found.startswith(operand)
+    rank = _rank(found)
+    if rank is None or rank != _rank(operand):
+        return False
+    if operator == "<":
+        return found < operand
+    if operator == "<=":
+        return found <= operand
+    if operator == ">":
+        return found > operand
+    return found >= operand
+
+
+class KeyIndex(object):
+    """
+    Sorted list of keys.
+    """
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+
+    def add(self, keys):
+        """ Add keys not in the index yet """
+        if len(keys) > _SORT_THRESHOLD:
+            self.keys.extend(keys)
+            self.keys.sort()
+            return
+        for key in keys:
+            insort(self.keys, key)
+
+    def remove(self, keys):
+        """ Remove keys in the index """
+        if len(keys) > _SORT_THRESHOLD:
+            removed = set(keys)
+            self.keys = [key for key in self.keys if key not in removed]
+            return
+        for key in keys:
+            index = bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                del self.keys[index]
+
+    def scan(self, start=None, stop=None, after=None, prefix=None):
+        """ Keys in order from start, or after the key after, up to but not
+        including stop, that start with prefix
+        """
+        keys = self.keys
+        position = 0
+        if start is not None:
+            position = bisect_left(keys, start)
+        if prefix:
+            position = max(position, bisect_left(keys, prefix))
+        if after is not None:
+            position = max(position, bisect_right(keys, after))
+        for index in range(position, len(keys)):
+            key = keys[index]
+            if stop is not None and key >= stop or \
+                    prefix and not key.startswith(prefix):
+                return
+            yield key
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class FieldIndex(object):
+    """
+    Keys ordered by the value of one field of their values, "a.b" names
+    field b of field a. Keys whose value lacks the field, or holds neither
+    a number nor a string in it, are left out.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.path = field.split(".")
+        self.entries = []
+
+    def _entry(self, key, value):
+        found = lookup(value, self.path)
+        rank = None if found is _missing else _rank(found)
+        if rank is None:
+            return None
+        return rank, found, key
+
+    def build(self, items):
+        """ Index every (key, value) pair of items """
+        self.entries = sorted(entry for entry in
+                              (self._entry(key, value)
+                               for key, value in items)
+                              if entry is not None)
+
+    def add(self, key, value):
+        entry = self._entry(key, value)
+        if entry is not None:
+            insort(self.entries, entry)
+
+    def remove(self, key, value):
+        entry = self._entry(key, value)
+        if entry is None:
+            return
+        index = bisect_left(self.entries, entry)
+        if index < len(self.entries) and self.entries[index] == entry:
+            del self.entries[index]
+
+    def find(self, operator, operand):
+        """ Keys whose field meets the condition, None if the index can not
+        answer it
+        """
+        if operator == "in":
+            keys = []
+            for item in operand:
+                found = self.find("==", item)
+                if found is None:
+                    return None
+                keys.extend(found)
+            return keys
+        rank = _rank(operand)
+        if operator not in _INDEXED or rank is None or \
+                operator == "prefix" and rank != 1:
+            return None
+        entries = self.entries
+        low = bisect_left(entries, (rank,))
+        high = bisect_left(entries, (rank + 1,))
+        if operator in ("==", ">=", "prefix"):
+            low = bisect_left(entries, (rank, operand), low, high)
+        elif operator == ">":
+            low = bisect_left(entries, (rank, operand, _TOP), low, high)
+        if operator in ("==", "<="):
+            high = bisect_left(entries, (rank, operand, _TOP), low, high)
+        elif operator == "<":
+            high = bisect_left(entries, (rank, operand), low, high)
+        keys = []
+        for index in range(low, high):
+            entry = entries[index]
+            if operator == "prefix" and not entry[1].startswith(operand):
+                break
+            keys.append(entry[2])
+        return keys
+
+
+class Query(object):
+    """
+    Validated query, from a dictionary of:
+
+        prefix      only keys starting with it
+        start       only keys from this one on
+        stop        only keys before this one
+        after       only keys after this one, the cursor of the last page
+        where       list of [field, operator, operand] conditions the value
+                    has to meet, see OPERATORS
+        limit       the most items returned, all of them if not given
+        keys_only   return the keys without their values
+
+    Matches are returned in key order. A query answered with limit items
+    carries the last key as cursor, send it as after to get the next page.
+    """
+    def __init__(self, data):
+        data = data or {}
+        if not isinstance(data, dict):
+            raise QueryError("Expected a dictionary describing the query")
+        unknown = set(data) - set(["prefix", "start", "stop", "after",
+                                   "where", "limit", "keys_only"])
+        if unknown:
+            raise QueryError("Unknown query options {0}".format(
+                ", ".join(sorted(unknown))))
+        for name in ("prefix", "start", "stop", "after"):
+            if data.get(name) is not None and \
+                    not isinstance(data[name], _string_types):
+                raise QueryError("{0} must be a key".format(name))
+        self.prefix = data.get("prefix") or None
+        self.start = data.get("start")
+        self.stop = data.get("stop")
+        self.after = data.get("after")
+        self.limit = data.get("limit")
+        if self.limit is not None and (isinstance(self.limit, bool) or
+                                       not isinstance(self.limit, int) or
+                                       self.limit < 1):
+            raise QueryError("limit must be a positive number")
+        self.keys_only = bool(data.get("keys_only"))
+        self.where = []
+        for condition in data.get("where") or []:
+            if not isinstance(condition, list) or len(condition) != 3:
+                raise QueryError("Conditions must be [field, operator, "
+                                 "operand]")
+            field, operator, operand = condition
+            if not isinstance(field, _string_types) or not field:
+                raise QueryError("Condition fields must be names")
+            if operator not in OPERATORS:
+                raise QueryError("Unknown operator {0}, pick from {1}".format(
+                    operator, ", ".join(OPERATORS)))
+            if operator == "in" and not isinstance(operand, list):
+                raise QueryError("in needs a list of values")
+            if operator == "prefix" and \
+                    not isinstance(operand, _string_types):
+                raise QueryError("prefix needs a string")
+            self.where.append((field, field.split("."), operator, operand))
+
+    def _in_range(self, key):
+        return (self.start is None or key >= self.start) and \
+            (self.stop is None or key < self.stop) and \
+            (self.after is None or key > self.after) and \
+            (not self.prefix or key.startswith(self.prefix))
+
+    def matches(self, value):
+        """ Whether value meets every condition """
+        return all(compare(lookup(value, path), operator, operand)
+                   for _, path, operator, operand in self.where)
+
+    def _candidates(self, keys, fields):
+        """ Keys to check in order: those found by the most selective
+        indexed condition, or a scan of the key range
+        """
+        best = None
+        for field, _, operator, operand in self.where:
+            if field not in fields:
+                continue
+            found = fields[field].find(operator, operand)
+            if found is not None and (best is None or len(found) < len(best)):
+                best = found
+        if best is None:
+            return keys.scan(self.start, self.stop, self.after, self.prefix)
+        return sorted(key for key in set(best) if self._in_range(key))
+
+    def run(self, data, keys, fields):
+        """
+        Run the query against the dictionary data, with keys the KeyIndex
+        of it and fields a dictionary of field name: FieldIndex.
+
+        :return: dictionary of items, a list of [key, value] (or keys with
+            keys_only), and cursor, None once there are no more pages
+        """
+        items = []
+        for key in self._candidates(keys, fields):
+            value = data[key]
+            if not self.matches(value):
+                continue
+            items.append(key if self.keys_only else [key, value])
+            if len(items) == self.limit:
+                return dict(items=items, cursor=key)
+        return dict(items=items, cursor=None)
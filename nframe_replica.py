@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Copyright (c) 2014 Chris Griffith - MIT License
+
+Read replicas for nframe. A replica loads a snapshot of the data of a
+primary server, then follows the primary's changes through a watch and
+answers reads from its own copy. Writes are forwarded to the primary and
+answered once their change arrived on the replica, usually within
+milliseconds, so the next read from the same replica sees them. Replicas
+can be watched and replicated in turn.
+"""
+
+__version__ = '0.1'
+
+import socket
+import threading
+from time import time
+
+from nframe_client import Client, COMMUNICATION_ERROR
+from nframe_protocol import (recv_message, set_nodelay, ConnectionClosed,
+                             ProtocolError, RemoteError)
+from nframe_server import Store, CommandError, ServerError
+
+
+class Replica(Store):
+    """
+    Store holding a copy of the data of the primary server at the address
+    primary, a (host, port) tuple. A thread keeps the copy up to date,
+    reconnecting every reconnect_delay seconds while the primary can not
+    be reached and when it sent nothing, not even a heartbeat, for
+    watch_timeout seconds. Reads fail until the first snapshot is loaded,
+    see wait_synced. With wait_for_writes=False forwarded writes are
+    answered as soon as the primary ran them.
+
+    The primary must run in thread or async mode, a primary in fork mode
+    works but every change made by another worker than the one watched
+    costs a full snapshot. A replica can not run in fork mode itself, run
+    more replicas instead.
+
+    Expiry times arrive with the changes, keys loaded from a snapshot are
+    kept until the primary deletes them. Requests to the primary use the
+    codec the data is stored in, JSON by default.
+    """
+    # Commands answered from the local copy, everything else is forwarded
+    read_commands = ("get data", "get", "exists", "keys", "count", "query",
+                     "hello", "stats")
+
+    def __init__(self, primary, data_file, reconnect_delay=1.0,
+                 watch_timeout=10.0, wait_for_writes=True, **kwargs):
+        if kwargs.get('shared'):
+            raise ServerError("A replica can not be shared between "
+                              "processes, run more replicas instead")
+        if kwargs.get('max_keys') or kwargs.get('max_memory'):
+            raise ServerError("A replica can not evict keys, set the limits "
+                              "on the primary")
+        self.primary = tuple(primary)
+        self.reconnect_delay = reconnect_delay
+        self.watch_timeout = watch_timeout
+        self.wait_for_writes = wait_for_writes
+        self.client = Client(self.primary[0], self.primary[1],
+                             persistent=True,
+                             codec=kwargs.get('codec', "json"))
+        self.synced = threading.Event()
+        self.primary_version = None
+        self.error = None
+        self._primary_instance = None
+        self._watch_socket = None
+        self._applied = threading.Condition(threading.Lock())
+        super(Replica, self).__init__(data_file, **kwargs)
+        self._follower = threading.Thread(target=self._follow,
+                                          name="nframe-replica")
+        self._follower.daemon = True
+        self._follower.start()
+
+    def wait_synced(self, timeout=None):
+        """
+        wait_synced(timeout)
+        Wait up to timeout seconds for the first snapshot of the primary,
+        returns whether it was loaded.
+        """
+        return self.synced.wait(timeout)
+
+    def execute(self, incoming, received=None):
+        if not self._reads(incoming):
+            return self._forward(incoming)
+        if not self.synced.is_set():
+            raise CommandError("Replica has not loaded the data of "
+                               "{0}:{1} yet".format(*self.primary))
+        return super(Replica, self).execute(incoming, received)
+
+    def _reads(self, incoming):
+        """ Whether a request only reads, invalid requests are left to
+        Store.execute to report
+        """
+        try:
+            command, data = incoming['command'], incoming['data']
+        except (KeyError, TypeError):
+            return True
+        if command == "batch" and isinstance(data, list):
+            return all(self._reads(request) for request in data)
+        return command in self.read_commands
+
+    def _forward(self, incoming):
+        """ Run a request on the primary, returns its response. With
+        wait_for_writes the request is sent in a batch ending with a hello,
+        which tells the version of the primary after the request, and the
+        response is held back until that version was applied here.
+        """
+        command, data = incoming['command'], incoming['data']
+        fields = dict((key, value) for key, value in incoming.items()
+                      if key not in ("command", "data"))
+        if not self.wait_for_writes or \
+                command == "batch" and not isinstance(data, list):
+            return self._on_primary(command, data, fields)
+        hello = dict(command="hello", data={})
+        if command == "batch":
+            response = self._on_primary(command, data + [hello], fields)
+            if len(response['results']) > len(data):
+                self._wait_applied(response['results'].pop())
+            return response
+        response = self._on_primary("batch", [dict(incoming), hello], {})
+        if response['error']:
+            raise CommandError(response['error']['message'])
+        self._wait_applied(response['results'][1])
+        return response['results'][0]
+
+    def _on_primary(self, command, data, fields):
+        try:
+            response = self.client._communicate(command, data, **fields)
+        except RemoteError as err:
+            raise CommandError(str(err))
+        except (socket.error, ConnectionClosed, ProtocolError) as err:
+            raise CommandError("Could not forward to {0}:{1}: {2}".format(
+                self.primary[0], self.primary[1], err))
+        if response == COMMUNICATION_ERROR:
+            raise CommandError("Could not forward to {0}:{1}".format(
+                *self.primary))
+        return response
+
+    def _wait_applied(self, hello):
+        """ Wait until the changes up to the version in the hello answer of
+        the primary were applied, at most watch_timeout seconds.
+        """
+        version = hello.get('version')
+        if version is None or hello.get('instance') != self._primary_instance:
+            return
+        deadline = time() + self.watch_timeout
+        with self._applied:
+            while self.primary_version is None or \
+                    self.primary_version < version:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return
+                self._applied.wait(remaining)
+
+    def _follow(self):
+        """ Keep following the primary until the store is closed """
+        while not self._stopped.is_set():
+            try:
+                self._stream()
+            except (socket.error, ConnectionClosed, ProtocolError,
+                    RemoteError, CommandError, KeyError, TypeError) as err:
+                self.error = "{0}: {1}".format(type(err).__name__, err)
+            self._stopped.wait(self.reconnect_delay)
+
+    def _stream(self):
+        """ Watch the primary and apply its changes, resuming after the
+        last change applied if the primary is still the same instance,
+        otherwise starting over from a snapshot.
+        """
+        sock = socket.create_connection(self.primary, self.watch_timeout)
+        set_nodelay(sock)
+        self._watch_socket = sock
+        try:
+            hello = self.client._send(dict(command="hello",
+                                           data=dict(codecs=[])), sock)
+            since = None
+            if hello.get('instance') == self._primary_instance and \
+                    self.primary_version is not None:
+                since = "{0}:{1}".format(self._primary_instance,
+                                         self.primary_version)
+            frame = self.client._send(dict(command="watch",
+                                           data=dict(since=since)), sock)
+            if since is None:
+                self._load_snapshot(frame['instance'])
+            while True:
+                self._apply_events(frame['events'], frame['instance'])
+                with self._applied:
+                    self.primary_version = frame['version']
+                    self._applied.notify_all()
+                self.error = None
+                frame = recv_message(sock)
+        finally:
+            self._watch_socket = None
+            sock.close()
+
+    def _load_snapshot(self, instance):
+        """ Replace the copy with the data the primary holds now. Only the
+        keys that differ are changed.
+        """
+        snapshot = self.client.get_data()
+        if not isinstance(snapshot, dict):
+            raise CommandError("Could not load the data of {0}:{1}".format(
+                *self.primary))
+        with self._access():
+            self._delete([key for key in self.data if key not in snapshot])
+            self._update(snapshot)
+        self._primary_instance = instance
+        self._flush_due()
+        self.synced.set()
+
+    def _apply_events(self, events, instance):
+        """ Apply change events of the primary instance, a reset loads a
+        new snapshot. Events the snapshot already holds change nothing.
+        """
+        for event in events:
+            if event['op'] == "reset":
+                self._load_snapshot(instance)
+                continue
+            with self._access():
+                if event['op'] == "update":
+                    self._update(event['data'], event.get('expires'))
+                elif event['op'] == "delete":
+                    self._delete([key for key in event['keys']
+                                  if key in self.data])
+        self._flush_due()
+
+    def _flush_due(self):
+        if self.flush_every and self.pending >= self.flush_every:
+            self.flush()
+
+    def _stats(self, data, incoming):
+        stats = super(Replica, self)._stats(data, incoming)
+        stats['replica'] = dict(primary="{0}:{1}".format(*self.primary),
+                                primary_version=self.primary_version,
+                                synced=self.synced.is_set(),
+                                error=self.error)
+        return stats
+
+    def close(self):
+        """
+        close()
+        Stop following the primary and write everything still pending.
+        """
+        self._stopped.set()
+        sock = self._watch_socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._follower.join()
+        self.client.close()
+        super(Replica, self).close()
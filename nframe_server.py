@@ -6,20 +6,54 @@ Copyright (c) 2014 Chris Griffith - MIT License
 
 __version__ = '0.1'
 
-from time import sleep
+from time import sleep, time
+import errno
 import json
-from math import ceil
 import os
+import shutil
 import signal
+import socket
+import struct
 import tempfile
 import sys
+import threading
+import zlib
+from binascii import hexlify
+from collections import deque, OrderedDict
+from heapq import heapify, heappop, heappush
 from functools import partial, wraps
+from contextlib import contextmanager
+from itertools import islice
 from distutils.version import LooseVersion
 
 try:
-    from socketserver import BaseRequestHandler, TCPServer
+    from collections.abc import MutableMapping
 except ImportError:
-    from SocketServer import BaseRequestHandler, TCPServer
+    from collections import MutableMapping
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+BaseRequestHandler = socketserver.BaseRequestHandler
+ThreadingMixIn = socketserver.ThreadingMixIn
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, locking is then limited to one process
+    fcntl = None
+
+from nframe_protocol import (recv_exactly, unpack_header, decode_frame,
+                             send_message, send_error, set_nodelay,
+                             send_file_frame,
+                             accepted_compression, ProtocolError,
+                             ConnectionClosed, CODECS, COMPRESSIONS,
+                             COMPRESS_THRESHOLD, PROTOCOL_VERSION, HEADER,
+                             CODEC_SHIFT, JSON, BINARY)
+from nframe_indexed import IndexedData
+from nframe_metrics import Metrics, measured, timer
+from nframe_query import KeyIndex, FieldIndex, Query, QueryError
 
 
 class LockError(Exception):
@@ -31,21 +65,51 @@ class ServerError(Exception):
     """ Custom error class for errors occurring within the Server class """
     pass
 
+
+class CommandError(ServerError):
+    """ Raised for requests the server can not run, reported to the client """
+    pass
+
 _bytes = partial(bytes, encoding='utf-8') if sys.version_info > (3,) else \
     lambda x: str(x).encode('utf-8')
+_str_type = type(u"")
+_string_types = (str, _str_type)
+
+# Atomic rename over an existing file, os.rename only does that on POSIX
+_replace = getattr(os, 'replace', os.rename)
+
+# Length prefix of binary log records, and the first byte of a binary
+# snapshot (the tag of its top level dictionary)
+_RECORD_SIZE = struct.Struct("<I")
+_BINARY_SNAPSHOT = bytes(bytearray([BINARY.DICT]))
+
+ENGINES = ("json", "indexed")
 
 LOCK_FILE = os.path.join(tempfile.gettempdir(), "nframe.pid")
 DATA_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                          "data.json")
 
+# Largest request accepted, and seconds a request may take to arrive or a
+# response to be sent
+MAX_REQUEST_SIZE = 64 * 1024 ** 2
+REQUEST_TIMEOUT = 10.0
+
+# Sent to connections turned away because the server is at capacity
+BUSY_MESSAGE = "Server busy, try again later"
+
 
 class Lock(object):
     """
     Simply PID based file lock context manager. Can cleanup on SIGTERM.
+    The time spent waiting for the lock is recorded in metrics, if given.
+
+    Waits are retried once a second and the lock stays taken if its holder
+    dies, nframe itself uses FileLock instead.
     """
     def __init__(self, pid_file=LOCK_FILE, timeout=0,
-                 safe=False, cleanup_on_term=False):
+                 safe=False, cleanup_on_term=False, metrics=None):
         self.pid_file = pid_file
+        self.metrics = metrics
         self.pid = os.getpid()
         self.timeout = timeout
         self.cleanup = cleanup_on_term
@@ -71,20 +135,28 @@ class Lock(object):
         """
         If the file is not currently in use set the lock
         """
+        started = timer()
         while self.timeout >= 0:
             try:
-                if os.path.exists(self.pid_file):
+                try:
+                    handle = os.open(self.pid_file,
+                                     os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                     0o0444)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
                     self.check_lock()
                 else:
-                    with open(self.pid_file, "wb") as pid_data:
+                    with os.fdopen(handle, "wb") as pid_data:
                         pid_data.write(_bytes(str("{0}\n".format(self.pid))))
-                    os.chmod(self.pid_file, 0o0444)
                 break
             except LockError:
                 self.timeout -= 1
                 sleep(1)
         else:
             raise LockError()
+        if self.metrics is not None:
+            self.metrics.observe("pid_lock_wait", timer() - started)
 
     def release(self):
         """
@@ -134,57 +206,1048 @@ by process {0}".format(str(pid)))
         return False
             
 
+class FileLock(object):
+    """
+    Lock between processes, held with flock on an open descriptor of
+    lock_file. The kernel releases it as soon as the holder exits or dies,
+    and hands it to a blocked waiter right away.
+
+    exclusive=False takes a shared lock, which any number of readers hold
+    at once but never together with an exclusive one. timeout is None to
+    wait as long as it takes, or the seconds, fractions allowed, to wait
+    before LockError is raised. Waits with a timeout retry at most a
+    millisecond apart. The time spent waiting is recorded in metrics, if
+    given.
+
+    The lock file only exists while the lock is held. Without fcntl, on
+    Windows, the lock is taken by creating the file, it is then always
+    exclusive and left behind if its holder dies.
+    """
+    def __init__(self, lock_file=LOCK_FILE, timeout=None, exclusive=True,
+                 metrics=None):
+        self.lock_file = lock_file
+        self.timeout = timeout
+        self.exclusive = exclusive
+        self.metrics = metrics
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    #noinspection PyUnusedLocal
+    def __exit__(self, exctype, value, tb):
+        self.release()
+
+    @property
+    def locked(self):
+        """ Whether this object holds the lock """
+        return self._fd is not None
+
+    def acquire(self):
+        """
+        acquire()
+        Take the lock, waiting for up to timeout seconds.
+        """
+        if self._fd is not None:
+            raise LockError("{0} is already held".format(self.lock_file))
+        started = timer()
+        deadline = None if self.timeout is None else started + self.timeout
+        blocking = deadline is None and fcntl is not None
+        delay = 0.00005
+        while True:
+            self._fd = self._try_lock(blocking)
+            if self._fd is not None:
+                break
+            if blocking:
+                # The file was replaced while waiting, lock the new one
+                continue
+            now = timer()
+            if deadline is not None and now >= deadline:
+                raise LockError("{0} is locked by another process".format(
+                    self.lock_file))
+            sleep(delay if deadline is None else min(delay, deadline - now))
+            delay = min(delay * 2, 0.001)
+        if self.metrics is not None:
+            self.metrics.observe("pid_lock_wait", timer() - started)
+
+    def _try_lock(self, blocking):
+        """ One attempt at taking the lock, returns the descriptor holding
+        it or None
+        """
+        if not fcntl:
+            try:
+                fd = os.open(self.lock_file,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o0644)
+            except OSError as err:
+                if err.errno == errno.EEXIST:
+                    return None
+                raise LockError("Could not lock {0}: {1}".format(
+                    self.lock_file, err))
+            os.write(fd, _bytes("{0}\n".format(os.getpid())))
+            return fd
+        try:
+            fd = os.open(self.lock_file, os.O_RDONLY | os.O_CREAT, 0o0644)
+        except OSError as err:
+            raise LockError("Could not open {0}: {1}".format(self.lock_file,
+                                                             err))
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(fd, mode if blocking else mode | fcntl.LOCK_NB)
+        except (IOError, OSError) as err:
+            os.close(fd)
+            if err.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return None
+            raise LockError("Could not lock {0}: {1}".format(self.lock_file,
+                                                             err))
+        if not self._current(fd):
+            # Removed by its last holder while this one waited for it
+            os.close(fd)
+            return None
+        return fd
+
+    def _current(self, fd):
+        """ Whether fd is open on the file lock_file names now """
+        try:
+            opened, named = os.fstat(fd), os.stat(self.lock_file)
+        except OSError:
+            return False
+        return (opened.st_dev, opened.st_ino) == (named.st_dev, named.st_ino)
+
+    def release(self):
+        """
+        release()
+        Give up the lock, removing the lock file if no one else holds it.
+        """
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if fcntl:
+                # Only succeeds for the last holder
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if self._current(fd):
+                os.unlink(self.lock_file)
+        except (IOError, OSError):
+            pass
+        os.close(fd)
+
+
+class StateLock(object):
+    """
+    Reentrant lock guarding a data file against concurrent load/modify/save
+    cycles, both between threads and between processes. Threads are
+    serialized with an RLock, processes with an flock on a sidecar file.
+    Use StateLock.for_file so all users of a file in a process share one lock.
+    """
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, data_file):
+        self.lock_file = "{0}.lock".format(data_file)
+        self._pid = None
+        self._fd = None
+        self._depth = 0
+        self._rlock = threading.RLock()
+
+    @classmethod
+    def for_file(cls, data_file):
+        """ Return the lock shared by everything in this process using
+        data_file.
+        """
+        data_file = os.path.abspath(data_file)
+        with cls._registry_lock:
+            if data_file not in cls._registry:
+                cls._registry[data_file] = cls(data_file)
+            return cls._registry[data_file]
+
+    def _after_fork(self):
+        """ A forked child shares the parent's open file description, and
+        with it the flock, so it needs its own descriptor and thread lock.
+        """
+        self._pid = os.getpid()
+        self._fd = None
+        self._depth = 0
+        self._rlock = threading.RLock()
+
+    def __enter__(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        self._rlock.acquire()
+        self._depth += 1
+        if self._depth == 1 and fcntl:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.lock_file,
+                                       os.O_RDWR | os.O_CREAT, 0o0644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except (OSError, IOError):
+                self._depth -= 1
+                self._rlock.release()
+                raise ServerError("Could not lock {0}".format(self.lock_file))
+        return self
+
+    #noinspection PyUnusedLocal
+    def __exit__(self, exctype, value, tb):
+        self._depth -= 1
+        if self._depth == 0 and fcntl and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._rlock.release()
+
+
+def _stat_signature(name):
+    """ Inode, size and modification time of a file, None if it is missing
+    """
+    try:
+        stat = os.stat(name)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class _PartLocks(object):
+    """
+    In-process locks of a sharded store, one per shard. Entered as a
+    context manager it holds all of them, after taking the lock of the
+    whole store, so that can not deadlock with another thread holding
+    all of them.
+    """
+    def __init__(self, count):
+        self.whole = threading.RLock()
+        self.parts = [threading.RLock() for _ in range(count)]
+
+    def __enter__(self):
+        self.whole.acquire()
+        for lock in self.parts:
+            lock.acquire()
+        return self
+
+    #noinspection PyUnusedLocal
+    def __exit__(self, exctype, value, tb):
+        for lock in reversed(self.parts):
+            lock.release()
+        self.whole.release()
+
+
+def _value_type(value):
+    """ Type of a value when telling whether it changed, str and unicode
+    are the same on Python 2
+    """
+    return _str_type if isinstance(value, _string_types) else type(value)
+
+
+def _indexable(key):
+    """ Whether key is kept in the key and field indexes. The binary codec
+    allows keys other than strings, these can not be sorted among them and
+    are left out.
+    """
+    return isinstance(key, _string_types)
+
+
+@contextmanager
+def _holding(locks):
+    """ Hold all of the given locks, taken in order """
+    held = []
+    try:
+        for lock in locks:
+            lock.__enter__()
+            held.append(lock)
+        yield
+    finally:
+        for lock in reversed(held):
+            lock.__exit__(None, None, None)
+
+
+class ShardedData(MutableMapping):
+    """
+    Dictionary view over the data of several shards, or over another
+    dictionary attribute of theirs. Every key lives in the shard picked by
+    the CRC32 of the key, which is the same in every process and on every
+    run.
+    """
+    def __init__(self, shards, attribute="data"):
+        self.shards = shards
+        self.attribute = attribute
+
+    def shard_of(self, key):
+        """ Index of the shard holding key """
+        if not isinstance(key, _string_types):
+            key = repr(key)
+        return (zlib.crc32(_bytes(key)) & 0xffffffff) % len(self.shards)
+
+    def split(self, data):
+        """ Group the dictionary data by shard index """
+        groups = {}
+        for key, value in data.items():
+            groups.setdefault(self.shard_of(key), {})[key] = value
+        return groups
+
+    def _part(self, key):
+        return getattr(self.shards[self.shard_of(key)], self.attribute)
+
+    def __getitem__(self, key):
+        return self._part(key)[key]
+
+    def __setitem__(self, key, value):
+        self._part(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._part(key)[key]
+
+    def __contains__(self, key):
+        return key in self._part(key)
+
+    def __iter__(self):
+        for shard in self.shards:
+            for key in getattr(shard, self.attribute):
+                yield key
+
+    def __len__(self):
+        return sum(len(getattr(shard, self.attribute))
+                   for shard in self.shards)
+
+    def items(self):
+        for shard in self.shards:
+            for item in getattr(shard, self.attribute).items():
+                yield item
+
+    def copy(self):
+        merged = {}
+        for shard in self.shards:
+            merged.update(getattr(shard, self.attribute))
+        return merged
+
+
 class JSONModification(object):
-    """Class for reusable use of saving and loading data from JSON files"""
+    """Class for reusable use of saving and loading data from JSON files
+
+    With wal=True changes are not saved by rewriting the data file, they are
+    appended as records to a write ahead log next to it (data.json.wal).
+    Loading replays the log on top of the data file, compact() folds the log
+    back into the data file. fsync is "always", "never" or the number of
+    milliseconds that may pass between two fsyncs of the log. Loading again
+    only applies the records appended since, as long as the data file was
+    not replaced meanwhile.
 
-    def __init__(self, data_file=DATA_FILE, pid_file=LOCK_FILE, timeout=0):
+    codec picks how the data file and log records are written, "json" or
+    the more compact "binary". Loading detects the format of an existing
+    file, so the codec can be changed at any time.
+
+    With shards=N the keys are spread over N shard files next to the data
+    file (data.json.shard0 ...), which then only names the number of shards.
+    Every shard has its own state lock and log, saving only rewrites the
+    shards that changed. Loading data written with another number of shards,
+    or without shards, redistributes it.
+
+    engine="indexed" keeps the data in an append only record file with an
+    index instead (see nframe_indexed), the data file then only names the
+    engine. Nothing is loaded up front, values are read from disk when they
+    are used and saving appends the changed keys. Data in the JSON format is
+    converted when loaded, and the other way around.
+
+    Changes made through _update and _delete are counted, updates that do
+    not change a value are not. Nothing is written while the count matches
+    the one of the last save.
+
+    Keys written with expiry times are kept in expires, a dictionary of
+    key: Unix time, which is saved with the data and carried by the log
+    records. Keys whose time has passed are dropped when the data is loaded.
+    The indexed engine does not keep expiry times.
+
+    Used as a context manager it holds a FileLock on pid_file, waiting up to
+    timeout seconds for it, shared with exclusive=False so tools that only
+    read can run at the same time.
+
+    With metrics set, loads, saves and compactions are timed and the bytes
+    written counted.
+    """
+    metrics = None
+
+    def __init__(self, data_file=DATA_FILE, pid_file=LOCK_FILE, timeout=0,
+                 wal=False, fsync="never", codec="json", shards=1,
+                 engine="json", exclusive=True):
         self.data = {}
+        self.expires = {}
         self.data_file = data_file
         self.lock = None
         self.lock_file = pid_file
         self.timeout = timeout
+        self.exclusive = exclusive
+        self.state_lock = StateLock.for_file(data_file)
+        self.wal = wal
+        self.wal_file = "{0}.wal".format(data_file)
+        self.wal_size = 0
+        self.fsync = fsync
+        if fsync not in ("always", "never"):
+            try:
+                self.fsync = float(fsync) / 1000
+            except (TypeError, ValueError):
+                raise ServerError("fsync must be always, never or a number "
+                                  "of milliseconds")
+        if codec not in CODECS:
+            raise ServerError("Unknown codec {0}".format(codec))
+        self.codec = CODECS[codec]
+        self._wal_codec = None
+        self._signature = None
+        # Signature of the data file the data in memory was loaded from
+        self._loaded = None
+        if engine not in ENGINES:
+            raise ServerError("Unknown engine {0}".format(engine))
+        self.engine = engine
+        self._signature_files = (data_file, self.wal_file)
+        if engine == "indexed":
+            if wal or shards > 1:
+                raise ServerError("The indexed engine already appends its "
+                                  "changes, it can not be combined with "
+                                  "wal or shards")
+            self.data = IndexedData("{0}.records".format(data_file),
+                                    "{0}.index".format(data_file),
+                                    self.codec)
+            self._signature_files = (self.data.records_file,
+                                     self.data.index_file)
+        self.shards = []
+        if shards > 1:
+            self.shards = [JSONModification(self._shard_file(index),
+                                            pid_file, timeout, wal, fsync,
+                                            codec)
+                           for index in range(shards)]
+            self.data = ShardedData(self.shards)
+            self.expires = ShardedData(self.shards, "expires")
+        self.changes = 0
+        self._saved = 0
+        self._records = []
+        self._generation = 0
+        self._wal_handle = None
+        self._wal_pid = None
+        self._last_fsync = 0
+        # Log data was appended since the last fsync
+        self._unsynced = False
 
     def __enter__(self):
         """
         Use the JSON modification as a context manager to automatically lock
         the file and load the data (creating it if it does not yet exist)
         """
-        self.lock = Lock(self.lock_file, timeout=self.timeout)
+        self.lock = FileLock(self.lock_file, timeout=self.timeout,
+                             exclusive=self.exclusive, metrics=self.metrics)
         self.lock.acquire()
-        self._load()
-        self._save()
+        with self.state_lock:
+            self._load()
+            if not os.path.exists(self.data_file):
+                self._save()
         return self
 
     #noinspection PyUnusedLocal
     def __exit__(self, exctype, value, tb):
         """
-        Save the data and close exclusive access to the file
+        Save any unsaved changes and close exclusive access to the file
         """
-        self._load()
-        self._save()
+        if self.dirty:
+            with self.state_lock:
+                self._save()
+        self._close_wal()
         self.lock.release()
 
-    def _save(self):
-        """ Save data to local json file so it is persistent."""
-        file_data = dict(data=self.data, version=__version__)
+    @property
+    def dirty(self):
+        """ True if there are changes that have not been saved yet """
+        return self.changes != self._saved
+
+    def _shard_file(self, index):
+        return "{0}.shard{1}".format(self.data_file, index)
+
+    def _parts(self, keys=None):
+        """ The objects owning a file of the data set: the shards holding
+        the given keys, all shards for None, or just this one if unsharded.
+        """
+        if not self.shards:
+            return [self]
+        if keys is None:
+            return self.shards
+        return [self.shards[index] for index in
+                sorted(set(self.data.shard_of(key) for key in keys))]
+
+    def _file_signature(self):
+        """ Identify the current version of the data files. Saves rename a
+        new data file into place, so its inode changes with every save, the
+        log only grows until it is compacted.
+        """
+        return tuple(_stat_signature(name) for name in self._signature_files)
+
+    def _expiry_times(self, keys, ttl):
+        """ Expiry times of keys written with ttl, None without a ttl """
+        if ttl is None:
+            return None
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or \
+                ttl <= 0:
+            raise CommandError("ttl must be a positive number of seconds")
+        if self.engine == "indexed":
+            raise CommandError("The indexed engine does not support ttl")
+        return dict.fromkeys(keys, time() + ttl)
+
+    def _update(self, data, expires=None):
+        """ Update the data with the dictionary data, recording the change.
+
+        :param expires: Dictionary of the expiry time of keys in data, the
+            other keys are kept until deleted
+        :return: Dictionary of the keys whose value or expiry time actually
+            changed
+        """
+        data = dict(data)
+        expires = expires or {}
+        if self.shards:
+            changed = {}
+            for index, group in self.data.split(data).items():
+                changed.update(self.shards[index]._update(group, expires))
+        else:
+            missing = object()
+            changed = dict((key, value) for key, value in data.items()
+                           if _value_type(self.data.get(key, missing))
+                           is not _value_type(value) or
+                           self.data[key] != value)
+            if expires or self.expires:
+                # A new expiry time, or dropping the old one, is a change
+                changed.update((key, value) for key, value in data.items()
+                               if self.expires.get(key) != expires.get(key))
+                for key in changed:
+                    if key in expires:
+                        self.expires[key] = expires[key]
+                    else:
+                        self.expires.pop(key, None)
+            self.data.update(changed)
+        if changed:
+            record = dict(op="update", data=changed)
+            expiring = dict((key, expires[key]) for key in changed
+                            if key in expires)
+            if expiring:
+                record['expires'] = expiring
+            self._record(record)
+        return changed
+
+    def _delete(self, keys):
+        """ Remove keys from the data, recording the change """
+        if self.shards:
+            for index, group in self.data.split(
+                    dict.fromkeys(keys)).items():
+                self.shards[index]._delete(list(group))
+        else:
+            for key in keys:
+                del self.data[key]
+            if self.expires:
+                for key in keys:
+                    self.expires.pop(key, None)
+        if keys:
+            self._record(dict(op="delete", keys=list(keys)))
+
+    def _drop_expired(self):
+        """ Forget the keys whose expiry time has passed, without recording
+        a change, the next save leaves them out.
+        """
+        now = time()
+        for key in [key for key, when in self.expires.items()
+                    if when <= now]:
+            del self.expires[key]
+            self.data.pop(key, None)
+
+    def _record(self, record):
+        """ Called with the log record of every change, which it counts. In
+        wal mode it is kept until the next save, shards log their own
+        records.
+        """
+        self.changes += 1
+        if self.wal and not self.shards:
+            self._records.append(record)
+
+    def _apply(self, record):
+        """ Replay a single log record """
+        if record['op'] == "update":
+            self.data.update(record['data'])
+            expires = record.get('expires', {})
+            for key in record['data']:
+                if key in expires:
+                    self.expires[key] = expires[key]
+                else:
+                    self.expires.pop(key, None)
+        elif record['op'] == "delete":
+            for key in record['keys']:
+                self.data.pop(key, None)
+                self.expires.pop(key, None)
+
+    @measured("save")
+    def _save(self, data=None, records=None, expires=None):
+        """ Save data to local json file so it is persistent. In wal mode
+        only the recorded changes are appended to the log.
+
+        :param data: Snapshot to save instead of the current data
+        :param records: Log records to append instead of the recorded ones
+        :param expires: Expiry times going with the data snapshot
+        """
+        self._saved = self.changes
+        if self.engine == "indexed":
+            synced = self._fsync_due()
+            try:
+                written = self.data.write(self.data.take_pending()
+                                          if records is None else records,
+                                          synced)
+            except (TypeError, ValueError, IOError, OSError):
+                raise ServerError("Data could not be saved")
+            if written:
+                self._unsynced = not synced
+            self._count_written(written)
+            if not os.path.exists(self.data_file):
+                self._write_manifest()
+            return
+        if self.shards:
+            for shard in self.shards:
+                if shard.dirty or not os.path.exists(shard.data_file):
+                    with shard.state_lock:
+                        shard._save()
+            if not os.path.exists(self.data_file):
+                self._write_manifest()
+            return
+        if not self.wal or not os.path.exists(self.data_file):
+            self._records = []
+            return self._write_snapshot(self.data if data is None else data,
+                                        expires)
+        if records is None:
+            records, self._records = self._records, []
+        self._append(records)
+
+    def _write_snapshot(self, data, expires=None):
+        """ Write the data file. The file is written next to the old one and
+        renamed over it, so readers never see a partially written file.
+
+        :param expires: Expiry times of the keys in data, the current ones
+            if None
+        """
+        if expires is None:
+            expires = self.expires
+        if self.shards:
+            groups = self.data.split(data)
+            expiring = self.data.split(expires)
+            for index, shard in enumerate(self.shards):
+                with shard.state_lock:
+                    shard._write_snapshot(groups.get(index, {}),
+                                          expiring.get(index, {}))
+            return self._write_manifest()
+        if self.engine == "indexed":
+            try:
+                self.data.rebuild(data.copy(), self.fsync != "never")
+            except (TypeError, ValueError, IOError, OSError):
+                raise ServerError("Data could not be saved")
+            return self._write_manifest()
+        file_data = dict(data=data, version=__version__)
+        if expires:
+            file_data['expires'] = dict(expires)
+        if self.wal:
+            file_data['wal'] = self._generation
+        self._write_file(file_data)
+        if not self.wal and os.path.exists(self.wal_file):
+            # The log is part of the data now
+            os.unlink(self.wal_file)
+
+    def _write_manifest(self):
+        """ Record the layout of the data set in the data file """
+        manifest = dict(version=__version__)
+        if self.shards:
+            manifest['shards'] = len(self.shards)
+        else:
+            manifest['engine'] = self.engine
+        self._write_file(manifest)
+
+    def _write_file(self, file_data):
+        """ Atomically replace the data file with file_data """
+        temp_file = "{0}.{1}.tmp".format(self.data_file, os.getpid())
+        try:
+            payload = self.codec.encode(file_data)
+            with open(temp_file, "wb") as data_file:
+                data_file.write(payload)
+                if self.fsync != "never":
+                    data_file.flush()
+                    os.fsync(data_file.fileno())
+            _replace(temp_file, self.data_file)
+        except (TypeError, ValueError, IOError, OSError):
+            raise ServerError("Data could not be saved")
+        self._loaded = _stat_signature(self.data_file)
+        self._count_written(len(payload))
+
+    def _count_written(self, size):
+        if self.metrics is not None:
+            self.metrics.count("saved_bytes", size or 0)
+
+    def _append(self, records):
+        """ Append records to the write ahead log, one JSON line each, or
+        each one prefixed with its length for the binary codec.
+        """
+        if not records:
+            return
+        try:
+            handle = self._open_wal()
+            if self._wal_codec is JSON:
+                out = _bytes("".join("{0}\n".format(json.dumps(record))
+                                     for record in records))
+            else:
+                out = bytearray()
+                for record in records:
+                    payload = self._wal_codec.encode(record)
+                    out += _RECORD_SIZE.pack(len(payload))
+                    out += payload
+            handle.write(out)
+            handle.flush()
+            self.wal_size = handle.tell()
+            if self._fsync_due():
+                os.fsync(handle.fileno())
+                self._unsynced = False
+            else:
+                self._unsynced = True
+        except (ValueError, IOError, OSError):
+            raise ServerError("Data could not be saved")
+        self._count_written(len(out))
+
+    def _fsync_due(self):
+        """ Whether the fsync policy asks for an fsync of this write """
+        if self.fsync == "always" or (
+                self.fsync != "never" and
+                time() - self._last_fsync >= self.fsync):
+            self._last_fsync = time()
+            return True
+        return False
+
+    def _sync_due(self):
+        """ fsync log data appended without one once the fsync interval
+        has passed, so the last changes before a quiet period are not left
+        waiting for the next write.
+        """
+        if not self._unsynced or self.fsync in ("always", "never") or \
+                time() - self._last_fsync < self.fsync:
+            return
         try:
-            with open(self.data_file, "w") as data_file:
-                data_file.write(str(json.dumps(file_data)))
-        except (ValueError, IOError):
+            if self.engine == "indexed":
+                with open(self.data.records_file, "ab") as handle:
+                    os.fsync(handle.fileno())
+            elif self._wal_handle is not None and \
+                    self._wal_pid == os.getpid():
+                os.fsync(self._wal_handle.fileno())
+        except (IOError, OSError):
             raise ServerError("Data could not be saved")
+        self._last_fsync = time()
+        self._unsynced = False
+
+    def _open_wal(self):
+        """ The log stays open between appends, but not across a fork. A
+        log that was not replayed, because it is missing or left over from
+        an earlier generation, is started over.
+        """
+        if self._wal_handle is None or self._wal_pid != os.getpid():
+            if self._wal_codec is None or not os.path.exists(self.wal_file):
+                self._reset_wal()
+            self._wal_handle = open(self.wal_file, "ab")
+            self._wal_pid = os.getpid()
+        return self._wal_handle
 
+    def _reset_wal(self):
+        """ Start an empty log for the current generation. """
+        self._close_wal()
+        header = _bytes("{0}\n".format(json.dumps(
+            dict(wal=self._generation, version=__version__,
+                 codec=self.codec.name))))
+        with open(self.wal_file, "wb") as wal:
+            wal.write(header)
+        self.wal_size = len(header)
+        self._wal_codec = self.codec
+
+    def _close_wal(self):
+        for shard in self.shards:
+            shard._close_wal()
+        if self._wal_handle is not None and self._wal_pid == os.getpid():
+            self._wal_handle.close()
+        self._wal_handle = None
+
+    def _replay(self, start=None):
+        """ Apply the log on top of the loaded data file. A log left over
+        from an earlier generation has already been folded into the data
+        file. A torn last record from a crash is cut off, so records
+        appended later follow the last complete one.
+
+        :param start: Offset of the first record to apply, the log was
+            replayed up to there already
+        """
+        codec = self._wal_codec
+        if start is None:
+            self._wal_codec = None
+        if not os.path.exists(self.wal_file):
+            return
+        with open(self.wal_file, "rb") as wal:
+            if start is None:
+                try:
+                    header = json.loads(wal.readline().decode('utf-8'))
+                    if header['wal'] != self._generation:
+                        return
+                    codec = CODECS[header.get('codec', JSON.name)]
+                except (ValueError, KeyError, TypeError):
+                    return
+            else:
+                wal.seek(start)
+            if codec is JSON:
+                end = self._replay_lines(wal)
+            else:
+                end = self._replay_records(wal, codec)
+            torn = os.fstat(wal.fileno()).st_size > end
+        if torn:
+            with open(self.wal_file, "r+b") as wal:
+                wal.truncate(end)
+        self.wal_size = end
+        self._wal_codec = codec
+
+    def _replay_lines(self, wal):
+        """ Apply JSON lines up to the first incomplete one, returns the
+        offset after the last one applied
+        """
+        end = wal.tell()
+        for line in wal:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            self._apply(record)
+            end += len(line)
+        return end
+
+    def _replay_records(self, wal, codec):
+        """ Apply length prefixed records up to the first incomplete one,
+        returns the offset after the last one applied
+        """
+        end = wal.tell()
+        while True:
+            size = wal.read(_RECORD_SIZE.size)
+            if len(size) < _RECORD_SIZE.size:
+                break
+            length = _RECORD_SIZE.unpack(size)[0]
+            payload = wal.read(length)
+            if len(payload) < length:
+                break
+            try:
+                record = codec.decode(payload)
+            except ValueError:
+                break
+            self._apply(record)
+            end = wal.tell()
+        return end
+
+    @measured("compact")
+    def compact(self, data=None, expires=None):
+        """
+        compact()
+        Fold the log into the data file and start a new, empty log. Records
+        appended before a crash between those two steps belong to an older
+        generation than the data file and are skipped when loading.
+
+        :param data: Snapshot to write instead of the current data
+        :param expires: Expiry times going with the data snapshot
+        """
+        if self.engine == "indexed":
+            with self.state_lock:
+                if data is None:
+                    self.data.compact(self.fsync != "never")
+                    self._saved = self.changes
+                else:
+                    self.data.rebuild(data, self.fsync != "never")
+            return
+        if self.shards:
+            groups = self.data.split(data) if data is not None else {}
+            expiring = self.data.split(expires or {})
+            for index, shard in enumerate(self.shards):
+                if data is None:
+                    shard.compact()
+                else:
+                    shard.compact(groups.get(index, {}),
+                                  expiring.get(index, {}))
+            self._saved = self.changes
+            return
+        with self.state_lock:
+            self._generation += 1
+            if data is None:
+                data = self.data
+                self._records = []
+                self._saved = self.changes
+            self._write_snapshot(data, expires)
+            self._reset_wal()
+
+    @measured("load")
     def _load(self):
         """ Retrieve data from the supplied json file."""
-
-        if not os.path.exists(self.data_file):
+        if not self.shards and self.engine == "json" and self._catch_up():
+            return
+        file_data = self._read_file(self.data_file)
+        if self.shards:
+            return self._load_shards(file_data)
+        if self.engine == "indexed":
+            return self._load_indexed(file_data)
+        if file_data is not None and file_data.get('engine') == "indexed":
+            # Written by the indexed engine, convert it
+            indexed = IndexedData("{0}.records".format(self.data_file),
+                                  "{0}.index".format(self.data_file))
+            indexed.open()
+            self.data = indexed.copy()
+            self.expires = {}
+            self._records = []
+            self._write_snapshot(self.data)
+            if self.wal:
+                self._reset_wal()
+            indexed.remove()
+            return
+        if file_data is not None and 'shards' in file_data:
+            # Written with shards, fold them into this file
+            self.data, self.expires = self._read_shards(file_data['shards'])
+            self._drop_expired()
+            self._records = []
+            self._write_snapshot(self.data)
+            if self.wal:
+                self._reset_wal()
+            self._remove_shards(0, file_data['shards'])
             return
+        if file_data is not None:
+            self.data = file_data['data']
+            self.expires = file_data.get('expires', {})
+            self._generation = file_data.get('wal', 0)
+        self._loaded = _stat_signature(self.data_file)
+        # A log is replayed even when not in wal mode, so switching modes
+        # never loses changes
+        self._records = []
+        self._replay()
+        self._drop_expired()
 
-        with open(self.data_file, "r") as file_data:
-            file_data = json.loads(file_data.read())
+    def _catch_up(self):
+        """ Bring the loaded data up to date without reading the data file,
+        returns whether that was possible: the data file was not replaced
+        since it was loaded or saved, and the log only grew. Then only the
+        records appended since are applied.
+        """
+        if self._loaded is None or \
+                _stat_signature(self.data_file) != self._loaded:
+            return False
+        size = os.path.getsize(self.wal_file) \
+            if os.path.exists(self.wal_file) else None
+        if self._wal_codec is None or size is None:
+            # Only good if there was no log to replay before either
+            return self._wal_codec is None and size is None
+        if size < self.wal_size:
+            return False
+        if size > self.wal_size:
+            self._replay(self.wal_size)
+        self._drop_expired()
+        return True
+
+    def _load_indexed(self, file_data):
+        """ Open the record file, converting data in the JSON format """
+        if file_data is None or file_data.get('engine') == "indexed":
+            try:
+                return self.data.refresh()
+            except (ValueError, IOError, OSError) as err:
+                raise ServerError("Could not open {0}: {1}".format(
+                    self.data.records_file, err))
+        json_data = JSONModification(self.data_file, codec=self.codec.name)
+        json_data._load()
+        self._write_snapshot(json_data.data)
+        if os.path.exists(self.wal_file):
+            os.unlink(self.wal_file)
 
+    def _read_file(self, filename):
+        """ Decode a data file in whichever codec it was written with,
+        None if it does not exist.
+        """
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as file_data:
+            raw = file_data.read()
+        codec = BINARY if raw[:1] == _BINARY_SNAPSHOT else JSON
+        file_data = codec.decode(raw)
         if file_data['version'] != __version__:
             file_data = self._upgrade_path(file_data)
-        self.data = file_data['data']
+        return file_data
+
+    def _load_shards(self, file_data):
+        """ Load every shard, redistributing the keys if the data set was
+        written with another number of shards or without them.
+        """
+        if file_data is None or file_data.get('shards') == len(self.shards):
+            for shard in self.shards:
+                with shard.state_lock:
+                    shard._load()
+            self._loaded = _stat_signature(self.data_file)
+            return
+        if 'shards' in file_data:
+            data, expires = self._read_shards(file_data['shards'])
+        else:
+            unsharded = JSONModification(self.data_file, codec=self.codec.name)
+            unsharded._load()
+            data, expires = unsharded.data, unsharded.expires
+        groups = self.data.split(data)
+        expiring = self.data.split(expires)
+        for index, shard in enumerate(self.shards):
+            with shard.state_lock:
+                shard.data = groups.get(index, {})
+                shard.expires = expiring.get(index, {})
+                shard._drop_expired()
+                shard._records = []
+                if shard.wal:
+                    shard.compact()
+                else:
+                    shard._write_snapshot(shard.data)
+        self._write_manifest()
+        if os.path.exists(self.wal_file):
+            os.unlink(self.wal_file)
+        self._remove_shards(len(self.shards), file_data.get('shards', 0))
+
+    def _read_shards(self, count):
+        """ Merge the data and expiry times of count shard files """
+        data, expires = {}, {}
+        for index in range(count):
+            shard = JSONModification(self._shard_file(index),
+                                     codec=self.codec.name)
+            with shard.state_lock:
+                shard._load()
+            data.update(shard.data)
+            expires.update(shard.expires)
+        return data, expires
+
+    def _log_size(self):
+        """ Bytes appended since the data was last compacted """
+        if self.engine == "indexed":
+            return self.data.tail_size
+        return self.wal_size
+
+    def _take_changes(self):
+        """ What the next _save has to write, taken while the data can not
+        change so it can be written without holding up requests.
+
+        :return: tuple of (snapshot, records, expires), see _save
+        """
+        if self.engine == "indexed":
+            return None, self.data.take_pending(), None
+        if self.wal:
+            records, self._records = self._records, []
+            return None, records, None
+        return dict(self.data), None, dict(self.expires)
+
+    def _return_changes(self, records):
+        """ Hand records taken by _take_changes back after _save failed,
+        so the next save writes them.
+        """
+        if self.engine == "indexed":
+            self.data.return_pending(records)
+        elif self.wal:
+            self._records[:0] = records
+
+    def _remove_shards(self, start, stop):
+        """ Delete the files of shards no longer in use """
+        for index in range(start, stop):
+            for name in (self._shard_file(index),
+                         "{0}.wal".format(self._shard_file(index))):
+                if os.path.exists(name):
+                    os.unlink(name)
 
     @staticmethod
     def _upgrade_path(data):
@@ -196,79 +1259,1414 @@ class JSONModification(object):
             pass
         return data
 
-
-def autosave(func):
+def autosave(func=None, keys=None):
     """ This decorator will take in class objects and invoke their load
     method running them, and then save method afterwards. This makes sure that
     all stored in attributes and on the file system are synchronized.
+    The whole cycle holds the state lock, so concurrent threads or processes
+    can not overwrite each other's changes.
+    Nothing is written unless the method actually changed the data.
+
+    keys is a function of the positional and keyword arguments of a call
+    returning the keys it touches. With shards only the state locks of the
+    shards holding them are taken, and only those shards loaded and saved.
     """
+    if func is None:
+        return partial(autosave, keys=keys)
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        self._load()
-        response = func(self, *args, **kwargs)
-        self._save()
+        parts = [self]
+        locks = [self.state_lock] + [shard.state_lock for shard in self.shards]
+        if self.shards and keys is not None and self._loaded is not None \
+                and self._loaded == _stat_signature(self.data_file):
+            # The layout of the shards is still the one loaded
+            parts = self._parts(keys(args, kwargs))
+            locks = [part.state_lock for part in parts]
+        with _holding(locks):
+            for part in parts:
+                part._load()
+            try:
+                response = func(self, *args, **kwargs)
+                for part in parts:
+                    if part.dirty or part is self and \
+                            any(shard.dirty for shard in self.shards):
+                        part._save()
+                self._saved = self.changes
+            except Exception:
+                # What is in memory may not be on disk, read it all again
+                for part in parts:
+                    part._loaded = None
+                self._loaded = None
+                raise
         return response
     return wrapper
 
-    
-class Server(BaseRequestHandler, JSONModification):
+
+class Store(JSONModification):
+    """
+    Authoritative in memory copy of the data file, shared by all connections
+    of a server whichever engine serves them. The file is loaded once and
+    changes are written behind: every flush_interval seconds by a background
+    thread and as soon as flush_every changes are pending. flush_every=1
+    writes every change through before the response is sent.
+
+    In wal mode a flush only appends the changes to the log, once the log
+    grows past compact_size bytes it is folded into the data file by a
+    background thread.
+
+    Forked workers each hold their own store, these are created with
+    shared=True. A shared store checks under the state lock whether another
+    process changed the files, reloads them if so, and writes changes through.
+    Without wal every change rewrites the data file, or its shard, and
+    every other process then reloads the file and its log in full. Only the
+    indexed engine reads just the records appended since.
+    With shards only the state locks of the shards a request touches are
+    taken, so requests for keys in different shards do not wait on each
+    other. A store that is not shared holds the shards of a request the
+    same way, unless max_keys or max_memory may evict keys from any shard.
+
+    Every change gets the next version number and is kept in a changelog of
+    the last changelog_size changes, which watchers read with
+    changes_since or wait_changes. Changes other processes make to a shared
+    store only show up as a "reset" event once the store reloads.
+
+    The etag names the data as it is now, a request for "get data" or "get"
+    carrying the etag of an earlier answer as if_version gets a short "not
+    modified" answer if nothing it asked for changed since.
+
+    Requests, the time spent waiting for locks and running commands, and
+    saves are recorded in metrics, which the "stats" command returns.
+
+    Writes carrying a ttl expire that many seconds later. Expired keys are
+    deleted when a request touches them, a request that may touch any key
+    deletes all of them first, and the flush thread deletes them in batches
+    of expire_batch keys. Deleting an expired key is a change like any other.
+
+    With max_keys or max_memory, the least recently read or written keys
+    are deleted once there are more than max_keys keys, or their keys and
+    values take more than max_memory bytes in the storage codec. Both can
+    not be used by a shared store, and the indexed engine only supports
+    max_keys.
+
+    A request carrying a timeout, in seconds, is answered with an error
+    instead of being run if it waited longer than that for the data, the
+    client has given up on it by then.
+
+    open_snapshot hands out a consistent copy of the data in the JSON data
+    file format, which the "snapshot" command streams to the client. Data
+    already saved in that format is handed out as the saved file itself.
+
+    The "query" command scans a sorted index of the keys, and for the
+    fields named in indexes an index of the keys by the value of that field
+    (see nframe_query). The indexes are built by the first query or "keys"
+    command and kept up to date by every change after it.
+    """
+    def __init__(self, data_file=DATA_FILE, flush_interval=1.0,
+                 flush_every=1000, shared=False, compact_size=64 * 1024 ** 2,
+                 changelog_size=10000, metrics=None, max_keys=None,
+                 max_memory=None, expire_batch=1000, indexes=None,
+                 **kwargs):
+        if shared and (max_keys or max_memory):
+            raise ServerError("A shared store can not evict keys, other "
+                              "processes do not see which keys it uses")
+        if max_memory and kwargs.get('engine') == "indexed":
+            raise ServerError("The indexed engine keeps values on disk, "
+                              "limit it with max_keys instead")
+        self.metrics = metrics or Metrics()
+        self.version = 0
+        self.changelog = deque(maxlen=changelog_size)
+        # Distinguishes the versions of this store from those of other
+        # processes and runs, see _instance
+        self._instance_id = None
+        self._instance_pid = None
+        # Version of the last change to each key that exists, and of the
+        # last change that dropped keys, which stands in for those missing
+        self._key_versions = {}
+        self._dropped_version = 0
+        self._watch = threading.Condition(threading.Lock())
+        self._listeners = []
+        super(Store, self).__init__(data_file=data_file, **kwargs)
+        for shard in self.shards:
+            shard.metrics = self.metrics
+        self.flush_interval = flush_interval
+        self.flush_every = 1 if shared else flush_every
+        self.shared = shared
+        self.compact_size = compact_size
+        # Everything, or in a sharded store each shard on its own
+        self._mutex = _PartLocks(len(self.shards)) if self.shards else \
+            threading.RLock()
+        # Kept by requests for keys in different shards at the same time:
+        # versions, changelog, indexes and expiry times
+        self._books = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._compactor = None
+        self.max_keys = max_keys
+        self.max_memory = max_memory
+        self.expire_batch = expire_batch
+        self.memory = 0
+        self._sizes = {}
+        # Keys from least to most recently used, kept only with limits
+        self._recency = None
+        self._expiry_heap = []
+        self.index_fields = list(indexes or ())
+        # Built on first use, see _indexes
+        self._key_index = None
+        self._field_indexes = {}
+        with self.state_lock:
+            self._load()
+            if not os.path.exists(self.data_file):
+                self._save()
+            for part in self._parts():
+                part._signature = part._file_signature()
+        self._reset_expiry()
+        if max_keys or max_memory:
+            self._recency = OrderedDict.fromkeys(self.data)
+            if max_memory:
+                for key, value in self.data.items():
+                    self._sizes[key] = self._size_of(key, value)
+                self.memory = sum(self._sizes.values())
+            with self._mutex:
+                self._evict()
+        if self.flush_interval and not self.shared:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name="nframe-flush")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    @property
+    def pending(self):
+        """ Number of changes not written to disk yet """
+        return self.changes - self._saved
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.expire()
+                self.flush()
+                for part in self._parts():
+                    with part.state_lock:
+                        part._sync_due()
+            except ServerError:
+                # The changes stay pending, the next round tries again
+                self.metrics.count("flush_errors")
+
+    @contextmanager
+    def _access(self, command=None, data=None):
+        """ Exclusive access to the data for one request. In a sharded
+        store a request for known keys only holds the shards of those keys,
+        unless keys may be evicted from any shard.
+        """
+        if not self.shared:
+            keys = self._request_keys(command, data) \
+                if self.shards and self._recency is None else None
+            if keys is None:
+                with self._mutex:
+                    yield
+                return
+            with _holding(self._mutex.parts[index] for index in sorted(
+                    set(self.data.shard_of(key) for key in keys))):
+                yield
+            return
+        parts = self._parts(self._request_keys(command, data)
+                            if self.shards else None)
+        with _holding([part.state_lock for part in parts]):
+            for part in parts:
+                if part._file_signature() != part._signature:
+                    part._load()
+                    self._reset_expiry()
+                    self._key_index = None
+                    if part._signature is not None:
+                        # Another process changed the data
+                        self._publish(dict(op="reset"))
+            yield
+            for part in parts:
+                if part.dirty:
+                    part._save()
+                    if (self.wal or self.engine == "indexed") and \
+                            part._log_size() > self.compact_size:
+                        self._compact_parts([part])
+                part._signature = part._file_signature()
+            self._saved = self.changes
+
+    def refresh(self):
+        """
+        refresh()
+        Pick up changes other processes wrote to a shared store.
+        """
+        if self.shared:
+            with self._access():
+                pass
+
+    def _record(self, record):
+        with self._books:
+            super(Store, self)._record(record)
+            self._publish(record)
+
+    def _update(self, data, expires=None):
+        data = dict(data)
+        if self.codec is JSON:
+            # Values from the binary codec, bytes say, would only fail once
+            # the flush thread writes them
+            try:
+                JSON.encode(data)
+            except (TypeError, ValueError) as err:
+                raise CommandError("Values can not be stored as JSON: {0}"
+                                   .format(err))
+        indexed = self._key_index is not None
+        if indexed:
+            if self._field_indexes:
+                previous = dict((key, self.data[key]) for key in data
+                                if key in self.data)
+            else:
+                previous = set(key for key in data if key in self.data)
+        changed = super(Store, self)._update(data, expires)
+        with self._books:
+            if indexed and changed:
+                self._key_index.add([key for key in changed if
+                                     key not in previous and _indexable(key)])
+                for index in self._field_indexes.values():
+                    for key, value in changed.items():
+                        if not _indexable(key):
+                            continue
+                        if key in previous:
+                            index.remove(key, previous[key])
+                        index.add(key, value)
+            if expires:
+                for key in changed:
+                    if key in expires:
+                        heappush(self._expiry_heap, (expires[key], key))
+                if len(self._expiry_heap) > 2 * len(self.expires) + 1000:
+                    # Mostly times that were replaced since
+                    self._reset_expiry()
+        if self._recency is not None:
+            if self.max_memory:
+                for key, value in changed.items():
+                    size = self._size_of(key, value)
+                    self.memory += size - self._sizes.get(key, 0)
+                    self._sizes[key] = size
+            self._touch(dict(data))
+            self._evict()
+        return changed
+
+    def _delete(self, keys):
+        indexed = [key for key in keys if _indexable(key)] \
+            if self._key_index is not None else None
+        if indexed:
+            with self._books:
+                for index in self._field_indexes.values():
+                    for key in indexed:
+                        index.remove(key, self.data[key])
+        super(Store, self)._delete(keys)
+        if indexed:
+            with self._books:
+                self._key_index.remove(indexed)
+        if self._recency is not None:
+            for key in keys:
+                self._recency.pop(key, None)
+                self.memory -= self._sizes.pop(key, 0)
+
+    def _size_of(self, key, value):
+        """ Bytes a key and its value take in the storage codec """
+        try:
+            return len(_bytes(key)) + len(self.codec.encode(value))
+        except (TypeError, ValueError):
+            return len(_bytes(key))
+
+    def _touch(self, keys):
+        """ Mark keys as the most recently used ones """
+        if self._recency is None:
+            return
+        for key in keys:
+            self._recency.pop(key, None)
+            self._recency[key] = None
+
+    def _evict(self):
+        """ Delete the least recently used keys until the limits hold """
+        count, memory = len(self.data), self.memory
+        victims = []
+        for key in self._recency:
+            if (not self.max_keys or count <= self.max_keys) and \
+                    (not self.max_memory or memory <= self.max_memory):
+                break
+            victims.append(key)
+            count -= 1
+            memory -= self._sizes.get(key, 0)
+        if victims:
+            self._delete(victims)
+            self.metrics.count("evicted", len(victims))
+
+    def _indexes(self):
+        """ The key index and the field indexes, built if needed """
+        if self._key_index is None:
+            keys = [key for key in self.data if _indexable(key)]
+            self._field_indexes = {}
+            for field in self.index_fields:
+                index = FieldIndex(field)
+                index.build((key, self.data[key]) for key in keys)
+                self._field_indexes[field] = index
+            self._key_index = KeyIndex(keys)
+        return self._key_index, self._field_indexes
+
+    def _reset_expiry(self):
+        """ Rebuild the heap of expiry times from expires """
+        self._expiry_heap = [(when, key) for key, when
+                             in self.expires.items()]
+        heapify(self._expiry_heap)
+
+    def _expire(self, command=None, data=None):
+        """ Delete the expired keys a request touches, all of them if it
+        may touch any. Costs a look at the earliest expiry time as long as
+        none has passed.
+        """
+        heap = self._expiry_heap
+        now = time()
+        if not heap or heap[0][0] > now:
+            return
+        keys = self._request_keys(command, data)
+        if keys is None:
+            self._expire_due(now)
+            return
+        expired = [key for key in set(key for key in keys
+                                      if isinstance(key, _string_types))
+                   if self.expires.get(key, now + 1) <= now]
+        if expired:
+            self._delete(expired)
+            self.metrics.count("expired", len(expired))
+
+    def _expire_due(self, now, limit=None):
+        """ Delete up to limit keys whose expiry time passed before now,
+        returns how many were deleted
+        """
+        heap = self._expiry_heap
+        expired = []
+        while heap and heap[0][0] <= now and \
+                (limit is None or len(expired) < limit):
+            when, key = heappop(heap)
+            # Times replaced or dropped since are still in the heap
+            if self.expires.get(key) == when:
+                expired.append(key)
+        if expired:
+            self._delete(expired)
+            self.metrics.count("expired", len(expired))
+        return len(expired)
+
+    def expire(self):
+        """
+        expire()
+        Delete every key whose expiry time has passed, expire_batch keys
+        at a time, so requests are only held up briefly.
+        """
+        while True:
+            with self._access():
+                if self._expire_due(time(), self.expire_batch) < \
+                        self.expire_batch:
+                    return
+
+    def _publish(self, record):
+        """ Give the change the next version and wake up the watchers """
+        with self._watch:
+            self.version += 1
+            self.changelog.append(dict(record, version=self.version))
+            if record['op'] == "reset":
+                self._key_versions.clear()
+                self._dropped_version = self.version
+            elif record['op'] == "delete":
+                for key in record['keys']:
+                    self._key_versions.pop(key, None)
+                self._dropped_version = self.version
+            else:
+                for key in record['data']:
+                    self._key_versions[key] = self.version
+            self._watch.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    @property
+    def _instance(self):
+        """ Random name of this store in this process. Forked workers count
+        versions of their own, so each one names its store anew.
+        """
+        if self._instance_pid != os.getpid():
+            self._instance_id = hexlify(os.urandom(4)).decode('ascii')
+            self._instance_pid = os.getpid()
+        return self._instance_id
+
+    @property
+    def etag(self):
+        """ Tag of the current version of the data """
+        return "{0}:{1}".format(self._instance, self.version)
+
+    def _modified_since(self, etag, keys=None):
+        """ Whether the data, or just the given keys, may have changed
+        since the version named by etag
+        """
+        try:
+            instance, version = etag.split(":")
+            version = int(version)
+        except (AttributeError, ValueError):
+            return True
+        if instance != self._instance or version > self.version:
+            return True
+        if keys is None:
+            return version != self.version
+        with self._watch:
+            return any(self._key_versions.get(key, self._dropped_version) >
+                       version for key in keys)
+
+    def add_listener(self, listener):
+        """ Call listener, without arguments, after every change """
+        with self._watch:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._watch:
+            self._listeners.remove(listener)
+
+    def watch_args(self, data):
+        """
+        watch_args(data)
+        Validate the data of a watch request, returns the version to watch
+        from (the current one if none was given) and the set of watched
+        keys, None for all. since is the token of the last event seen,
+        "instance:version" like an etag. Versions of another instance, an
+        earlier run or another worker, say nothing about the changes since,
+        watching from them starts with a reset.
+        """
+        data = data or {}
+        if not isinstance(data, dict):
+            raise CommandError("Expected a dictionary with since and keys")
+        since, keys = data.get("since"), data.get("keys")
+        version = None
+        if since is not None:
+            try:
+                instance, version = since.split(":")
+                version = int(version)
+            except (AttributeError, ValueError):
+                raise CommandError("since must be the token of an event, "
+                                   "instance:version")
+            if instance != self._instance:
+                version = -1
+        if keys is not None:
+            keys = set(self._key_list(keys))
+        with self._watch:
+            return self.version if version is None else version, keys
+
+    def changes_since(self, version, keys=None):
+        """
+        changes_since(version, keys)
+        The change events after version, only those touching keys if a set
+        of them is given, and the version they lead up to. If the changes
+        are no longer in the changelog a single "reset" event is returned
+        instead, the watcher then has to fetch the data again.
+        """
+        with self._watch:
+            current = self.version
+            if version == current:
+                return [], current
+            if version > current or not self.changelog or \
+                    self.changelog[0]['version'] > version + 1:
+                return [dict(op="reset", version=current)], current
+            start = version + 1 - self.changelog[0]['version']
+            events = list(islice(self.changelog, start, None))
+        if keys is None:
+            return events, current
+        filtered = []
+        for event in events:
+            if event['op'] == "update":
+                data = dict((key, value) for key, value
+                            in event['data'].items() if key in keys)
+                if data:
+                    event = dict(event, data=data)
+                    if 'expires' in event:
+                        event['expires'] = dict(
+                            (key, when) for key, when
+                            in event['expires'].items() if key in keys)
+                    filtered.append(event)
+            elif event['op'] == "delete":
+                deleted = [key for key in event['keys'] if key in keys]
+                if deleted:
+                    filtered.append(dict(event, keys=deleted))
+            else:
+                filtered.append(event)
+        return filtered, current
+
+    def wait_changes(self, version, keys=None, timeout=None):
+        """
+        wait_changes(version, keys, timeout)
+        Like changes_since, but waits up to timeout seconds for a change
+        if there is none after version yet.
+        """
+        with self._watch:
+            if self.version == version:
+                self._watch.wait(timeout)
+        return self.changes_since(version, keys)
+
+    def _request_keys(self, command, data):
+        """ The keys a request touches, None if it may touch any """
+        if command in ("set", "add data") and isinstance(data, dict):
+            return list(data)
+        if command in ("get", "delete", "exists") and isinstance(data, list):
+            return data
+        if command == "hello":
+            return []
+        if command == "batch" and isinstance(data, list):
+            keys = []
+            for request in data:
+                try:
+                    request_keys = self._request_keys(request['command'],
+                                                      request['data'])
+                except (KeyError, TypeError):
+                    return None
+                if request_keys is None:
+                    return None
+                keys.extend(request_keys)
+            return keys
+        return None
+
+    def flush(self):
+        """
+        flush()
+        Write pending changes to disk. Serializing and writing happen
+        outside of the data lock, so requests are not held up. Changes that
+        could not be saved stay pending for the next flush.
+        """
+        with self._flush_lock:
+            with self._mutex:
+                if not self.pending:
+                    return
+                writes = []
+                for part in self._parts():
+                    if part.dirty:
+                        writes.append((part,) + part._take_changes() +
+                                      (part.changes,))
+                changes = self.changes
+            for position, (part, snapshot, records, expires,
+                           part_changes) in enumerate(writes):
+                saved, error = part._saved, None
+                with part.state_lock:
+                    try:
+                        part._save(snapshot, records, expires)
+                    except ServerError as err:
+                        error = err
+                    else:
+                        part._saved = part_changes
+                        part._signature = part._file_signature()
+                if error is not None:
+                    with self._mutex:
+                        part._saved = saved
+                        for unsaved in writes[position:]:
+                            unsaved[0]._return_changes(unsaved[2])
+                    raise error
+            self._saved = changes
+        if self.wal or self.engine == "indexed":
+            self._compact_in_background([
+                part for part in self._parts()
+                if part._log_size() > self.compact_size])
+
+    def _compact_in_background(self, parts):
+        if not parts or self._compactor and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self._compact_parts,
+                                           args=(parts,),
+                                           name="nframe-compact")
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def compact(self, data=None):
+        """
+        compact()
+        Fold the log into the data file. Requests keep being served from
+        memory meanwhile, their changes are written by the next flush.
+        """
+        self._compact_parts(self._parts())
+
+    def _compact_parts(self, parts):
+        """ Compact the given shards, or this store if it has none """
+        with self._flush_lock:
+            if self.engine == "indexed":
+                # Reads are served from the files being rewritten
+                with self._mutex:
+                    JSONModification.compact(self)
+                    self._signature = self._file_signature()
+                return
+            with self._mutex:
+                snapshots = []
+                for part in parts:
+                    # Everything pending is part of the snapshot
+                    snapshots.append((part, dict(part.data),
+                                      dict(part.expires), part.changes))
+                    part._records = []
+                changes = self.changes
+            for part, snapshot, expires, part_changes in snapshots:
+                JSONModification.compact(part, snapshot, expires)
+                part._saved = part_changes
+                part._signature = part._file_signature()
+            if len(parts) == len(self._parts()):
+                self._saved = changes
+
+    def open_snapshot(self):
+        """
+        open_snapshot()
+        Open a JSON data file holding the data as it is now, for reading in
+        binary mode. When the data file is a single JSON file with every
+        change saved, that file is opened: saves rename a new file into
+        place, so the open one never changes. Otherwise the keys are copied
+        under the lock, with the indexed engine only their record offsets,
+        and written one entry at a time to an anonymous temporary file.
+        Expired keys may still be in it, their expiry times are.
+        """
+        self.flush()
+        with self._access():
+            if not self.dirty and not self.wal and not self.shards and \
+                    self.engine == "json" and os.path.exists(self.data_file):
+                handle = open(self.data_file, "rb")
+                if handle.read(1) != _BINARY_SNAPSHOT:
+                    handle.seek(0)
+                    self.metrics.count("snapshot.saved_file")
+                    return handle
+                handle.close()
+            if self.engine == "indexed":
+                items = self.data.frozen_items()
+            else:
+                items = self.data.copy().items()
+            expires = dict(self.expires)
+        handle = tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(self.data_file)))
+        try:
+            handle.write(b'{"version": ' + JSON.encode(__version__) +
+                         b', "data": {')
+            separator = b""
+            for key, value in items:
+                handle.write(separator + JSON.encode(key) + b": " +
+                             JSON.encode(value))
+                separator = b", "
+            handle.write(b"}")
+            if expires:
+                handle.write(b', "expires": ' + JSON.encode(expires))
+            handle.write(b"}")
+            handle.seek(0)
+        except (TypeError, ValueError, IOError, OSError):
+            handle.close()
+            raise ServerError("Snapshot could not be written")
+        self.metrics.count("snapshot.written")
+        return handle
+
+    def close(self):
+        """
+        close()
+        Stop the background flush and write everything still pending.
+        """
+        self._stopped.set()
+        if self._flusher:
+            self._flusher.join()
+        if self._compactor:
+            self._compactor.join()
+        self.flush()
+        for part in self._parts():
+            if self.wal and self.fsync != "never" and part._wal_handle:
+                os.fsync(part._wal_handle.fileno())
+        self._close_wal()
+
+    def execute(self, incoming, received=None):
+        """
+        execute(incoming, received)
+        Run a decoded request and return the response to send back.
+        Raises CommandError for requests that can not be run. The timeout
+        of a request counts from received, the timer() value of when its
+        header arrived, by default from now.
+        """
+        try:
+            command = incoming['command']
+            data = incoming['data']
+        except (KeyError, TypeError) as err:
+            raise CommandError("Invalid request: {0}".format(err))
+        timeout = incoming.get('timeout')
+        if timeout is not None and (isinstance(timeout, bool) or
+                                    not isinstance(timeout, (int, float))):
+            raise CommandError("timeout must be a number of seconds")
+        started = timer()
+        if received is None:
+            received = started
+        try:
+            self._check_deadline(received, timeout)
+            with self._access(command, data):
+                waited = timer() - started
+                self._check_deadline(received, timeout)
+                self._expire(command, data)
+                if "if_version" in incoming:
+                    response = self._conditional(command, data, incoming)
+                else:
+                    response = self._execute(command, data, incoming)
+        except CommandError:
+            self.metrics.count("errors")
+            raise
+        if self.flush_every and self.pending >= self.flush_every:
+            self.flush()
+        # Only known commands get this far, so there are only so many names
+        name = "command.{0}".format(command)
+        self.metrics.count(name)
+        self.metrics.observe(name, timer() - started)
+        self.metrics.observe("lock_wait", waited)
+        self.metrics.dump_due()
+        return response
+
+    def _check_deadline(self, received, timeout):
+        """ Refuse a request that is older than its timeout, the client
+        gave up on it already.
+        """
+        if timeout is None:
+            return
+        elapsed = timer() - received
+        if elapsed > timeout:
+            self.metrics.count("deadline_exceeded")
+            raise CommandError(
+                "Deadline exceeded, {0:.3f} of {1} seconds passed before "
+                "the request could run".format(elapsed, timeout))
+
+    def _conditional(self, command, data, incoming):
+        """
+        _conditional(command, data, incoming)
+        Answer a request carrying if_version with the etag of the data and
+        either the result or not_modified.
+        """
+        if command not in ("get data", "get"):
+            raise CommandError("Only get data and get can be conditional")
+        keys = None if command == "get data" else self._key_list(data)
+        if not self._modified_since(incoming['if_version'], keys):
+            return dict(version=self.etag, not_modified=True)
+        return dict(version=self.etag,
+                    data=self._execute(command, data, incoming))
+
+    # Request command: method running it
+    commands = {
+        "get data": "_get_data",
+        "add data": "_add_data",
+        "get": "_get",
+        "set": "_set",
+        "delete": "_remove",
+        "exists": "_exists",
+        "keys": "_keys",
+        "count": "_count",
+        "query": "_query",
+        "batch": "_batch",
+        "hello": "_hello",
+        "stats": "_stats",
+    }
+
+    def _execute(self, command, data, incoming):
+        try:
+            method = getattr(self, self.commands[command])
+        except (KeyError, TypeError):
+            raise CommandError("Unknown command {0}".format(command))
+        return method(data, incoming)
+
+    @staticmethod
+    def _key_list(data):
+        """ Validate the list of keys a request was sent with """
+        if not isinstance(data, list) or \
+                not all(isinstance(key, _string_types) for key in data):
+            raise CommandError("Expected a list of keys")
+        return data
+
+    #noinspection PyUnusedLocal
+    def _get_data(self, data, incoming):
+        # Return all current data, copied as it is sent after the
+        # data lock is released
+        return self.data.copy()
+
+    def _add_data(self, data, incoming):
+        # update data dict and return incoming as in
+        self._set(data, incoming)
+        return incoming
+
+    #noinspection PyUnusedLocal
+    def _get(self, data, incoming):
+        """ The values of the requested keys that exist """
+        found = dict((key, self.data[key]) for key in self._key_list(data)
+                     if key in self.data)
+        self._touch(found)
+        return found
+
+    def _set(self, data, incoming):
+        """ Update keys without echoing them back, returns the key count.
+        With a ttl in the request the keys expire that many seconds later,
+        without one they are kept until deleted.
+        """
+        if not isinstance(data, dict):
+            raise CommandError("Expected a dictionary of keys and values")
+        self._update(data, self._expiry_times(data, incoming.get('ttl')))
+        return len(data)
+
+    #noinspection PyUnusedLocal
+    def _remove(self, data, incoming):
+        """ Delete keys, missing ones are ignored, returns the number of
+        keys deleted
+        """
+        keys = [key for key in set(self._key_list(data)) if key in self.data]
+        self._delete(keys)
+        return len(keys)
+
+    #noinspection PyUnusedLocal
+    def _exists(self, data, incoming):
+        """ For every requested key whether it exists """
+        return [key in self.data for key in self._key_list(data)]
+
+    #noinspection PyUnusedLocal
+    def _keys(self, data, incoming):
+        """ Sorted keys starting with the prefix sent as data """
+        prefix = data or u""
+        if not isinstance(prefix, _string_types):
+            raise CommandError("Expected a key prefix")
+        return list(self._indexes()[0].scan(prefix=prefix))
+
+    #noinspection PyUnusedLocal
+    def _query(self, data, incoming):
+        """ Keys, and their values, found by a query, see
+        nframe_query.Query
+        """
+        try:
+            query = Query(data)
+        except QueryError as err:
+            raise CommandError(str(err))
+        keys, fields = self._indexes()
+        result = query.run(self.data, keys, fields)
+        if not query.keys_only:
+            self._touch(key for key, _ in result['items'])
+        return result
+
+    #noinspection PyUnusedLocal
+    def _count(self, data, incoming):
+        """ Number of keys """
+        return len(self.data)
+
+    #noinspection PyUnusedLocal
+    def _hello(self, data, incoming):
+        """ Negotiation, returns which of the codecs and compression methods
+        the client offered are available, in the client's order of preference,
+        and the instance and version of this store's data
+        """
+        if not isinstance(data, dict) or \
+                not isinstance(data.get("codecs", []), list) or \
+                not isinstance(data.get("compression", []), list):
+            raise CommandError("Expected a dictionary with lists of codecs "
+                               "and compression methods")
+        return dict(protocol=PROTOCOL_VERSION,
+                    codecs=[name for name in data.get("codecs", [])
+                            if name in CODECS],
+                    compression=[name for name in data.get("compression", [])
+                                 if name in COMPRESSIONS],
+                    instance=self._instance, version=self.version)
+
+    #noinspection PyUnusedLocal
+    def _stats(self, data, incoming):
+        """ Snapshot of the metrics, see nframe_metrics.Metrics.snapshot,
+        with the number of keys, of keys with an expiry time, the bytes the
+        keys take if max_memory is set, the version and the pending changes.
+        In fork mode every worker answers with its own metrics.
+        """
+        return dict(self.metrics.snapshot(), keys=len(self.data),
+                    expiring=len(self.expires), memory=self.memory,
+                    version=self.version, pending=self.pending,
+                    pid=os.getpid())
+
+    #noinspection PyUnusedLocal
+    def _batch(self, data, incoming):
+        """ Run a list of requests in order, all under the same lock and
+        followed by a single flush. A failing request stops the batch, the
+        ones before it stay applied. Returns the results so far and the
+        error, if any.
+        """
+        if not isinstance(data, list):
+            raise CommandError("Expected a list of requests")
+        results = []
+        for index, request in enumerate(data):
+            try:
+                command, request_data = request['command'], request['data']
+                if command == "batch":
+                    raise CommandError("Batches can not be nested")
+                results.append(self._execute(command, request_data, request))
+            except (KeyError, TypeError) as err:
+                error = "Invalid request: {0}".format(err)
+            except CommandError as err:
+                error = str(err)
+            else:
+                continue
+            return dict(results=results,
+                        error=dict(index=index, message=error))
+        return dict(results=results, error=None)
+
+
+class Server(BaseRequestHandler):
     """ Server is a custom Request Handler. This will handle all incoming
-    requests and can store the information in local JSON files for persistent
-    storage.
+    requests and run them against the store of the TCP server, which keeps
+    the information in local JSON files for persistent storage.
     """
 
+    # Seconds a kept alive connection may sit idle before it is closed
+    keep_alive_timeout = 5
+    # Seconds between heartbeats sent to watchers while nothing changes
+    watch_heartbeat = 1.0
+
     def __init__(self, request, client_address, tcpserver):
-        """ Create the CTFServer class and set up custom class attributes."""
-        self.data = {}
-        self.data_file = DATA_FILE
+        """ Create the Server class and set up custom class attributes."""
+        self.store = getattr(tcpserver, "store", None)
+        if self.store is None:
+            # Plain socketserver without a store, write every change through
+            self.store = tcpserver.store = Store(flush_every=1,
+                                                 flush_interval=None)
         self.message = None
-        self._load()
-        self._save()
-        super(Server, self).__init__(request, client_address, tcpserver)
+        self.codec = JSON
+        self.compression = None
+        # timer() value of when the header of the current request arrived
+        self.received = None
+        self.compress_threshold = getattr(tcpserver, "compress_threshold",
+                                          COMPRESS_THRESHOLD)
+        self.max_request_size = getattr(tcpserver, "max_request_size",
+                                        MAX_REQUEST_SIZE)
+        self.request_timeout = getattr(tcpserver, "request_timeout",
+                                       REQUEST_TIMEOUT)
+        BaseRequestHandler.__init__(self, request, client_address, tcpserver)
+
+    def setup(self):
+        set_nodelay(self.request)
 
     def _read(self):
-        """ Retrieve incoming information from the socket. This will
-        deal with large data chunks by reading them in sections and
-        concatenating them back together.
-        """
-        data = self.request.recv(1024).decode('utf-8')
-        recv = json.loads(data)
-        self.request.send("ok".encode("utf-8"))
-        incoming = ""
-        for sec in range(0, recv['sections']):
-            incoming += self.request.recv(1024).decode('utf-8')
-        return json.loads(incoming)
+        """ Retrieve the next request frame from the socket. The response
+        will be encoded with the same codec, and compressed if the request
+        accepts it. Requests larger than max_request_size are refused from
+        their header, once the header arrived the rest has to arrive within
+        request_timeout seconds.
+        """
+        self.request.settimeout(self.keep_alive_timeout)
+        flags, length = unpack_header(recv_exactly(self.request,
+                                                   HEADER.size),
+                                      self.max_request_size)
+        # Waiting for the next request is not part of reading it
+        started = self.received = timer()
+        payload = recv_exactly(self.request, length, self.request_timeout)
+        read = timer()
+        self.compression = accepted_compression(flags)
+        incoming, self.codec = decode_frame(flags, payload,
+                                            self.max_request_size)
+        metrics = self.store.metrics
+        metrics.observe("read", read - started)
+        metrics.observe("decode", timer() - read)
+        metrics.count("bytes_in", HEADER.size + length)
+        return incoming
 
     def _send(self, data):
-        """ Write information to the socket. Break up all incoming data into
-        blocks of 1024 bytes before sending.
+        """ Write a response frame to the socket, taking at most
+        request_timeout seconds per chunk the client accepts.
         """
-        write_data = _bytes(json.dumps(data))
-        data_sections = int(ceil(len(write_data) / 1024.0))
-        sec_data = json.dumps({'sections': data_sections})
-        self.request.send(_bytes(sec_data))
-        self.request.recv(2)
-        for sec in range(0, data_sections):
-            self.request.send(write_data[(1024 * sec):(1024 * (sec + 1))])
+        started = timer()
+        self.request.settimeout(self.request_timeout)
+        sent = send_message(self.request, data, codec=self.codec,
+                            compression=self.compression,
+                            threshold=self.compress_threshold)
+        self.store.metrics.observe("send", timer() - started)
+        self.store.metrics.count("bytes_out", sent)
 
-    @autosave
     def handle(self):
         """
         handle()
-        Overloaded handle function to communicate with client.
-        """
-        # Read data in
-        incoming = self._read()
-        command = incoming['command']
-        data = incoming['data']
-        # do something
-        if command == "get data":
-            # Return all current data
-            return self._send(self.data)
-        else:
-            # update data dict and return incoming as in
-            self.data.update(data)
-            return self._send(incoming)
+        Overloaded handle function to communicate with client. Requests are
+        served one after another until the client closes the connection or
+        leaves it idle for longer than keep_alive_timeout. A server serving
+        one connection at a time closes it after every request but a
+        "hello" instead, so an idle client can not hold up the others.
+        """
+        keep_alive = isinstance(self.server, ThreadingMixIn)
+        while True:
+            try:
+                incoming = self._read()
+            except (ConnectionClosed, socket.error):
+                return
+            except ProtocolError as err:
+                # The stream can not be trusted anymore, drop the client
+                return send_error(self.request,
+                                  "Invalid request: {0}".format(err))
+            except ValueError as err:
+                send_error(self.request, "Invalid request: {0}".format(err))
+                incoming = None
+            else:
+                self._process(incoming)
+            # A hello is followed by the request it negotiated the codec for
+            if not keep_alive and not (isinstance(incoming, dict) and
+                                       incoming.get("command") == "hello"):
+                return
+
+    def _process(self, incoming):
+        """
+        _process(incoming)
+        Run a single request and write the response. The state lock is only
+        held while the store runs the request, not while it is sent.
+        """
+        if isinstance(incoming, dict) and incoming.get("command") == "watch":
+            return self._watch(incoming.get("data"))
+        if isinstance(incoming, dict) and \
+                incoming.get("command") == "snapshot":
+            return self._snapshot()
+        try:
+            response = self.store.execute(incoming, self.received)
+        except CommandError as err:
+            return send_error(self.request, err)
+        try:
+            return self._send(response)
+        except (TypeError, ValueError) as err:
+            return send_error(self.request, "Response can not be encoded "
+                              "with {0}: {1}".format(self.codec.name, err))
+
+
+    def _snapshot(self):
+        """
+        _snapshot()
+        Answer with the data in the JSON data file format, see
+        Store.open_snapshot. The file is the payload of the response frame
+        and copied to the socket by the kernel, it is neither encoded nor
+        compressed.
+        """
+        try:
+            snapshot = self.store.open_snapshot()
+        except ServerError as err:
+            return send_error(self.request, err)
+        started = timer()
+        self.request.settimeout(self.request_timeout)
+        try:
+            sent = send_file_frame(self.request, snapshot,
+                                   JSON.codec_id << CODEC_SHIFT)
+        except socket.error:
+            return
+        finally:
+            snapshot.close()
+        self.store.metrics.observe("send", timer() - started)
+        self.store.metrics.count("bytes_out", sent)
+
+    def _watch(self, data):
+        """
+        _watch(data)
+        Stream change events until the client disconnects. Every frame is a
+        dictionary of the version reached and the list of events since the
+        last frame, the first one and heartbeats have no events. Frames
+        name the instance of the store, which resume tokens carry.
+        """
+        try:
+            if not isinstance(self.server, ThreadingMixIn):
+                raise CommandError("watch needs the thread, fork or async "
+                                   "mode")
+            version, keys = self.store.watch_args(data)
+        except CommandError as err:
+            return send_error(self.request, err)
+        events = []
+        while True:
+            try:
+                self._send(dict(instance=self.store._instance,
+                                version=version, events=events))
+            except socket.error:
+                return
+            events, version = self.store.wait_changes(version, keys,
+                                                      self.watch_heartbeat)
+            if not events:
+                self.store.refresh()
+
+
+class TCPServer(socketserver.TCPServer):
+    """ Single threaded server, serves one connection at a time.
+
+    With max_connections set, connections beyond that many are answered
+    with BUSY_MESSAGE and closed right away, so a burst of clients gets a
+    quick error instead of a slow answer.
+    """
+    allow_reuse_address = True
+    store = None
+    # Smallest response compressed for clients accepting it, None for never
+    compress_threshold = COMPRESS_THRESHOLD
+    # Largest request frame accepted, in bytes
+    max_request_size = MAX_REQUEST_SIZE
+    # Seconds a request may take to arrive and a response to be sent
+    request_timeout = REQUEST_TIMEOUT
+    # Connections served at once, None for no limit
+    max_connections = None
+
+    def __init__(self, *args, **kwargs):
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        socketserver.TCPServer.__init__(self, *args, **kwargs)
+
+    def verify_request(self, request, client_address):
+        with self._connections_lock:
+            if self.max_connections is None or \
+                    len(self._connections) < self.max_connections:
+                self._connections.add(request)
+                return True
+        if self.store is not None:
+            self.store.metrics.count("connections_rejected")
+        try:
+            send_error(request, BUSY_MESSAGE)
+        except socket.error:
+            pass
+        return False
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        socketserver.TCPServer.shutdown_request(self, request)
+
+
+class ThreadedTCPServer(ThreadingMixIn, TCPServer):
+    """ Serves every connection in its own thread """
+    daemon_threads = True
+
+
+class ReusePortTCPServer(ThreadedTCPServer):
+    """ Threaded server sharing its port with other processes through
+    SO_REUSEPORT, the kernel spreads new connections over all of them
+    """
+    def server_bind(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ServerError("SO_REUSEPORT is not available")
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadedTCPServer.server_bind(self)
+
+
+SERVER_MODES = ("single", "thread", "fork", "reuseport", "async")
+
+
+def make_server(address, mode="single", handler=None, store=None,
+                compress_threshold=COMPRESS_THRESHOLD, max_connections=None,
+                max_request_size=MAX_REQUEST_SIZE,
+                request_timeout=REQUEST_TIMEOUT):
+    """
+    make_server(address, mode)
+    Bind a server for the given mode. Forked workers each run a threaded
+    server on the shared listening socket, see serve_forked, and each
+    allow max_connections. A reuseport server binds a port other processes
+    bind as well, see serve_reuseport. The async mode is served by
+    nframe_async instead.
+    """
+    if mode not in SERVER_MODES or mode == "async":
+        raise ServerError("Unknown server mode {0}".format(mode))
+    server_class = dict(single=TCPServer,
+                        reuseport=ReusePortTCPServer).get(mode,
+                                                          ThreadedTCPServer)
+    server = server_class(address, handler or Server)
+    server.store = store or Store(shared=mode == "fork")
+    server.compress_threshold = compress_threshold
+    server.max_connections = max_connections
+    server.max_request_size = max_request_size
+    server.request_timeout = request_timeout
+    return server
+
+
+def _fork_workers(workers, target):
+    """ Fork worker processes running target, returns their pids """
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                target()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    return children
+
+
+def _wait_workers(children):
+    """ Wait for worker processes, terminating them when the parent is
+    interrupted or terminated.
+    """
+    def stop(*_):
+        raise SystemExit()
+
+    previous = signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        signal.signal(signal.SIGTERM, previous)
+
+
+def serve_forked(server, workers):
+    """
+    serve_forked(server, workers)
+    Fork worker processes that all accept connections on the listening
+    socket of server, then wait for them. Workers are terminated when the
+    parent is interrupted or terminated.
+
+    The store of server must be shared, every change is then written
+    through and reloaded by the other workers, see Store. This suits data
+    read far more often than written, serve_reuseport does not have that
+    cost.
+    """
+    _wait_workers(_fork_workers(workers, server.serve_forever))
+
+
+def serve_reuseport(address, workers, make_store,
+                    compress_threshold=COMPRESS_THRESHOLD, indexes=None,
+                    **options):
+    """
+    serve_reuseport(address, workers, make_store, compress_threshold, indexes)
+    Fork worker processes that each accept connections on address through
+    SO_REUSEPORT and keep a replica of the data (see nframe_replica), then
+    wait for them. Workers decode, read and encode in parallel, changes are
+    forwarded to the single store make_store() returns, which this process
+    holds and saves. A worker answers a change once its own copy holds it.
+    The replicas index the fields named in indexes for queries, options
+    are passed on to make_server for the servers of the workers.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ServerError("SO_REUSEPORT is not available")
+    owner = ThreadedTCPServer(("127.0.0.1", 0), Server)
+    directory = tempfile.mkdtemp(prefix="nframe-workers-")
+
+    def work():
+        owner.server_close()
+        _reuseport_worker(address, owner.server_address, directory,
+                          compress_threshold, indexes, **options)
+
+    try:
+        # Forked before the store starts any threads
+        children = _fork_workers(workers, work)
+        owner.store = make_store()
+        runner = threading.Thread(target=owner.serve_forever,
+                                  name="nframe-owner")
+        runner.daemon = True
+        runner.start()
+        try:
+            _wait_workers(children)
+        finally:
+            owner.shutdown()
+            owner.server_close()
+            owner.store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _reuseport_worker(address, owner, directory, compress_threshold,
+                      indexes=None, **options):
+    """ Serve address from a replica of the store at owner """
+    from nframe_replica import Replica
+    replica = Replica(owner, os.path.join(directory, "worker-{0}.json".format(
+        os.getpid())), flush_interval=None, flush_every=0, indexes=indexes)
+    # Connections are only handed to this worker once it listens
+    replica.wait_synced()
+    make_server(address, "reuseport", store=replica,
+                compress_threshold=compress_threshold,
+                **options).serve_forever()
+
+
+EXPORT_FORMATS = ("json", "ndjson")
+
+
+def _export_format(filename, export_format=None):
+    """ Pick the export format, by default from the file extension """
+    if export_format is None:
+        ndjson = os.path.splitext(filename)[1].lower() in (".ndjson", ".jsonl")
+        export_format = "ndjson" if ndjson else "json"
+    if export_format not in EXPORT_FORMATS:
+        raise ServerError("Unknown export format {0}".format(export_format))
+    return export_format
+
+
+class _JSONStream(object):
+    """
+    Reads the items of the data object of an export file without loading
+    the whole file. Only chunk_size characters plus the value being parsed
+    are held in memory.
+    """
+    _whitespace = " \t\n\r"
+
+    def __init__(self, handle, chunk_size=64 * 1024):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """ Read more of the file, dropping what was already parsed """
+        if self.eof:
+            return False
+        chunk = self.handle.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """ Next character that is not whitespace, empty at the end """
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in self._whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of {0!r} at {1!r}".format(
+                chars, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """ Decode the next value, reading more until it is complete. A
+        value ending right at the end of the buffer may continue (numbers),
+        so it is only accepted at the end of the file.
+        """
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill(size):
+                    raise
+            else:
+                if end < len(self.buffer) or not self._fill(size):
+                    self.pos = end
+                    return value
+            # Grow the reads so huge values are not parsed over and over
+            size *= 2
+
+    def items(self):
+        """ Yield every (key, value) of the data object """
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            name = self._value()
+            self._expect(":")
+            if name == "data":
+                self._expect("{")
+                if self._peek() == "}":
+                    self.pos += 1
+                else:
+                    while True:
+                        key = self._value()
+                        self._expect(":")
+                        yield key, self._value()
+                        if self._expect(",}") == "}":
+                            break
+            else:
+                self._value()
+            if self._expect(",}") == "}":
+                return
 
 
 class Data(JSONModification):
@@ -277,42 +2675,109 @@ class Data(JSONModification):
         super(Data, self).__init__(data_file=data_file, **kwargs)
 
     @autosave
-    def export_data(self, filename="export.json"):
+    def export_data(self, filename="export.json", export_format=None):
         """
-        export_data(filename)
-        Save all data to a file that can be imported.
+        export_data(filename, export_format)
+        Save all data to a file that can be imported. The file is written
+        one entry at a time, either as a JSON document ("json") or as a
+        header line followed by one [key, value] line per key ("ndjson").
+        By default the format follows the file extension, .ndjson and
+        .jsonl files are written as ndjson.
         """
-        file_data = {"version": __version__, "data": self.data}
-
+        export_format = _export_format(filename, export_format)
         with open(filename, "w") as data_file:
-            data_file.write(str(json.dumps(file_data, indent=2)))
+            if export_format == "ndjson":
+                data_file.write(json.dumps({"version": __version__}))
+                data_file.write("\n")
+                for key, value in self.data.items():
+                    data_file.write(json.dumps([key, value]))
+                    data_file.write("\n")
+                return
+            data_file.write('{{\n  "version": {0},\n  "data": {{'.format(
+                json.dumps(__version__)))
+            separator = "\n"
+            for key, value in self.data.items():
+                data_file.write("{0}    {1}: {2}".format(
+                    separator, json.dumps(key), json.dumps(value)))
+                separator = ",\n"
+            data_file.write("\n  }\n}\n")
 
     @autosave
-    def import_data(self, filename="export.json"):
+    def import_data(self, filename="export.json", export_format=None,
+                    batch_size=1000):
         """
-        import_data(filename)
-        Add all data in the given file to the data set.
+        import_data(filename, export_format, batch_size)
+        Add all data in the given file to the data set. The file is parsed
+        incrementally and merged in batches of batch_size keys, in wal mode
+        every batch is appended to the log right away.
         """
+        export_format = _export_format(filename, export_format)
         with open(filename, "r") as data_file:
-            file_data = json.loads(data_file.read())
-        self.data.update(file_data['data'])
+            if export_format == "ndjson":
+                header = json.loads(data_file.readline() or "{}")
+                if not isinstance(header, dict):
+                    raise ServerError("Not an nframe ndjson export")
+                items = (json.loads(line) for line in data_file
+                         if line.strip())
+            else:
+                items = _JSONStream(data_file).items()
+            batch = {}
+            for key, value in items:
+                batch[key] = value
+                if len(batch) >= batch_size:
+                    self._import_batch(batch)
+                    batch = {}
+            self._import_batch(batch)
 
-    @autosave
-    def add_data(self, **kwargs):
+    def _import_batch(self, batch):
+        if batch and self._update(batch) and \
+                (self.wal or self.engine == "indexed"):
+            self._save()
+
+    @autosave(keys=lambda args, kwargs: [key for key in kwargs
+                                         if key != "_ttl"])
+    def add_data(self, _ttl=None, **kwargs):
         """
-        add_data()
-        Update the current data dictionary with new information provided
+        add_data(_ttl)
+        Update the current data dictionary with new information provided,
+        with _ttl the keys expire after that many seconds
         """
-        self.data.update(kwargs)
+        self._update(kwargs, self._expiry_times(kwargs, _ttl))
 
-    @autosave
+    @autosave(keys=lambda args, kwargs: args)
     def remove_data(self, *args):
         """
         remove_data()
         Removes the key:value pair based on the provided key(s) in a list
         """
-        for arg in args:
-            del self.data[arg]
+        self._delete(args)
+
+
+#noinspection PyUnusedLocal
+def _terminate(signum, frame):
+    """ Turn SIGTERM into SystemExit so pending changes are flushed """
+    raise SystemExit()
+
+
+def _cpu_count():
+    try:
+        from multiprocessing import cpu_count
+        return cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def _address(text):
+    """ "host:port" to a (host, port) tuple """
+    host, _, port = text.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def _byte_size(text):
+    """ "512", "64K", "512M" or "2G" to a number of bytes """
+    units = dict(K=1024, M=1024 ** 2, G=1024 ** 3)
+    unit = units.get(text[-1:].upper(), 1)
+    return int(float(text[:-1] if unit > 1 else text) * unit)
 
 
 def main(*args):
@@ -323,14 +2788,99 @@ def main(*args):
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument("-i", "--ip", default="0.0.0.0",
                         help="IP address of server")
-    parser.add_argument("-p", "--port", default=7645,
+    parser.add_argument("-p", "--port", default=7645, type=int,
                         help="Port of server")
+    parser.add_argument("--data-file", default=None, dest="data_file",
+                        help="File the data is kept in (default: data.json "
+                             "next to the server, replica-PORT.json for "
+                             "replicas)")
+    parser.add_argument("--pid-file", default=None, dest="pid_file",
+                        help="Lock file making sure only one server uses "
+                             "the data")
+    parser.add_argument("--replica-of", default=None, type=_address,
+                        dest="replica_of", metavar="HOST:PORT",
+                        help="Serve reads from a copy of the data of this "
+                             "server, kept up to date by watching it, and "
+                             "forward writes to it")
+    parser.add_argument("--mode", default="single", choices=SERVER_MODES,
+                        help="Serve connections one at a time, in threads, "
+                             "in forked worker processes, in worker "
+                             "processes with a replica each that share the "
+                             "port and send changes to this process, or on "
+                             "an asyncio event loop")
+    parser.add_argument("--workers", default=None, type=int,
+                        help="Number of worker processes in fork and "
+                             "reuseport mode (default: number of CPUs)")
+    parser.add_argument("--flush-interval", default=1.0, type=float,
+                        help="Seconds between writes of changed data to "
+                             "disk, 0 to only write on --flush-every")
+    parser.add_argument("--flush-every", default=1000, type=int,
+                        help="Write to disk once this many changes are "
+                             "pending, 1 writes every change through")
+    parser.add_argument("--wal", action="store_true", default=False,
+                        help="Append changes to a write ahead log instead "
+                             "of rewriting the data file")
+    parser.add_argument("--fsync", default="never",
+                        help="When to fsync the write ahead log: always, "
+                             "never or every N milliseconds")
+    parser.add_argument("--storage-codec", default="json",
+                        choices=sorted(CODECS), dest="storage_codec",
+                        help="Encoding of the data file and write ahead log, "
+                             "binary is needed to store bytes values")
+    parser.add_argument("--engine", default="json", choices=ENGINES,
+                        help="Keep the data in one JSON file, or in an "
+                             "indexed record file read on demand")
+    parser.add_argument("--shards", default=1, type=int,
+                        help="Spread the keys over this many shard files, "
+                             "each saved and locked on its own")
+    parser.add_argument("--index", action="append", default=[],
+                        dest="indexes", metavar="FIELD",
+                        help="Index this field of the values for queries, "
+                             "\"a.b\" is field b of field a, can be given "
+                             "more than once")
+    parser.add_argument("--max-keys", default=None, type=int,
+                        dest="max_keys",
+                        help="Delete the least recently used keys once there "
+                             "are more than this many")
+    parser.add_argument("--max-memory", default=None, type=_byte_size,
+                        dest="max_memory",
+                        help="Delete the least recently used keys once keys "
+                             "and values take more than this many bytes, "
+                             "K, M and G suffixes are understood")
+    parser.add_argument("--compress-threshold", default=COMPRESS_THRESHOLD,
+                        type=int, dest="compress_threshold",
+                        help="Compress responses of at least this many bytes "
+                             "for clients accepting it, 0 to never compress")
+    parser.add_argument("--max-connections", default=None, type=int,
+                        dest="max_connections",
+                        help="Turn away connections beyond this many with "
+                             "an error, per worker in fork and reuseport "
+                             "mode")
+    parser.add_argument("--max-request-size", default=MAX_REQUEST_SIZE,
+                        type=_byte_size, dest="max_request_size",
+                        help="Refuse requests larger than this many bytes, "
+                             "K, M and G suffixes are understood")
+    parser.add_argument("--request-timeout", default=REQUEST_TIMEOUT,
+                        type=float, dest="request_timeout",
+                        help="Seconds a request may take to arrive once it "
+                             "started, and a response to be sent")
+    parser.add_argument("--stats-file", default=None, dest="stats_file",
+                        help="Write the metrics of the stats command to this "
+                             "file, {pid} is replaced with the process id")
+    parser.add_argument("--stats-interval", default=60.0, type=float,
+                        dest="stats_interval",
+                        help="Seconds between writes of --stats-file")
     parser.add_argument("--import", action="store",
                         default=False, dest="import_file",
                         help="Import data before starting server")
     parser.add_argument("--export", action="store",
                         default=False, dest="export_file",
                         help="Export data then exits")
+    parser.add_argument("--format", default=None, choices=EXPORT_FORMATS,
+                        dest="export_format",
+                        help="Format of the import and export files "
+                             "(default: ndjson for .ndjson and .jsonl files, "
+                             "json otherwise)")
     parser.add_argument("--force-unlock", action="store_true", default=False,
                         help="Remove lock file without discretion",
                         dest="force_unlock")
@@ -339,27 +2889,92 @@ def main(*args):
                         dest="exit")
 
     pargs = parser.parse_args(args) if args else parser.parse_args()
+    if (pargs.max_keys or pargs.max_memory) and \
+            (pargs.mode == "fork" or pargs.replica_of):
+        parser.error("--max-keys and --max-memory can not be used in fork "
+                     "mode or by a replica")
+    if pargs.replica_of:
+        if pargs.mode == "fork":
+            parser.error("a replica can not run in fork mode, start more "
+                         "replicas instead")
+        pargs.data_file = pargs.data_file or os.path.join(
+            os.path.dirname(DATA_FILE), "replica-{0}.json".format(pargs.port))
+        pargs.pid_file = pargs.pid_file or os.path.join(
+            tempfile.gettempdir(), "nframe-{0}.pid".format(pargs.port))
+    pargs.data_file = pargs.data_file or DATA_FILE
+    pargs.pid_file = pargs.pid_file or LOCK_FILE
 
     if pargs.force_unlock:
-        Lock().force_release()
+        Lock(pargs.pid_file).force_release()
 
     if pargs.import_file:
-        with Data(timeout=5) as import_data:
-            import_data.import_data(pargs.import_file)
+        with Data(pargs.data_file, pid_file=pargs.pid_file, timeout=5,
+                  wal=pargs.wal, fsync=pargs.fsync,
+                  codec=pargs.storage_codec,
+                  shards=pargs.shards, engine=pargs.engine) as import_data:
+            import_data.import_data(pargs.import_file, pargs.export_format)
 
     if pargs.export_file:
-        with Data(timeout=5) as export_data:
-            export_data.export_data(pargs.export_file)
+        with Data(pargs.data_file, pid_file=pargs.pid_file, timeout=5,
+                  wal=pargs.wal, fsync=pargs.fsync,
+                  codec=pargs.storage_codec, shards=pargs.shards,
+                  engine=pargs.engine, exclusive=False) as export_data:
+            export_data.export_data(pargs.export_file, pargs.export_format)
         return
 
-    server = TCPServer((pargs.ip, pargs.port), Server)
     if pargs.exit:
         return pargs
-    with Lock(timeout=5):
+
+    signal.signal(signal.SIGTERM, _terminate)
+    threshold = pargs.compress_threshold or None
+    limits = dict(max_connections=pargs.max_connections,
+                  max_request_size=pargs.max_request_size,
+                  request_timeout=pargs.request_timeout)
+    with FileLock(pargs.pid_file, timeout=5):
+        options = dict(flush_interval=pargs.flush_interval,
+                       flush_every=pargs.flush_every,
+                       wal=pargs.wal, fsync=pargs.fsync,
+                       codec=pargs.storage_codec, shards=pargs.shards,
+                       engine=pargs.engine, indexes=pargs.indexes,
+                       metrics=Metrics(pargs.stats_file,
+                                       pargs.stats_interval))
+        if pargs.replica_of:
+            from nframe_replica import Replica
+            make_store = partial(Replica, pargs.replica_of, pargs.data_file,
+                                 **options)
+        else:
+            make_store = partial(Store, pargs.data_file,
+                                 shared=pargs.mode == "fork",
+                                 max_keys=pargs.max_keys,
+                                 max_memory=pargs.max_memory, **options)
+        if pargs.mode == "reuseport":
+            try:
+                serve_reuseport((pargs.ip, pargs.port),
+                                pargs.workers or _cpu_count(), make_store,
+                                threshold, pargs.indexes, **limits)
+            except (SystemError, SystemExit, KeyboardInterrupt):
+                pass
+            return
+        store = make_store()
         try:
-            server.serve_forever()
+            if pargs.mode == "async":
+                from nframe_async import serve
+                serve(pargs.ip, pargs.port, store, threshold, **limits)
+            else:
+                server = make_server((pargs.ip, pargs.port), pargs.mode,
+                                     store=store, compress_threshold=threshold,
+                                     **limits)
+                try:
+                    if pargs.mode == "fork":
+                        serve_forked(server, pargs.workers or _cpu_count())
+                    else:
+                        server.serve_forever()
+                finally:
+                    server.server_close()
         except (SystemError, SystemExit, KeyboardInterrupt):
-            server.server_close()
+            pass
+        finally:
+            store.close()
 
 
 if __name__ == '__main__':
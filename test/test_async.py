@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from unittest import TestCase, skipIf
+import json
+import os
+import sys
+from nframe_server import Store
+from nframe_client import Client
+from nframe_protocol import RemoteError, pack_header, decode_message
+
+# nframe_async needs asyncio of Python 3.7
+if sys.version_info >= (3, 7):
+    import asyncio
+    from nframe_async import AsyncServer, AsyncClient, read_frame
+
+loc = os.path.abspath(os.path.dirname(__file__))
+
+data_file = os.path.join(loc, "async_data.json")
+server_port = 6768
+
+
+@skipIf(sys.version_info < (3, 7), "nframe_async needs Python 3.7")
+class AsyncInteraction(TestCase):
+
+    def setUp(self):
+        if os.path.exists(data_file):
+            os.unlink(data_file)
+
+    def tearDown(self):
+        for name in (data_file, "{0}.lock".format(data_file)):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def run_against_server(self, scenario, **options):
+        async def run():
+            server = AsyncServer(Store(data_file), **options)
+            await server.start("localhost", server_port)
+            try:
+                await scenario()
+            finally:
+                await server.close()
+                server.store.close()
+        asyncio.run(run())
+
+    def test_message(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port)
+            msg = await conn.message(dict(async_data="example"))
+            assert msg['data'] == dict(async_data="example")
+            assert (await conn.get_data())['async_data'] == "example"
+        self.run_against_server(scenario)
+
+    def test_gather(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port, persistent=True)
+            results = await asyncio.gather(*[
+                conn.message({"key {0}".format(i): i}) for i in range(50)])
+            assert [r['data'] for r in results] == [
+                {"key {0}".format(i): i} for i in range(50)]
+            data = await conn.get_data()
+            assert all(data["key {0}".format(i)] == i for i in range(50))
+            assert 0 < len(conn._idle) <= conn.pool_size
+            conn.close()
+        self.run_against_server(scenario)
+
+    def test_invalid_request(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port)
+            try:
+                await conn._communicate("add data", ["not", "a", "dict"])
+            except RemoteError:
+                pass
+            else:
+                assert False, "Invalid data should raise"
+        self.run_against_server(scenario)
+
+    def test_compressed_response(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port, compression="zlib")
+            await conn.set({"big": "x" * 100000})
+            assert (await conn.get("big"))['big'] == "x" * 100000
+        self.run_against_server(scenario)
+
+    def test_watch(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port)
+            events = conn.watch(keys=["watched"])
+            first = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0.2)
+            await conn.set({"watched": 1, "other": 2})
+            event = await asyncio.wait_for(first, 5)
+            assert event['op'] == "update"
+            assert event['data'] == {"watched": 1}
+            await events.aclose()
+        self.run_against_server(scenario)
+
+    def test_limits(self):
+        async def scenario():
+            conn = AsyncClient(port=server_port, persistent=True)
+            assert await conn.set({"small": 1}) == 1
+            try:
+                await conn.set({"big": "x" * 2000})
+            except RemoteError as err:
+                assert "exceeds the limit" in str(err)
+            else:
+                assert False, "Oversized request should be refused"
+            held = await asyncio.open_connection("localhost", server_port)
+            await conn.count()
+            reader, writer = await asyncio.open_connection("localhost",
+                                                           server_port)
+            try:
+                decode_message(*await read_frame(reader))
+            except RemoteError as err:
+                assert "busy" in str(err)
+            else:
+                assert False, "Connections beyond the limit should be refused"
+            writer.close()
+            # A started request has request_timeout seconds to arrive
+            held[1].write(pack_header(100))
+            assert await asyncio.wait_for(held[0].read(), 5) == b""
+            conn.close()
+        self.run_against_server(scenario, max_connections=2,
+                                max_request_size=1024, request_timeout=0.2)
+
+    def test_snapshot(self):
+        snapshot_file = os.path.join(loc, "async_snapshot.json")
+
+        async def scenario():
+            await AsyncClient(port=server_port).set({"a": 1, "b": [2]})
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, Client(
+                port=server_port).download_snapshot, snapshot_file)
+            with open(snapshot_file, "rb") as handle:
+                assert json.loads(handle.read().decode("utf-8"))['data'] == \
+                    {"a": 1, "b": [2]}
+        try:
+            self.run_against_server(scenario)
+        finally:
+            if os.path.exists(snapshot_file):
+                os.unlink(snapshot_file)
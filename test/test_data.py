@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from nframe_server import Data, Lock, main
+from nframe_server import (Data, Lock, Store, ServerError, CommandError,
+                           main, _JSONStream)
+from nframe_metrics import timer
+from io import StringIO
+from glob import glob
 import os
 from json import loads, dumps
 import sys
 from unittest import TestCase
 from functools import partial
+from time import sleep
+from threading import Event, Thread
 
 loc = os.path.abspath(os.path.dirname(__file__))
 
@@ -100,7 +106,855 @@ class TestUsers(TestCase):
 
         os.unlink(export_file)
 
+    def test_no_op_update_not_saved(self):
+        with Data(data_file, pid_file=lock_file) as users:
+            users.add_data(same="value", number=1)
+            before = os.stat(data_file).st_ino
+            users.add_data(same="value")
+            assert not users.dirty
+            users.add_data(same=u"value")
+            assert not users.dirty
+            assert os.stat(data_file).st_ino == before
+            users.add_data(number=True)
+            assert os.stat(data_file).st_ino != before
+        with Data(data_file, pid_file=lock_file) as users:
+            assert users.data['number'] is True
+
+    def test_context_does_not_rewrite(self):
+        with Data(data_file, pid_file=lock_file) as users:
+            before = os.stat(data_file).st_ino
+            users.export_data("test_export")
+        assert os.stat(data_file).st_ino == before
+        os.unlink("test_export")
+
+    def test_streaming_formats(self):
+        values = {"text": "line\nbreak", "number": 12345678901234567890,
+                  "nested": {"a": [1, 2.5, None, True]}, "empty": {},
+                  u"uni\u00e7ode": u"\u2603"}
+        with Data(data_file, pid_file=lock_file) as users:
+            users.add_data(**values)
+        for export_file in ("test_export.json", "test_export.ndjson"):
+            with Data(data_file, pid_file=lock_file) as users:
+                users.export_data(export_file)
+            with open(export_file) as exported:
+                content = exported.read()
+            if export_file.endswith(".json"):
+                assert loads(content)['data'] == values
+            else:
+                assert len(content.splitlines()) == len(values) + 1
+            os.unlink(data_file)
+            with Data(data_file, pid_file=lock_file) as users:
+                users.import_data(export_file, batch_size=2)
+                assert users.data == values
+            os.unlink(export_file)
+
+    def test_stream_chunk_boundaries(self):
+        document = dumps({"version": "0.1", "data": {
+            "number": 1234567, "long": "x" * 100, "list": list(range(30))},
+            "after": [1, 2]}, indent=1)
+        if not isinstance(document, type(u"")):
+            # Python 2 dumps to bytes, StringIO only takes text
+            document = document.decode("utf-8")
+        for chunk_size in (1, 3, 7, 64):
+            items = dict(_JSONStream(StringIO(document), chunk_size).items())
+            assert items == loads(document)['data'], chunk_size
+        assert list(_JSONStream(StringIO(u'{"data": {}}')).items()) == []
+        self.assertRaises(ValueError, list,
+                          _JSONStream(StringIO(u'{"data": {"a": 1')).items())
+
     def test_main_import_export(self):
         main("--force-unlock", "--export", "test_data")
         main("--force-unlock", "--import", "test_data", "--exit")
-        os.unlink("test_data")
\ No newline at end of file
+        os.unlink("test_data")
+
+
+class TestStore(TestCase):
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in (data_file, "{0}.wal".format(data_file)):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    @staticmethod
+    def on_disk():
+        with open(data_file, 'rb') as test_data:
+            return loads(test_data.read().decode('utf-8'))['data']
+
+    def test_write_behind(self):
+        store = Store(data_file, flush_interval=None, flush_every=3)
+        store.execute(dict(command="add data", data=dict(a=1)))
+        store.execute(dict(command="add data", data=dict(b=2)))
+        assert store.pending == 2
+        assert self.on_disk() == {}
+        assert store.execute(dict(command="get data", data=None)) == \
+            dict(a=1, b=2)
+        store.execute(dict(command="add data", data=dict(c=3)))
+        assert store.pending == 0
+        assert self.on_disk() == dict(a=1, b=2, c=3)
+        store.close()
+
+    def test_read_only_requests_not_pending(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="get data", data=None))
+        assert store.pending == 0
+        store.close()
+
+    def test_no_op_requests_not_pending(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="add data", data=dict(a=1)))
+        store.flush()
+        before = os.stat(data_file).st_ino
+        store.execute(dict(command="add data", data=dict(a=1)))
+        assert store.pending == 0
+        store.close()
+        assert os.stat(data_file).st_ino == before
+
+    def test_batch_single_flush(self):
+        store = Store(data_file, flush_interval=None, flush_every=2)
+        response = store.execute(dict(command="batch", data=[
+            dict(command="set", data=dict(a=1)),
+            dict(command="set", data=dict(b=2)),
+            dict(command="set", data=dict(c=3))]))
+        assert response == dict(results=[1, 1, 1], error=None)
+        assert store.pending == 0
+        assert self.on_disk() == dict(a=1, b=2, c=3)
+        store.close()
+
+    def test_close_flushes(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="add data", data=dict(closing=True)))
+        assert "closing" not in self.on_disk()
+        store.close()
+        assert self.on_disk() == dict(closing=True)
+
+    def test_deadline(self):
+        store = Store(data_file, flush_interval=None)
+        request = dict(command="count", data=None, timeout=0.5)
+        self.assertRaises(CommandError, store.execute, request,
+                          timer() - 1)
+        assert store.execute(request, timer()) == 0
+        assert store.metrics.snapshot()['counters'][
+            'deadline_exceeded'] == 1
+        store.close()
+
+    def test_unstorable_value(self):
+        store = Store(data_file, flush_interval=None)
+        self.assertRaises(CommandError, store.execute,
+                          dict(command="set", data=dict(raw=bytearray(2))))
+        assert "raw" not in store.data
+        store.close()
+
+    def test_flush_retried(self):
+        store = Store(data_file, flush_interval=0.05, wal=True)
+        save = store._save
+
+        def fail_once(*args):
+            store._save = save
+            raise ServerError("Data could not be saved")
+        store._save = fail_once
+        store.execute(dict(command="set", data=dict(retried=1)))
+        sleep(0.5)
+        assert store.metrics.snapshot()['counters']['flush_errors'] == 1
+        assert store.pending == 0
+        store.execute(dict(command="set", data=dict(later=2)))
+        store.close()
+        store = Store(data_file, flush_interval=None, wal=True)
+        assert store.data == dict(retried=1, later=2)
+        store.close()
+
+    def test_interval_flush(self):
+        store = Store(data_file, flush_interval=0.05)
+        store.execute(dict(command="add data", data=dict(timed=True)))
+        sleep(0.5)
+        assert self.on_disk() == dict(timed=True)
+        store.close()
+
+    def test_loaded_once(self):
+        with Data(data_file, pid_file=lock_file) as users:
+            users.add_data(preloaded=1)
+        store = Store(data_file, flush_interval=None)
+        os.unlink(data_file)
+        assert store.execute(dict(command="get data", data=None)) == \
+            dict(preloaded=1)
+        store.close()
+
+    def test_changelog(self):
+        store = Store(data_file, flush_interval=None, changelog_size=3)
+        store.execute(dict(command="set", data=dict(a=1, b=2)))
+        store.execute(dict(command="set", data=dict(a=1)))
+        store.execute(dict(command="delete", data=["b"]))
+        assert store.version == 2
+        events, version = store.changes_since(0)
+        assert version == 2
+        assert events == [dict(op="update", data=dict(a=1, b=2), version=1),
+                          dict(op="delete", keys=["b"], version=2)]
+        assert store.changes_since(0, keys={"a"})[0] == [
+            dict(op="update", data=dict(a=1), version=1)]
+        assert store.changes_since(2) == ([], 2)
+        for i in range(3):
+            store.execute(dict(command="set", data=dict(c=i)))
+        assert store.changes_since(0)[0] == [dict(op="reset", version=5)]
+        assert store.changes_since(9)[0] == [dict(op="reset", version=5)]
+        assert store.wait_changes(5, timeout=0.01) == ([], 5)
+        for since in ("1", 1, "a:b"):
+            self.assertRaises(CommandError, store.watch_args,
+                              dict(since=since))
+        assert store.watch_args(dict(since=store.etag)) == (5, None)
+        # A version of another run says nothing about the changes since
+        version, _ = store.watch_args(dict(since="other:3", keys=["c"]))
+        assert store.changes_since(version)[0] == [dict(op="reset",
+                                                        version=5)]
+        store.close()
+
+    def test_conditional_get(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="set", data=dict(a=1, b=2)))
+        first = store.execute(dict(command="get", data=["a"],
+                                   if_version=None))
+        assert first['data'] == dict(a=1)
+        assert store.execute(dict(command="get", data=["a"],
+                                  if_version=first['version'])) == \
+            dict(version=first['version'], not_modified=True)
+        store.execute(dict(command="set", data=dict(b=3)))
+        # Only the version of b changed
+        assert store.execute(dict(command="get", data=["a"],
+                                  if_version=first['version'])
+                             )['not_modified']
+        answer = store.execute(dict(command="get data", data=None,
+                                    if_version=first['version']))
+        assert answer['data'] == dict(a=1, b=3)
+        assert answer['version'] != first['version']
+        assert store.execute(dict(command="get", data=["a"],
+                                  if_version="other:1"))['data'] == dict(a=1)
+        self.assertRaises(CommandError, store.execute,
+                          dict(command="count", data=None, if_version=None))
+        store.close()
+
+    def test_key_versions_of_deleted_keys(self):
+        store = Store(data_file, flush_interval=None, max_keys=2)
+        store.execute(dict(command="set", data=dict(a=1)))
+        etag = store.etag
+        store.execute(dict(command="set", data=dict(b=2)))
+        store.execute(dict(command="delete", data=["b"]))
+        assert sorted(store._key_versions) == ["a"]
+        # A key without a version counts as changed by the last delete
+        assert store.execute(dict(command="get", data=["b"],
+                                  if_version=etag))['data'] == {}
+        etag = store.etag
+        assert store.execute(dict(command="get", data=["b"],
+                                  if_version=etag))['not_modified']
+        for key in "cde":
+            store.execute(dict(command="set", data={key: 1}))
+        store.execute(dict(command="set", data=dict(f=1), ttl=0.01))
+        sleep(0.05)
+        store.execute(dict(command="count", data=None))
+        assert sorted(store._key_versions) == sorted(store.data) == ["e"]
+        store.close()
+
+    def test_etags_per_process(self):
+        store = Store(data_file, flush_interval=None, shared=True)
+        etag = store.etag
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write, store.etag.encode('ascii'))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        forked = os.read(read, 100).decode('ascii')
+        os.close(read)
+        os.close(write)
+        # A forked worker counts versions of its own
+        assert forked.split(":")[1] == etag.split(":")[1]
+        assert forked.split(":")[0] != etag.split(":")[0]
+        assert store.etag == etag
+        store.close()
+
+    def test_stats(self):
+        store = Store(data_file, flush_interval=None, flush_every=1)
+        store.execute(dict(command="set", data=dict(a=1)))
+        store.execute(dict(command="get", data=["a"]))
+        self.assertRaises(CommandError, store.execute,
+                          dict(command="unknown", data=None))
+        stats = store.execute(dict(command="stats", data=None))
+        assert stats['keys'] == 1 and stats['version'] == 1
+        assert stats['counters']['command.set'] == 1
+        assert stats['counters']['errors'] == 1
+        assert stats['counters']['saved_bytes'] > 0
+        assert "command.unknown" not in stats['counters']
+        assert stats['latency']['save']['count'] >= 1
+        assert stats['latency']['lock_wait']['count'] == 2
+        store.close()
+
+    def test_shared_stores(self):
+        first = Store(data_file, shared=True)
+        second = Store(data_file, shared=True)
+        first.execute(dict(command="add data", data=dict(first=1)))
+        second.execute(dict(command="add data", data=dict(second=2)))
+        assert first.execute(dict(command="get data", data=None)) == \
+            dict(first=1, second=2)
+        assert self.on_disk() == dict(first=1, second=2)
+
+
+
+class TestExpiry(TestCase):
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in glob("{0}*".format(data_file)) + [lock_file]:
+            if os.path.exists(name):
+                os.chmod(name, 0o0777)
+                os.unlink(name)
+
+    def test_ttl(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="set", data=dict(short=1), ttl=0.05))
+        store.execute(dict(command="set", data=dict(kept=2)))
+        assert store.execute(dict(command="get", data=["short"])) == \
+            dict(short=1)
+        sleep(0.1)
+        assert store.execute(dict(command="get", data=["short"])) == {}
+        assert store.execute(dict(command="count", data=None)) == 1
+        assert store.changelog[-1]['op'] == "delete"
+        stats = store.execute(dict(command="stats", data=None))
+        assert stats['counters']['expired'] == 1 and stats['expiring'] == 0
+        for ttl in (0, -1, "1", True):
+            self.assertRaises(CommandError, store.execute,
+                              dict(command="set", data=dict(a=1), ttl=ttl))
+        store.close()
+
+    def test_rewrite_drops_ttl(self):
+        store = Store(data_file, flush_interval=None)
+        store.execute(dict(command="set", data=dict(a=1), ttl=0.05))
+        store.execute(dict(command="set", data=dict(a=1)))
+        assert store.pending == 2 and not store.expires
+        sleep(0.1)
+        assert store.execute(dict(command="get", data=["a"])) == dict(a=1)
+        store.close()
+
+    def test_saved_and_loaded(self):
+        store = Store(data_file, flush_interval=None, flush_every=1)
+        store.execute(dict(command="set", data=dict(a=1, b=2), ttl=60))
+        store.execute(dict(command="set", data=dict(gone=3), ttl=0.05))
+        store.close()
+        with open(data_file, 'rb') as test_data:
+            assert set(loads(test_data.read().decode('utf-8'))
+                       ['expires']) == set(["a", "b", "gone"])
+        sleep(0.1)
+        store = Store(data_file, flush_interval=None)
+        assert sorted(store.expires) == ["a", "b"]
+        assert store.execute(dict(command="keys", data="")) == ["a", "b"]
+        store.close()
+
+    def test_log_and_shards(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(_ttl=60, logged=1)
+            users.add_data(_ttl=0.05, short=2)
+        sleep(0.1)
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(logged=1)
+            assert list(users.expires) == ["logged"]
+        with Data(data_file, pid_file=lock_file, shards=4) as users:
+            assert users.data.copy() == dict(logged=1)
+            assert list(users.expires) == ["logged"]
+            users.add_data(_ttl=60, **dict(("key {0}".format(i), i)
+                                          for i in range(20)))
+        with Data(data_file, pid_file=lock_file) as users:
+            assert len(users.expires) == 21
+            users.add_data(ttl=1)
+            assert users.data['ttl'] == 1
+            assert "ttl" not in users.expires
+            for ttl in (0, "1", True):
+                self.assertRaises(ServerError, users.add_data, _ttl=ttl, a=1)
+
+    def test_background_sweep(self):
+        store = Store(data_file, flush_interval=0.05, expire_batch=3)
+        store.execute(dict(command="set", data=dict(
+            ("key {0}".format(i), i) for i in range(10)), ttl=0.01))
+        store.execute(dict(command="set", data=dict(kept=1)))
+        sleep(0.3)
+        assert store.data == dict(kept=1)
+        store.close()
+
+    def test_max_keys(self):
+        store = Store(data_file, flush_interval=None, max_keys=3)
+        for key, value in (("a", 1), ("b", 2), ("c", 3)):
+            store.execute(dict(command="set", data={key: value}))
+        store.execute(dict(command="get", data=["a"]))
+        store.execute(dict(command="set", data=dict(d=4)))
+        assert sorted(store.data) == ["a", "c", "d"]
+        stats = store.execute(dict(command="stats", data=None))
+        assert stats['counters']['evicted'] == 1
+        store.close()
+        store = Store(data_file, flush_interval=None, max_keys=2)
+        assert len(store.data) == 2
+        store.close()
+
+    def test_max_memory(self):
+        store = Store(data_file, flush_interval=None, max_memory=100)
+        for index in range(10):
+            store.execute(dict(command="set", data={
+                "key {0}".format(index): "x" * 20}))
+        assert 0 < store.memory <= 100
+        assert "key 9" in store.data and "key 0" not in store.data
+        store.execute(dict(command="delete", data=["key 9"]))
+        assert store.memory == sum(store._sizes.values())
+        store.close()
+
+    def test_bad_limits(self):
+        self.assertRaises(ServerError, Store, data_file, shared=True,
+                          max_keys=10)
+        self.assertRaises(ServerError, Store, data_file, engine="indexed",
+                          max_memory=10)
+
+
+class TestWriteAheadLog(TestCase):
+
+    wal_file = "{0}.wal".format(data_file)
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in (data_file, self.wal_file, lock_file):
+            if os.path.exists(name):
+                os.chmod(name, 0o0777)
+                os.unlink(name)
+
+    def wal_records(self):
+        with open(self.wal_file, 'rb') as wal:
+            return [loads(line.decode('utf-8')) for line in wal][1:]
+
+    def test_changes_are_appended(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(logged=1)
+            users.add_data(other=2)
+            users.remove_data('other')
+        with open(data_file, 'rb') as test_data:
+            assert loads(test_data.read().decode('utf-8'))['data'] == {}
+        assert self.wal_records() == [
+            dict(op="update", data=dict(logged=1)),
+            dict(op="update", data=dict(other=2)),
+            dict(op="delete", keys=["other"])]
+
+    def test_replay(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(replayed=1)
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(replayed=1)
+        # Loading without wal mode still sees the log, saving folds it in
+        with Data(data_file, pid_file=lock_file) as users:
+            assert users.data == dict(replayed=1)
+            users.add_data(folded=2)
+        assert not os.path.exists(self.wal_file)
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(replayed=1, folded=2)
+
+    def test_torn_record(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(complete=1)
+        with open(self.wal_file, 'ab') as wal:
+            wal.write(b'{"op": "update", "da')
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(complete=1)
+
+    def test_writes_after_torn_record(self):
+        users = Data(data_file, pid_file=lock_file, wal=True)
+        users.add_data(a=1)
+        users.add_data(b=2)
+        with open(self.wal_file, 'ab') as wal:
+            wal.write(b'{"op": "update", "da')
+        users.add_data(c=3)
+        users.add_data(e=4)
+        assert users.data == dict(a=1, b=2, c=3, e=4)
+        users._close_wal()
+        assert self.wal_records()[-2:] == [dict(op="update", data=dict(c=3)),
+                                           dict(op="update", data=dict(e=4))]
+        fresh = Data(data_file, wal=True)
+        fresh._load()
+        assert fresh.data == dict(a=1, b=2, c=3, e=4)
+
+    def test_writes_after_torn_binary_record(self):
+        users = Data(data_file, pid_file=lock_file, wal=True, codec="binary")
+        users.add_data(a=1)
+        users.add_data(b=2)
+        with open(self.wal_file, 'ab') as wal:
+            wal.write(b"\x20\x00\x00\x00\x08\x02")
+        users.add_data(c=3)
+        users._close_wal()
+        fresh = Data(data_file, wal=True, codec="binary")
+        fresh._load()
+        assert fresh.data == dict(a=1, b=2, c=3)
+
+    def test_compact(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(compacted=1)
+            users.compact()
+            assert self.wal_records() == []
+        with open(data_file, 'rb') as test_data:
+            file_data = loads(test_data.read().decode('utf-8'))
+        assert file_data['data'] == dict(compacted=1)
+        assert file_data['wal'] == 1
+
+    def test_stale_log_skipped(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(key="old")
+        with open(self.wal_file, 'rb') as wal:
+            stale = wal.read()
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(key="new")
+            users.compact()
+        # Crash between writing the data file and resetting the log
+        with open(self.wal_file, 'wb') as wal:
+            wal.write(stale)
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(key="new")
+
+    def test_loads_appended_records(self):
+        first = Data(data_file, pid_file=lock_file, wal=True)
+        second = Data(data_file, pid_file=lock_file, wal=True)
+        first.add_data(a=1)
+        first.add_data(b=2)
+        second.add_data(c=3)
+        reads = []
+        read_file = first._read_file
+        first._read_file = lambda name: reads.append(name) or read_file(name)
+        first.add_data(d=4)
+        assert first.data == dict(a=1, b=2, c=3, d=4)
+        assert reads == []
+        second.add_data(e=5)
+        second.compact()
+        first.add_data(f=6)
+        assert reads == [data_file]
+        assert first.data == dict(a=1, b=2, c=3, d=4, e=5, f=6)
+
+    def test_bad_fsync(self):
+        self.assertRaises(ServerError, Data, data_file, fsync="sometimes")
+
+    def test_binary_storage(self):
+        with Data(data_file, pid_file=lock_file, wal=True,
+                  codec="binary") as users:
+            users.add_data(raw=b"\x00\x01", floats=[0.5, 1.5])
+            users.remove_data("floats")
+            users.add_data(after=1)
+        with open(data_file, 'rb') as test_data:
+            assert test_data.read(1) == b"\x08"
+        # The format of existing files is detected
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            assert users.data == dict(raw=b"\x00\x01", after=1)
+            users.add_data(json_record=2)
+        with Data(data_file, pid_file=lock_file, codec="binary") as users:
+            assert users.data == dict(raw=b"\x00\x01", after=1,
+                                      json_record=2)
+
+    def test_torn_binary_record(self):
+        with Data(data_file, pid_file=lock_file, wal=True,
+                  codec="binary") as users:
+            users.add_data(complete=1)
+        with open(self.wal_file, 'ab') as wal:
+            wal.write(b"\x20\x00\x00\x00\x08\x02")
+        with Data(data_file, pid_file=lock_file, wal=True,
+                  codec="binary") as users:
+            assert users.data == dict(complete=1)
+
+    def test_interval_fsync(self):
+        synced = []
+        fsync = os.fsync
+        os.fsync = lambda fd: synced.append(fd) or fsync(fd)
+        try:
+            store = Store(data_file, flush_interval=0.05, flush_every=1,
+                          wal=True, fsync=200)
+            for i in range(0, 3):
+                store.execute(dict(command="add data",
+                                   data={"key {0}".format(i): i}))
+            before = len(synced)
+            assert store._unsynced
+            sleep(0.5)
+            assert len(synced) == before + 1
+            assert not store._unsynced
+            store.close()
+        finally:
+            os.fsync = fsync
+
+    def test_unknown_codec(self):
+        self.assertRaises(ServerError, Data, data_file, codec="yaml")
+
+    def test_store_compacts(self):
+        store = Store(data_file, flush_interval=None, flush_every=1,
+                      wal=True, fsync="always", compact_size=512)
+        for i in range(0, 20):
+            store.execute(dict(command="add data",
+                               data={"key {0}".format(i): "x" * 50}))
+        store.close()
+        assert os.path.getsize(self.wal_file) < 512
+        store = Store(data_file, flush_interval=None, wal=True)
+        assert len(store.data) == 20
+        store.close()
+
+
+class TestShards(TestCase):
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in glob("{0}*".format(data_file)) + [lock_file]:
+            if os.path.exists(name):
+                os.chmod(name, 0o0777)
+                os.unlink(name)
+
+    @staticmethod
+    def shard_data(index):
+        with open("{0}.shard{1}".format(data_file, index), 'rb') as shard:
+            return loads(shard.read().decode('utf-8'))['data']
+
+    def test_keys_spread_over_shards(self):
+        keys = dict(("key {0}".format(i), i) for i in range(50))
+        with Data(data_file, pid_file=lock_file, shards=4) as users:
+            users.add_data(**keys)
+            assert len(users.data) == 50
+        with open(data_file, 'rb') as manifest:
+            assert loads(manifest.read().decode('utf-8'))['shards'] == 4
+        merged = {}
+        for index in range(4):
+            assert self.shard_data(index)
+            merged.update(self.shard_data(index))
+        assert merged == keys
+        with Data(data_file, pid_file=lock_file, shards=4) as users:
+            assert users.data.copy() == keys
+            users.remove_data("key 1", "key 2")
+            assert "key 1" not in users.data and len(users.data) == 48
+
+    def test_calls_load_their_shards(self):
+        with Data(data_file, pid_file=lock_file, shards=4) as users:
+            users.add_data(**dict(("key {0}".format(i), i)
+                                  for i in range(20)))
+            loaded = []
+            for shard in users.shards:
+                shard._load = partial(
+                    lambda shard, load: loaded.append(shard) or load(),
+                    shard, shard._load)
+            users.add_data(**{"key 3": "changed"})
+            assert loaded == [users.shards[users.data.shard_of("key 3")]]
+            users.remove_data("key 4")
+            assert loaded[1:] == [users.shards[users.data.shard_of("key 4")]]
+        with Data(data_file, pid_file=lock_file, shards=4) as users:
+            assert users.data["key 3"] == "changed"
+            assert "key 4" not in users.data and len(users.data) == 19
+
+    def test_requests_hold_their_shards(self):
+        store = Store(data_file, flush_interval=None, shards=4)
+        other = [key for key in ("a", "b", "c", "d", "e", "f")
+                 if store.data.shard_of(key) != store.data.shard_of("a")][0]
+        held, done = Event(), Event()
+
+        def hold():
+            with store._access("get", ["a"]):
+                held.set()
+                done.wait(5)
+        holder = Thread(target=hold)
+        holder.start()
+        held.wait(5)
+        try:
+            # Not held up by the request for a key in another shard
+            assert store.execute(dict(command="set", data={other: 1})) == 1
+            waiting = Thread(target=store.execute,
+                             args=(dict(command="count", data=None),))
+            waiting.start()
+            waiting.join(0.2)
+            assert waiting.is_alive()
+        finally:
+            done.set()
+            holder.join()
+        waiting.join()
+        store.close()
+
+    def test_only_changed_shard_rewritten(self):
+        store = Store(data_file, flush_interval=None, flush_every=1,
+                      shards=4)
+        store.execute(dict(command="set", data=dict(
+            ("key {0}".format(i), i) for i in range(20))))
+        before = [os.stat("{0}.shard{1}".format(data_file, i)).st_ino
+                  for i in range(4)]
+        store.execute(dict(command="set", data={"key 0": "changed"}))
+        after = [os.stat("{0}.shard{1}".format(data_file, i)).st_ino
+                 for i in range(4)]
+        changed = store.data.shard_of("key 0")
+        assert [index for index in range(4)
+                if before[index] != after[index]] == [changed]
+        assert self.shard_data(changed)["key 0"] == "changed"
+        store.close()
+
+    def test_reshard(self):
+        keys = dict(("key {0}".format(i), i) for i in range(30))
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(**keys)
+        with Data(data_file, pid_file=lock_file, shards=3) as users:
+            assert users.data.copy() == keys
+        assert not os.path.exists("{0}.wal".format(data_file))
+        with Data(data_file, pid_file=lock_file, shards=2,
+                  wal=True) as users:
+            assert users.data.copy() == keys
+            users.add_data(added=1)
+        assert not os.path.exists("{0}.shard2".format(data_file))
+        with Data(data_file, pid_file=lock_file) as users:
+            keys['added'] = 1
+            assert users.data == keys
+        assert not os.path.exists("{0}.shard0".format(data_file))
+
+    def test_shared_sharded_stores(self):
+        first = Store(data_file, shared=True, shards=4)
+        second = Store(data_file, shared=True, shards=4)
+        first.execute(dict(command="set", data={"a": 1, "b": 2}))
+        second.execute(dict(command="set", data={"c": 3}))
+        assert second.execute(dict(command="get", data=["a", "b"])) == \
+            {"a": 1, "b": 2}
+        assert first.execute(dict(command="count", data=None)) == 3
+        assert first._parts(first._request_keys("get", ["a"])) == \
+            [first.shards[first.data.shard_of("a")]]
+        assert first._request_keys("batch", [
+            dict(command="set", data={"a": 1}),
+            dict(command="keys", data="")]) is None
+
+    def test_sharded_export_import(self):
+        with Data(data_file, pid_file=lock_file, shards=3) as users:
+            users.add_data(**dict(("key {0}".format(i), i)
+                                  for i in range(10)))
+            users.export_data("test_export.ndjson")
+        self.tearDown()
+        with Data(data_file, pid_file=lock_file, shards=5) as users:
+            users.import_data("test_export.ndjson", batch_size=3)
+            assert len(users.data) == 10
+        os.unlink("test_export.ndjson")
+
+
+class TestIndexedEngine(TestCase):
+
+    records_file = "{0}.records".format(data_file)
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in glob("{0}*".format(data_file)) + [lock_file]:
+            if os.path.exists(name):
+                os.chmod(name, 0o0777)
+                os.unlink(name)
+
+    def test_add_remove_reload(self):
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.add_data(first=1, second=[1, 2], third=None)
+            users.remove_data("second")
+        with open(data_file, 'rb') as manifest:
+            assert loads(manifest.read().decode('utf-8'))['engine'] == \
+                "indexed"
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            assert users.data.copy() == dict(first=1, third=None)
+            assert users.data['third'] is None
+            assert "second" not in users.data
+            assert len(users.data) == 2
+
+    def test_lazy_after_compact(self):
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.add_data(**dict(("key {0}".format(i), i)
+                                  for i in range(100)))
+            users.compact()
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            assert users.data._index_count == 100
+            assert users.data._tail == {}
+            assert users.data["key 42"] == 42
+            assert "key 100" not in users.data
+            users.add_data(**{"key 42": "changed"})
+            assert list(users.data._tail) == ["key 42"]
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            assert users.data["key 42"] == "changed"
+            assert len(users.data) == 100
+            assert sorted(users.data) == sorted("key {0}".format(i)
+                                                for i in range(100))
+
+    def test_convert_json(self):
+        with Data(data_file, pid_file=lock_file, wal=True) as users:
+            users.add_data(converted=1)
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            assert users.data.copy() == dict(converted=1)
+            users.add_data(added=2)
+        assert not os.path.exists("{0}.wal".format(data_file))
+        with Data(data_file, pid_file=lock_file) as users:
+            assert users.data == dict(converted=1, added=2)
+        assert not os.path.exists(self.records_file)
+
+    def test_torn_record(self):
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.add_data(complete=1)
+        size = os.path.getsize(self.records_file)
+        with open(self.records_file, 'ab') as records:
+            records.write(b"\x05\x00\x00\x00\x40")
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            assert users.data.copy() == dict(complete=1)
+            assert os.path.getsize(self.records_file) == size
+
+    def test_store(self):
+        store = Store(data_file, flush_interval=None, engine="indexed",
+                      compact_size=2048)
+        for i in range(50):
+            store.execute(dict(command="set", data={"key": "x" * i}))
+        store.flush()
+        assert store.data.tail_size < 2048
+        store.execute(dict(command="set", data={"other": [1.5, 2.5]}))
+        store.close()
+        store = Store(data_file, flush_interval=None, engine="indexed")
+        assert store.execute(dict(command="get data", data=None)) == \
+            dict(key="x" * 49, other=[1.5, 2.5])
+        store.close()
+
+    def test_frozen_items(self):
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.add_data(kept=1, changed=[1, 2])
+            users.add_data(unwritten=True)
+            items = users.data.frozen_items()
+            users.add_data(changed="after", added=3)
+            users.compact()
+            assert dict(items) == dict(kept=1, changed=[1, 2],
+                                       unwritten=True)
+
+    def test_store_snapshot(self):
+        store = Store(data_file, flush_interval=None, engine="indexed")
+        store.execute(dict(command="set", data={"a": 1, "b": [1.5, 2.5]}))
+        handle = store.open_snapshot()
+        store.execute(dict(command="set", data={"a": 2}))
+        snapshot = loads(handle.read().decode('utf-8'))
+        handle.close()
+        store.close()
+        assert snapshot == dict(data={"a": 1, "b": [1.5, 2.5]},
+                                version=snapshot['version'])
+
+    def test_shared_stores(self):
+        first = Store(data_file, shared=True, engine="indexed")
+        second = Store(data_file, shared=True, engine="indexed")
+        first.execute(dict(command="set", data={"a": 1}))
+        second.execute(dict(command="set", data={"b": 2}))
+        assert first.execute(dict(command="get", data=["a", "b"])) == \
+            dict(a=1, b=2)
+        first.compact()
+        assert second.execute(dict(command="count", data=None)) == 2
+
+    def test_export_import(self):
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.add_data(exported=[1, 2, 3])
+            users.export_data("test_export.json")
+        self.tearDown()
+        with Data(data_file, pid_file=lock_file, engine="indexed") as users:
+            users.import_data("test_export.json")
+            assert users.data["exported"] == [1, 2, 3]
+        os.unlink("test_export.json")
+
+    def test_bad_combinations(self):
+        self.assertRaises(ServerError, Data, data_file, engine="indexed",
+                          wal=True)
+        self.assertRaises(ServerError, Data, data_file, engine="btree")
@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 from unittest import TestCase
+import json
 import os
-from nframe_server import TCPServer, Server, Data, Lock, DATA_FILE, main
+import socket
+import sys
+from nframe_server import (TCPServer, Server, Data, Lock, Store, DATA_FILE,
+                           LockError, main, make_server, serve_forked,
+                           serve_reuseport)
 from nframe_client import Client
+from nframe_replica import Replica
+from nframe_protocol import (RemoteError, send_message, recv_frame,
+                             recv_message, accept_flags, pack_header,
+                             FLAG_ZLIB)
 from threading import Thread
+from time import sleep, time
+from multiprocessing import Process
 from multiprocessing.pool import ThreadPool
 
 
 loc = os.path.abspath(os.path.dirname(__file__))
 
 lock_file = os.path.join(loc, "test.pid")
+snapshot_file = os.path.join(loc, "snapshot.json")
+imported_file = os.path.join(loc, "imported.json")
 server_port = 6758
 server = TCPServer(("localhost", server_port), Server)
 max_runs = 50
@@ -74,6 +87,188 @@ class Interaction(TestCase):
             assert conns[a].message(dict(num=a))['data'] == dict(num=a)
             assert 'num' in conns[a-1].get_data()
 
+    def test_key_commands(self):
+        conn = Client(port=server_port)
+        assert conn.set({"keyed 1": 1, "keyed 2": [2], "other": None}) == 3
+        assert conn.get("keyed 1", "keyed 2", "missing") == \
+            {"keyed 1": 1, "keyed 2": [2]}
+        assert conn.exists("keyed 1", "missing") == [True, False]
+        assert conn.keys("keyed") == ["keyed 1", "keyed 2"]
+        count = conn.count()
+        assert conn.delete("keyed 2", "missing") == 1
+        assert conn.count() == count - 1
+        assert conn.get("keyed 2") == {}
+        self.assertRaises(RemoteError, conn.get, 5)
+        self.assertRaises(RemoteError, conn._communicate, "no such command")
+
+    def test_ttl(self):
+        conn = Client(port=server_port)
+        assert conn.set({"expiring": 1}, ttl=0.05) == 1
+        assert conn.message({"expiring 2": 2}, ttl=0.05)['ttl'] == 0.05
+        with conn.pipeline() as pipe:
+            pipe.set({"expiring 3": 3}, ttl=0.05)
+        assert conn.exists("expiring", "expiring 2", "expiring 3") == \
+            [True, True, True]
+        sleep(0.1)
+        assert conn.exists("expiring", "expiring 2", "expiring 3") == \
+            [False, False, False]
+
+    def test_query(self):
+        conn = Client(port=server_port)
+        conn.set(dict(("queried {0:02}".format(i), dict(number=i))
+                      for i in range(25)))
+        page = conn.query(prefix="queried", where=[["number", "<", 10]],
+                          limit=3, keys_only=True)
+        assert page == dict(items=["queried 00", "queried 01", "queried 02"],
+                            cursor="queried 02")
+        assert [key for key, _ in conn.scan(page_size=4, prefix="queried",
+                                            after="queried 10")] == \
+            ["queried {0}".format(i) for i in range(11, 25)]
+        self.assertRaises(RemoteError, conn.query, where=[["a", "~", 1]])
+
+    def test_pipeline(self):
+        conn = Client(port=server_port)
+        with conn.pipeline() as pipe:
+            pipe.set({"piped": 1}).message({"piped": 2})
+            pipe.get("piped")
+            pipe.delete("piped")
+            pipe.exists("piped")
+        assert pipe.results == [1, {"command": "add data",
+                                    "data": {"piped": 2}},
+                                {"piped": 2}, 1, [False]]
+
+        pipe = conn.pipeline()
+        pipe.set({"before error": True}).get(5).set({"after error": True})
+        try:
+            pipe.execute()
+        except RemoteError as err:
+            assert err.results == [1]
+            assert "Command 1 failed" in str(err)
+        else:
+            assert False, "Batch should fail"
+        assert conn.exists("before error", "after error") == [True, False]
+        assert conn.pipeline().execute() == []
+
+    @staticmethod
+    def test_binary_codec():
+        conn = Client(port=server_port, persistent=True, codec="binary")
+        conn.set({"floats": [0.5, 1.5], "ints": [1, -2, 3]})
+        assert conn.get("floats", "ints") == {"floats": [0.5, 1.5],
+                                              "ints": [1, -2, 3]}
+        assert conn._codec.name == "binary"
+        assert Client(port=server_port).get("ints") == {"ints": [1, -2, 3]}
+        if sys.version_info > (3,):
+            # The data file is JSON, which has no bytes
+            try:
+                conn.set({"raw": b"\x00\x01"})
+            except RemoteError as err:
+                assert "can not be stored as JSON" in str(err)
+            else:
+                assert False, "bytes should be refused by a JSON store"
+            assert conn.set({"after raw": 1}) == 1
+            assert conn.exists("raw") == [False]
+        conn.close()
+
+    @staticmethod
+    def test_compression():
+        conn = Client(port=server_port, persistent=True, compression="zlib",
+                      compress_threshold=1000)
+        conn.set({"compressed": "y" * 200000})
+        assert conn._compression == "zlib"
+        assert conn.get("compressed") == {"compressed": "y" * 200000}
+        conn.close()
+        sock = socket.create_connection(("localhost", server_port))
+        send_message(sock, dict(command="get", data=["compressed"]),
+                     flags=accept_flags("zlib"))
+        flags, payload = recv_frame(sock)
+        assert flags & FLAG_ZLIB and len(payload) < 10000
+        sock.close()
+
+    @staticmethod
+    def test_read_cache():
+        conn = Client(port=server_port, cache_size=10)
+        conn.set(dict(cached=1))
+        assert conn.get("cached", "never set") == dict(cached=1)
+        etag = conn.cache.get(("key", "cached"))[0]
+        assert conn.get("cached", "never set") == dict(cached=1)
+        assert conn.cache.get(("key", "cached"))[0] == etag
+        assert conn.get_data()['cached'] == 1
+        conn.set(dict(cached=2))
+        assert conn.get("cached") == dict(cached=2)
+        assert conn.get_data()['cached'] == 2
+
+    @staticmethod
+    def test_stats():
+        conn = Client(port=server_port)
+        conn.count()
+        stats = conn.stats()
+        assert stats['counters']['bytes_in'] > 0
+        assert stats['counters']['bytes_out'] > 0
+        assert stats['latency']['read']['count'] >= 2
+        assert stats['latency']['command.count']['p99'] >= 0
+
+    def test_snapshot(self):
+        conn = Client(port=server_port)
+        conn.set({"snapshot": [1, 2], "unicode": u"\u00e9"})
+        try:
+            size = conn.download_snapshot(snapshot_file, imported_file)
+            assert size == os.path.getsize(snapshot_file)
+            with open(snapshot_file, "rb") as handle:
+                assert json.loads(handle.read().decode("utf-8"))['data'] == \
+                    conn.get_data()
+            imported = Data(imported_file)
+            imported._load()
+            assert imported.data['snapshot'] == [1, 2]
+            assert imported.data['unicode'] == u"\u00e9"
+            counters = conn.stats()['counters']
+            assert counters['snapshot.saved_file'] >= 1
+            # The import waits for the lock of the data file
+            with Data(imported_file):
+                self.assertRaises(LockError, Client(
+                    port=server_port, timeout=0.2).download_snapshot,
+                    snapshot_file, imported_file)
+        finally:
+            for name in (snapshot_file, imported_file):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    def test_watch_needs_concurrent_mode(self):
+        self.assertRaises(RemoteError, Client(port=server_port).watch)
+
+    @staticmethod
+    def test_persistent_connection():
+        conn = Client(port=server_port, persistent=True)
+        try:
+            for i in range(0, max_runs):
+                assert conn.message(dict(kept=i))['data'] == dict(kept=i)
+            assert len(conn.pool._idle) == 1
+            assert conn.get_data()['kept'] == max_runs - 1
+        finally:
+            conn.close()
+
+    @staticmethod
+    def test_persistent_reconnect():
+        conn = Client(port=server_port, persistent=True)
+        try:
+            conn.message(dict(reconnect=1))
+            # Server side went away while the connection was idle
+            conn.pool._idle[0][0].shutdown(socket.SHUT_RDWR)
+            assert conn.message(dict(reconnect=2))['data'] == dict(reconnect=2)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def test_idle_connection_does_not_block():
+        conn = Client(port=server_port, persistent=True)
+        try:
+            conn.set({"idle": 1})
+            started = time()
+            assert Client(port=server_port).get("idle") == {"idle": 1}
+            assert time() - started < 1
+            assert conn.get("idle") == {"idle": 1}
+        finally:
+            conn.close()
+
     def test_simultaneous_connections(self):
         pool = ThreadPool(10)
         pool.map(self.test_message, range(max_runs, max_runs*2))
@@ -81,4 +276,360 @@ class Interaction(TestCase):
     def test_main(self):
         pargs = main('--exit')
         assert pargs.ip == '0.0.0.0'
-        assert pargs.port == 7645
\ No newline at end of file
+        assert pargs.port == 7645
+        assert pargs.data_file == DATA_FILE
+        assert main('--exit', '--data-file', 'other.json').data_file == \
+            'other.json'
+
+class ConcurrentModes(TestCase):
+
+    def setUp(self):
+        if os.path.exists(DATA_FILE):
+            os.unlink(DATA_FILE)
+
+    def tearDown(self):
+        if os.path.exists(DATA_FILE):
+            os.unlink(DATA_FILE)
+
+    @staticmethod
+    def add_keys(port, worker):
+        conn = Client(port=port)
+        for i in range(0, 10):
+            key = "worker {0} key {1}".format(worker, i)
+            assert conn.message({key: i})['data'] == {key: i}
+
+    def check_no_lost_updates(self, port):
+        pool = ThreadPool(8)
+        pool.map(lambda worker: self.add_keys(port, worker), range(0, 16))
+        pool.close()
+        data = Client(port=port).get_data()
+        for worker in range(0, 16):
+            for i in range(0, 10):
+                key = "worker {0} key {1}".format(worker, i)
+                assert data[key] == i, key
+
+    def test_thread_mode(self):
+        port = server_port + 1
+        threaded = make_server(("localhost", port), "thread")
+        runner = Thread(target=threaded.serve_forever)
+        runner.start()
+        try:
+            self.check_no_lost_updates(port)
+        finally:
+            threaded.shutdown()
+            threaded.server_close()
+            threaded.store.close()
+            runner.join()
+
+    def test_watch(self):
+        port = server_port + 3
+        threaded = make_server(("localhost", port), "thread")
+        runner = Thread(target=threaded.serve_forever)
+        runner.start()
+        try:
+            conn = Client(port=port)
+            conn.set({"before": 0})
+            events = conn.watch(keys=["watched", "gone"])
+            everything = conn.watch()
+            conn.set({"watched": 1, "ignored": 2})
+            conn.set({"gone": 3})
+            conn.delete("gone", "ignored")
+            first = next(events)
+            assert first['op'] == "update"
+            assert first['data'] == {"watched": 1}
+            assert next(events)['data'] == {"gone": 3}
+            deleted = next(events)
+            assert deleted['op'] == "delete" and deleted['keys'] == ["gone"]
+            assert next(everything)['data'] == {"watched": 1, "ignored": 2}
+            events.close()
+            everything.close()
+            # Resume after the first event
+            assert first['token'] == "{0}:{1}".format(
+                threaded.store._instance, first['version'])
+            resumed = conn.watch(since=first['token'])
+            assert next(resumed)['data'] == {"gone": 3}
+            resumed.close()
+            # Same version, but of a server that was restarted since
+            restarted = conn.watch(since="0000:{0}".format(first['version']))
+            assert next(restarted)['op'] == "reset"
+            restarted.close()
+        finally:
+            threaded.shutdown()
+            threaded.server_close()
+            threaded.store.close()
+            runner.join()
+
+    def test_reuseport_mode(self):
+        port = server_port + 6
+        workers = Process(target=serve_reuseport,
+                          args=(("localhost", port), 3, Store))
+        workers.start()
+        try:
+            deadline = time() + 10
+            while Client(port=port).count() == "Error while communicating":
+                assert time() < deadline, "Workers did not start"
+                sleep(0.05)
+            self.check_no_lost_updates(port)
+            conn = Client(port=port, persistent=True)
+            assert conn.set({"written": 1}) == 1
+            assert conn.get("written") == {"written": 1}
+            conn.close()
+        finally:
+            workers.terminate()
+            workers.join()
+        with Data(DATA_FILE) as data:
+            assert data.data["written"] == 1
+
+    def test_fork_mode(self):
+        port = server_port + 2
+        forked = make_server(("localhost", port), "fork")
+        workers = Process(target=serve_forked, args=(forked, 3))
+        workers.start()
+        forked.server_close()
+        try:
+            self.check_no_lost_updates(port)
+        finally:
+            workers.terminate()
+            workers.join()
+            forked.store.close()
+
+
+class Limits(TestCase):
+
+    def setUp(self):
+        if os.path.exists(DATA_FILE):
+            os.unlink(DATA_FILE)
+        self.port = server_port + 7
+        self.server = make_server(("localhost", self.port), "thread",
+                                  max_connections=2, max_request_size=1024,
+                                  request_timeout=0.3)
+        self.store = self.server.store
+        self.runner = Thread(target=self.server.serve_forever)
+        self.runner.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+        self.runner.join()
+        if os.path.exists(DATA_FILE):
+            os.unlink(DATA_FILE)
+
+    def connect(self):
+        sock = socket.create_connection(("localhost", self.port))
+        sock.settimeout(5)
+        return sock
+
+    def test_request_size(self):
+        sock = self.connect()
+        sock.sendall(pack_header(2048))
+        try:
+            recv_message(sock)
+        except RemoteError as err:
+            assert "exceeds the limit of 1024 bytes" in str(err)
+        else:
+            assert False, "Oversized request should be refused"
+        assert sock.recv(1) == b""
+        sock.close()
+        conn = Client(port=self.port, compression="zlib",
+                      compress_threshold=1)
+        self.assertRaises(RemoteError, conn.set, {"big": "x" * 2000})
+        assert conn.set({"small": 1}) == 1
+
+    def test_busy(self):
+        held = [self.connect() for _ in range(2)]
+        for sock in held:
+            send_message(sock, dict(command="count", data=None))
+            recv_message(sock)
+        refused = self.connect()
+        try:
+            recv_message(refused)
+        except RemoteError as err:
+            assert "busy" in str(err)
+        else:
+            assert False, "Connections beyond the limit should be refused"
+        refused.close()
+        held.pop().close()
+        conn = Client(port=self.port)
+        deadline = time() + 5
+        while True:
+            try:
+                assert conn.count() == 0
+                break
+            except (RemoteError, socket.error):
+                assert time() < deadline, "Connection was not released"
+                sleep(0.01)
+        held[0].close()
+        counters = self.store.metrics.snapshot()['counters']
+        assert counters['connections_rejected'] >= 1
+
+    def test_slow_request(self):
+        sock = self.connect()
+        sock.sendall(pack_header(100) + b"{")
+        sleep(0.5)
+        assert sock.recv(1) == b""
+        sock.close()
+
+    def test_deadlines(self):
+        def hold():
+            with self.store._access():
+                sleep(0.5)
+        holder = Thread(target=hold)
+        holder.start()
+        sleep(0.05)
+        conn = Client(port=self.port, timeout=0.2)
+        started = time()
+        self.assertRaises(socket.timeout, conn.count)
+        assert time() - started < 0.45
+        holder.join()
+        assert conn.count() == 0
+        # The request that timed out was dropped once it got the lock
+        deadline = time() + 5
+        while not self.store.metrics.snapshot()['counters'].get(
+                'deadline_exceeded'):
+            assert time() < deadline, "Deadline was not enforced"
+            sleep(0.01)
+        self.assertRaises(RemoteError, Client(port=self.port)._communicate,
+                          "count", timeout="soon")
+
+    def test_deadline_counts_from_header(self):
+        payload = json.dumps(dict(command="count", data=None,
+                                  timeout=0.1)).encode('utf-8')
+        sock = self.connect()
+        sock.sendall(pack_header(len(payload)) + payload[:5])
+        sleep(0.2)
+        sock.sendall(payload[5:])
+        try:
+            recv_message(sock)
+        except RemoteError as err:
+            assert "Deadline exceeded" in str(err)
+        else:
+            assert False, "The time the request took to arrive should count"
+        sock.close()
+
+
+class Snapshots(TestCase):
+
+    def setUp(self):
+        for name in (DATA_FILE, snapshot_file):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def tearDown(self):
+        for name in (DATA_FILE, "{0}.wal".format(DATA_FILE), snapshot_file):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def test_written_snapshot(self):
+        port = server_port + 8
+        threaded = make_server(("localhost", port), "thread",
+                               store=Store(wal=True))
+        runner = Thread(target=threaded.serve_forever)
+        runner.start()
+        try:
+            conn = Client(port=port)
+            conn.set(dict(("key {0}".format(i), i) for i in range(1000)))
+            conn.set({"session": "abc"}, ttl=60)
+            conn.download_snapshot(snapshot_file)
+            with open(snapshot_file, "rb") as handle:
+                snapshot = json.loads(handle.read().decode("utf-8"))
+            assert snapshot['data'] == conn.get_data()
+            assert list(snapshot['expires']) == ["session"]
+            counters = threaded.store.metrics.snapshot()['counters']
+            assert counters['snapshot.written'] == 1
+        finally:
+            threaded.shutdown()
+            threaded.server_close()
+            threaded.store.close()
+            runner.join()
+        self.assertRaises(socket.error, Client(port=port).download_snapshot,
+                          snapshot_file)
+        assert os.path.getsize(snapshot_file) > 1000
+
+
+class Replication(TestCase):
+
+    replica_file = os.path.join(loc, "replica.json")
+
+    def setUp(self):
+        for name in (DATA_FILE, self.replica_file):
+            if os.path.exists(name):
+                os.unlink(name)
+        self.port = server_port + 4
+        self.primary = make_server(("localhost", self.port), "thread",
+                                   store=Store(changelog_size=5))
+        self.replica = Replica(("localhost", self.port), self.replica_file,
+                               reconnect_delay=0.05)
+        self.replica_server = make_server(("localhost", self.port + 1),
+                                          "thread", store=self.replica)
+        self.runners = [Thread(target=server.serve_forever) for server in
+                        (self.primary, self.replica_server)]
+        for runner in self.runners:
+            runner.start()
+
+    def tearDown(self):
+        for server in (self.replica_server, self.primary):
+            server.shutdown()
+            server.server_close()
+            server.store.close()
+        for runner in self.runners:
+            runner.join()
+        for name in (DATA_FILE, self.replica_file):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    @staticmethod
+    def eventually(check, timeout=5):
+        deadline = time() + timeout
+        while not check():
+            assert time() < deadline, "Replica did not catch up"
+            sleep(0.01)
+
+    def test_replica(self):
+        primary = Client(port=self.port)
+        primary.set({"before": 1})
+        assert self.replica.wait_synced(5)
+        assert self.replica.client.codec.name == "json"
+        replica = Client(port=self.port + 1)
+        self.eventually(lambda: replica.get("before") == {"before": 1})
+        primary.set({"after": 2})
+        primary.delete("before")
+        self.eventually(lambda: replica.get_data() == {"after": 2})
+        # Writes are forwarded to the primary, and answered once the
+        # replica holds them
+        assert replica.set({"forwarded": 3}) == 1
+        assert primary.get("forwarded") == {"forwarded": 3}
+        assert replica.exists("forwarded") == [True]
+        with replica.pipeline() as pipe:
+            pipe.delete("forwarded")
+            pipe.count()
+        assert pipe.results == [1, 1]
+        assert replica.count() == 1
+        self.assertRaises(RemoteError, replica.delete, [])
+        stats = replica.stats()['replica']
+        assert stats['synced'] and stats['error'] is None
+
+    def test_reset_and_reconnect(self):
+        primary = Client(port=self.port)
+        assert self.replica.wait_synced(5)
+        # More changes at once than the changelog keeps
+        with primary.pipeline() as pipe:
+            for i in range(10):
+                pipe.set({"key {0}".format(i): i})
+        replica = Client(port=self.port + 1)
+        self.eventually(lambda: replica.count() == 10)
+        self.replica._watch_socket.shutdown(socket.SHUT_RDWR)
+        primary.delete("key 0")
+        self.eventually(lambda: replica.count() == 9)
+
+    def test_reads_spread_over_replicas(self):
+        conn = Client(port=self.port, replicas=[("localhost", self.port + 1),
+                                                ("localhost", self.port + 9)])
+        conn.set({"spread": True})
+        self.eventually(lambda: self.replica.data.get("spread"))
+        served = self.replica.metrics.snapshot()['counters']
+        for _ in range(4):
+            assert conn.get("spread") == {"spread": True}
+        counters = self.replica.metrics.snapshot()['counters']
+        assert counters['command.get'] - served.get('command.get', 0) == 2
+        conn.close()
@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
-from nframe_server import Lock, LockError
+from nframe_server import Lock, LockError, FileLock, Data
 import os
 from json import loads, dumps
 import sys
+from threading import Thread
+from time import sleep, time
 from unittest import TestCase
 
 loc = os.path.abspath(os.path.dirname(__file__))
 
 lock_file = os.path.join(loc, "test.pid")
+data_file = os.path.join(loc, "lock_data.json")
 
 class TestLock(TestCase):
 
@@ -45,4 +48,83 @@ class TestLock(TestCase):
                 with Lock(pid_file=lock_file, safe=True, timeout=2):
                     assert False, "Lock should not work"
             except LockError:
-                assert True
\ No newline at end of file
+                assert True
+
+
+class TestFileLock(TestCase):
+
+    def tearDown(self):
+        for name in (lock_file, data_file):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def test_exclusive(self):
+        with FileLock(lock_file):
+            self.assertRaises(LockError,
+                              FileLock(lock_file, timeout=0).acquire)
+            self.assertRaises(LockError, FileLock(lock_file, timeout=0,
+                                                  exclusive=False).acquire)
+        assert not os.path.exists(lock_file)
+        with FileLock(lock_file, timeout=0) as lock:
+            assert lock.locked
+            self.assertRaises(LockError, lock.acquire)
+        assert not lock.locked
+
+    def test_shared(self):
+        with FileLock(lock_file, exclusive=False):
+            with FileLock(lock_file, timeout=0, exclusive=False):
+                self.assertRaises(LockError,
+                                  FileLock(lock_file, timeout=0).acquire)
+            # The other reader still holds it
+            assert os.path.exists(lock_file)
+        assert not os.path.exists(lock_file)
+
+    def test_fractional_timeout(self):
+        with FileLock(lock_file):
+            started = time()
+            self.assertRaises(LockError,
+                              FileLock(lock_file, timeout=0.2).acquire)
+            assert 0.2 <= time() - started < 0.9
+
+    def release_later(self, lock, delay=0.1):
+        def release():
+            sleep(delay)
+            lock.release()
+        thread = Thread(target=release)
+        thread.start()
+        return thread
+
+    def test_handoff(self):
+        for timeout in (None, 5):
+            holder = FileLock(lock_file)
+            holder.acquire()
+            releaser = self.release_later(holder)
+            started = time()
+            with FileLock(lock_file, timeout=timeout):
+                assert time() - started < 0.5
+            releaser.join()
+
+    def test_released_when_holder_dies(self):
+        pid = os.fork()
+        if pid == 0:
+            FileLock(lock_file).acquire()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with FileLock(lock_file, timeout=0):
+            pass
+
+    def test_data_waits_for_lock(self):
+        holder = FileLock(lock_file)
+        holder.acquire()
+        releaser = self.release_later(holder, 0.2)
+        started = time()
+        with Data(data_file, pid_file=lock_file, timeout=2) as data:
+            data.add_data(waited=True)
+        assert time() - started < 1
+        releaser.join()
+        with FileLock(lock_file, exclusive=False):
+            # Readers do not wait for each other, writers wait for them
+            with Data(data_file, pid_file=lock_file, exclusive=False) as data:
+                assert data.data == dict(waited=True)
+            self.assertRaises(LockError, Data(data_file, pid_file=lock_file,
+                                              timeout=0.1).__enter__)
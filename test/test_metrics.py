@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from unittest import TestCase
+import json
+import os
+from nframe_metrics import Histogram, Metrics, measured
+
+loc = os.path.abspath(os.path.dirname(__file__))
+
+stats_file = os.path.join(loc, "stats.json")
+
+
+class TestMetrics(TestCase):
+
+    def tearDown(self):
+        if os.path.exists(stats_file):
+            os.unlink(stats_file)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for _ in range(98):
+            histogram.add(0.001)
+        histogram.add(0.1)
+        histogram.add(0.2)
+        assert 0.001 <= histogram.percentile(0.5) < 0.00125
+        assert 0.1 <= histogram.percentile(0.99) < 0.125
+        assert histogram.percentile(1.0) == 0.2
+        summary = histogram.summary()
+        assert summary['count'] == 100 and summary['max'] == 200
+        assert Histogram().percentile(0.5) == 0.0
+
+    def test_extremes(self):
+        histogram = Histogram()
+        histogram.add(0)
+        histogram.add(10 ** 6)
+        assert histogram.count == 2
+        assert histogram.percentile(1.0) == 10 ** 6
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        metrics.count("bytes_in", 10)
+        metrics.count("bytes_in", 5)
+        metrics.observe("read", 0.002)
+        snapshot = metrics.snapshot()
+        assert snapshot['counters'] == dict(bytes_in=15)
+        assert snapshot['latency']['read']['count'] == 1
+        metrics.reset()
+        assert metrics.snapshot()['counters'] == {}
+
+    def test_dump(self):
+        metrics = Metrics(stats_file, dump_interval=0)
+        metrics.count("saves")
+        metrics.dump_due()
+        with open(stats_file) as handle:
+            dumped = json.load(handle)
+        assert dumped['counters'] == dict(saves=1)
+        assert dumped['pid'] == os.getpid()
+        metrics.dump_interval = 3600
+        metrics.dump_due()
+        os.unlink(stats_file)
+        metrics.dump_due()
+        assert not os.path.exists(stats_file)
+
+    def test_measured(self):
+        class Timed(object):
+            metrics = None
+
+            @measured("work")
+            def work(self):
+                return 1
+
+        timed = Timed()
+        assert timed.work() == 1
+        timed.metrics = Metrics()
+        assert timed.work() == 1
+        assert timed.metrics.snapshot()['latency']['work']['count'] == 1
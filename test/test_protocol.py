@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from unittest import TestCase, skipIf
+import socket
+from threading import Thread
+from time import time
+from nframe_protocol import (HEADER, MAGIC, FLAG_ERROR, ProtocolError,
+                             ConnectionClosed, RemoteError, encode,
+                             send_frame, recv_frame, send_message,
+                             recv_message, send_error, decode_frame,
+                             accepted_compression, accept_flags, compress,
+                             unpack_header, FLAG_ZLIB, BINARY, COMPRESSIONS,
+                             JSON)
+
+
+class TestProtocol(TestCase):
+
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_round_trip(self):
+        send_message(self.left, {"command": "get data", "data": None})
+        assert recv_message(self.right) == {"command": "get data",
+                                            "data": None}
+
+    def test_large_payload(self):
+        data = {"key": "x" * (1024 * 1024)}
+        sender = Thread(target=send_message, args=(self.left, data))
+        sender.start()
+        assert recv_message(self.right) == data
+        sender.join()
+
+    def test_split_frame(self):
+        payload = encode({"split": list(range(100))})
+        frame = HEADER.pack(MAGIC, 1, 0, len(payload)) + payload
+        for index in range(0, len(frame), 3):
+            self.left.send(frame[index:index + 3])
+        assert recv_message(self.right) == {"split": list(range(100))}
+
+    def test_merged_frames(self):
+        send_frame(self.left, encode("one"))
+        send_frame(self.left, encode("two"))
+        assert recv_message(self.right) == "one"
+        assert recv_message(self.right) == "two"
+
+    def test_error_frame(self):
+        send_error(self.left, "bad things")
+        flags, _ = recv_frame(self.right)
+        assert flags & FLAG_ERROR
+
+    def test_remote_error(self):
+        send_error(self.left, "bad things")
+        self.assertRaises(RemoteError, recv_message, self.right)
+
+    def test_bad_magic(self):
+        self.left.sendall(b'{"sections": 1}')
+        self.assertRaises(ProtocolError, recv_frame, self.right)
+
+    def test_future_version(self):
+        self.left.sendall(HEADER.pack(MAGIC, 255, 0, 0))
+        self.assertRaises(ProtocolError, recv_frame, self.right)
+
+    def test_compression(self):
+        data = {"repeated": "abc" * 10000}
+        for method, (flag, _) in COMPRESSIONS.items():
+            send_message(self.left, data, compression=method)
+            flags, payload = recv_frame(self.right)
+            assert flags & flag
+            assert len(payload) < 1000
+            assert decode_frame(flags, payload)[0] == data
+
+    def test_below_threshold_not_compressed(self):
+        send_message(self.left, "small", compression="zlib")
+        flags, payload = recv_frame(self.right)
+        assert not flags & FLAG_ZLIB
+        assert decode_frame(flags, payload)[0] == "small"
+
+    def test_corrupt_compressed_payload(self):
+        send_frame(self.left, b"not zlib", FLAG_ZLIB)
+        self.assertRaises(ProtocolError, recv_message, self.right)
+
+    @skipIf("lzma" not in COMPRESSIONS, "lzma is not available")
+    def test_accepted_compression(self):
+        assert accepted_compression(accept_flags("lzma")) == "lzma"
+        assert accepted_compression(accept_flags(None)) is None
+
+    def test_size_limits(self):
+        header = HEADER.pack(MAGIC, 1, 0, 2048)
+        assert unpack_header(header, 2048) == (0, 2048)
+        self.assertRaises(ProtocolError, unpack_header, header, 2047)
+        payload = encode("x" * 5000)
+        for method in COMPRESSIONS:
+            packed, flag = compress(payload, method)
+            assert decode_frame(flag, packed, len(payload))[0] == "x" * 5000
+            self.assertRaises(ProtocolError, decode_frame, flag, packed,
+                              len(payload) - 1)
+
+    def test_timeout(self):
+        self.left.sendall(HEADER.pack(MAGIC, 1, 0, 10) + b"abc")
+        started = time()
+        self.assertRaises(socket.timeout, recv_frame, self.right, 0.1)
+        assert time() - started < 1
+
+    def test_closed(self):
+        self.left.sendall(HEADER.pack(MAGIC, 1, 0, 10) + b"abc")
+        self.left.close()
+        self.assertRaises(ConnectionClosed, recv_frame, self.right)
+
+
+class TestBinaryCodec(TestCase):
+
+    def round_trip(self, value):
+        assert BINARY.decode(BINARY.encode(value)) == value
+
+    def test_values(self):
+        for value in (None, True, False, 0, 1, -1, 2 ** 40, -(2 ** 70),
+                      1.25, u"", u"text \u00e9", b"\x00\xff", [], {},
+                      [1, "mixed", None], [2 ** 70, 1], {1: "int key"},
+                      {"nested": {"list": [[1, 2], [0.5, 1.5]]}}):
+            self.round_trip(value)
+
+    def test_packed_arrays(self):
+        ints = list(range(-500, 500))
+        floats = [i / 3.0 for i in range(1000)]
+        self.round_trip(ints)
+        self.round_trip(floats)
+        assert len(BINARY.encode(floats)) < len(JSON.encode(floats)) * 0.6
+
+    def test_malformed(self):
+        payload = BINARY.encode({"key": "value"})
+        self.assertRaises(ValueError, BINARY.decode, payload[:-2])
+        self.assertRaises(ValueError, BINARY.decode, payload + b"\x00")
+        self.assertRaises(ValueError, BINARY.decode, b"\x7f")
+
+    def test_codec_in_flags(self):
+        left, right = socket.socketpair()
+        send_message(left, {"packed": [1, 2, 3]}, codec=BINARY)
+        data, codec = decode_frame(*recv_frame(right))
+        assert data == {"packed": [1, 2, 3]}
+        assert codec is BINARY
+        left.close()
+        right.close()
+
+    def test_unknown_codec(self):
+        payload = encode("x")
+        self.left, self.right = socket.socketpair()
+        send_frame(self.left, payload, 7 << 5)
+        self.assertRaises(ProtocolError, recv_message, self.right)
+        self.left.close()
+        self.right.close()
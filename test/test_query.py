@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from unittest import TestCase
+import os
+import random
+from nframe_query import KeyIndex, FieldIndex, Query, QueryError
+from nframe_server import Store, CommandError
+
+loc = os.path.abspath(os.path.dirname(__file__))
+
+data_file = os.path.join(loc, "query.json")
+
+
+def run(data, fields=(), **query):
+    indexes = {}
+    for field in fields:
+        indexes[field] = FieldIndex(field)
+        indexes[field].build(data.items())
+    return Query(query).run(data, KeyIndex(data), indexes)
+
+
+class TestIndexes(TestCase):
+
+    def test_key_index(self):
+        index = KeyIndex(["b", "d"])
+        index.add(["c", "a"])
+        index.add(["k{0}".format(i) for i in range(20)])
+        index.remove(["d"])
+        assert index.keys[:3] == ["a", "b", "c"] and len(index) == 23
+        assert list(index.scan(prefix="k1")) == \
+            ["k1"] + ["k1{0}".format(i) for i in range(10)]
+        assert list(index.scan(start="b", stop="k0")) == ["b", "c"]
+        assert list(index.scan(after="b", stop="k")) == ["c"]
+        index.remove(["k{0}".format(i) for i in range(20)])
+        assert index.keys == ["a", "b", "c"]
+
+    def test_field_index(self):
+        index = FieldIndex("info.age")
+        index.build([("a", dict(info=dict(age=30))), ("b", dict(info={})),
+                     ("c", dict(info=dict(age=20.5))), ("d", 5),
+                     ("e", dict(info=dict(age="30"))),
+                     ("f", dict(info=dict(age=30)))])
+        assert sorted(index.find("==", 30)) == ["a", "f"]
+        assert index.find("==", "30") == ["e"]
+        assert index.find("<", 30) == ["c"]
+        assert sorted(index.find(">=", 20.5)) == ["a", "c", "f"]
+        assert index.find(">", 30) == []
+        assert index.find("prefix", "3") == ["e"]
+        assert sorted(index.find("in", [20.5, "30"])) == ["c", "e"]
+        assert index.find("==", None) is None
+        assert index.find("!=", 30) is None
+        index.remove("a", dict(info=dict(age=30)))
+        index.add("g", dict(info=dict(age=1)))
+        assert index.find("<=", 30) == ["g", "c", "f"]
+
+
+class TestQuery(TestCase):
+
+    data = dict(("user:{0:02}".format(i),
+                 dict(age=i, name="n{0}".format(i % 3),
+                      tags=["even"] if i % 2 == 0 else None))
+                for i in range(30))
+
+    def test_range_and_pages(self):
+        result = run(self.data, prefix="user:1", keys_only=True)
+        assert result['items'] == ["user:1{0}".format(i) for i in range(10)]
+        assert result['cursor'] is None
+        pages, after = [], None
+        while True:
+            page = run(self.data, start="user:05", stop="user:20", limit=4,
+                       after=after)
+            pages.append([key for key, _ in page['items']])
+            after = page['cursor']
+            if after is None:
+                break
+        assert sum(pages, []) == ["user:{0:02}".format(i)
+                                  for i in range(5, 20)]
+        assert len(pages[0]) == 4
+
+    def test_conditions(self):
+        def keys(where, fields=()):
+            return [key for key, _ in
+                    run(self.data, fields, where=where)['items']]
+        assert keys([["age", "<", 3]]) == ["user:00", "user:01", "user:02"]
+        assert keys([["age", ">=", 28], ["name", "==", "n1"]]) == \
+            ["user:28"]
+        assert keys([["name", "in", ["n0"]], ["age", "<", 7]]) == \
+            ["user:00", "user:03", "user:06"]
+        assert len(keys([["tags", "==", ["even"]]])) == 15
+        assert len(keys([["tags", "!=", None]])) == 15
+        assert keys([["missing", "exists", True]]) == []
+        assert len(keys([["name", "prefix", "n"]])) == 30
+        assert keys([["age", "<", "3"]]) == []
+
+    def test_indexes_agree_with_scans(self):
+        rng = random.Random(7)
+        data = dict(("k{0}".format(i),
+                     dict(a=rng.choice([1, 2, 2.5, "x", "y", None, True]),
+                          b=rng.randrange(10)))
+                    for i in range(200))
+        operands = [1, 2, 2.5, "x", None, True, ["x", 1]]
+        for _ in range(300):
+            operator = rng.choice(["==", "!=", "<", "<=", ">", ">=", "in",
+                                   "prefix"])
+            operand = rng.choice(operands)
+            if operator == "in" and not isinstance(operand, list):
+                operand = [operand]
+            elif operator == "prefix":
+                operand = "x"
+            elif isinstance(operand, list):
+                continue
+            query = dict(where=[["a", operator, operand], ["b", "<", 5]],
+                         start="k1", limit=rng.choice([None, 5]))
+            assert run(data, ["a", "b"], **query) == run(data, **query), \
+                query
+
+    def test_invalid(self):
+        for query in (["a"], dict(unknown=1), dict(prefix=1),
+                      dict(limit=0), dict(limit=True),
+                      dict(where=[["a", "=", 1]]), dict(where=[["a", "=="]]),
+                      dict(where=[["a", "in", 1]]),
+                      dict(where=[["", "==", 1]])):
+            self.assertRaises(QueryError, Query, query)
+
+
+class TestStoreQuery(TestCase):
+
+    def tearDown(self):
+        if os.path.exists(data_file):
+            os.unlink(data_file)
+
+    def test_indexes_follow_changes(self):
+        store = Store(data_file, flush_interval=None, indexes=["age"])
+        store.execute(dict(command="set", data=dict(
+            ("u{0}".format(i), dict(age=i)) for i in range(20))))
+
+        def query(**data):
+            return store.execute(dict(command="query", data=data))['items']
+        assert query(where=[["age", ">", 17]], keys_only=True) == \
+            ["u18", "u19"]
+        store.execute(dict(command="set", data=dict(u18=dict(age=1),
+                                                    new=dict(age=99))))
+        store.execute(dict(command="delete", data=["u19"]))
+        assert query(where=[["age", ">", 17]]) == [["new", dict(age=99)]]
+        assert query(where=[["age", "==", 1]], keys_only=True) == \
+            ["u1", "u18"]
+        assert store.execute(dict(command="keys", data="u1")) == \
+            ["u1"] + ["u1{0}".format(i) for i in range(9)]
+        assert sorted(store._field_indexes['age'].entries) == \
+            store._field_indexes['age'].entries
+        assert len(store._field_indexes['age'].entries) == 20
+        self.assertRaises(CommandError, store.execute,
+                          dict(command="query", data=dict(limit=-1)))
+        store.close()
+
+    def test_keys_other_than_strings(self):
+        store = Store(data_file, flush_interval=None, indexes=["age"],
+                      codec="binary")
+        store.execute(dict(command="set", data={"a": dict(age=1)}))
+        assert store.execute(dict(command="keys", data="")) == ["a"]
+        # Possible with the binary codec, left out of the indexes
+        store.execute(dict(command="set", data={1: dict(age=2),
+                                                "b": dict(age=3)}))
+        assert store.execute(dict(command="keys", data="")) == ["a", "b"]
+        assert store.execute(dict(command="query", data=dict(
+            where=[["age", ">", 1]], keys_only=True)))['items'] == ["b"]
+        assert store.data[1] == dict(age=2)
+        store._delete([1, "a"])
+        assert store.execute(dict(command="keys", data="")) == ["b"]
+        store.close()